@@ -50,6 +50,294 @@ class Is_Alive_Manager(object):
         return True  # do not propergate exception
 
 
+def set_detector_property(detector, name, value):
+    '''
+    Sets a property of Detector_2D or of the nested 2D/3D settings of Detector_3D.
+    Returns False if the detector has no property of that name.
+    '''
+    settings = detector.get_settings()
+    # Detector_3D returns a new dict around its live 2D and 3D settings
+    nested = [settings[key] for key in ('2D_Settings', '3D_Settings') if key in settings]
+    for properties in nested or [settings]:
+        if name in properties:
+            properties[name] = value
+            return True
+    return False
+
+
+def init_eye_pool(timebase, ipc_socket, user_dir, version, eye_id):
+    '''g_pool with the constants and clocks of an eye process'''
+    from uvc import get_time_monotonic
+    g_pool = Global_Container()
+
+    # make some constants avaiable
+    g_pool.user_dir = user_dir
+    g_pool.version = version
+    g_pool.app = 'capture'
+    g_pool.process = 'eye{}'.format(eye_id)
+    g_pool.timebase = timebase
+
+    g_pool.ipc_pub = ipc_socket
+
+    def get_timestamp():
+        return get_time_monotonic() - g_pool.timebase.value
+    g_pool.get_timestamp = get_timestamp
+    g_pool.get_now = get_time_monotonic
+    return g_pool
+
+
+def load_session_settings(g_pool, eye_id, logger):
+    from file_methods import Persistent_Dict
+    from version_utils import VersionFormat
+    session_settings = Persistent_Dict(os.path.join(g_pool.user_dir, 'user_settings_eye{}'.format(eye_id)))
+    if VersionFormat(session_settings.get("version", '0.0')) != g_pool.version:
+        logger.info("Session setting are from a different version of this app. I will not use those.")
+        session_settings.clear()
+    return session_settings
+
+
+def init_capture_and_detector(g_pool, session_settings, eye_id, overwrite_cap_settings, roi_class):
+    '''
+    Creates capture manager, capture source, roi and pupil detector from the session settings.
+    Returns the source classes by name for replacing the source later.
+    '''
+    from video_capture import source_classes
+    from video_capture import manager_classes
+    from pupil_detectors import Detector_2D, Detector_3D
+    pupil_detectors = {Detector_2D.__name__: Detector_2D,
+                       Detector_3D.__name__: Detector_3D}
+
+    capture_manager_settings = session_settings.get(
+        'capture_manager_settings', ('UVC_Manager', {}))
+    manager_class_name, manager_settings = capture_manager_settings
+    manager_class_by_name = {c.__name__: c for c in manager_classes}
+    g_pool.capture_manager = manager_class_by_name[manager_class_name](g_pool, **manager_settings)
+
+    if eye_id == 0:
+        cap_src = ["Pupil Cam1 ID0", "HD-6000", "Integrated Camera", "HD USB Camera", "USB 2.0 Camera"]
+    else:
+        cap_src = ["Pupil Cam1 ID1", "HD-6000", "Integrated Camera"]
+
+    # Initialize capture
+    default_settings = ('UVC_Source', {
+                        'preferred_names': cap_src,
+                        'frame_size': (640, 480),
+                        'frame_rate': 90
+                        })
+
+    capture_source_settings = overwrite_cap_settings or session_settings.get('capture_settings', default_settings)
+    source_class_name, source_settings = capture_source_settings
+    source_class_by_name = {c.__name__: c for c in source_classes}
+    g_pool.capture = source_class_by_name[source_class_name](g_pool, **source_settings)
+    assert g_pool.capture
+
+    g_pool.u_r = roi_class((g_pool.capture.frame_size[1], g_pool.capture.frame_size[0]))
+    roi_user_settings = session_settings.get('roi')
+    if roi_user_settings and tuple(roi_user_settings[-1]) == g_pool.u_r.get()[-1]:
+        g_pool.u_r.set(roi_user_settings)
+
+    pupil_detector_settings = session_settings.get('pupil_detector_settings', None)
+    last_pupil_detector = pupil_detectors[session_settings.get(
+        'last_pupil_detector', Detector_2D.__name__)]
+    g_pool.pupil_detector = last_pupil_detector(g_pool, pupil_detector_settings)
+    return source_class_by_name
+
+
+def save_session_settings(g_pool, session_settings):
+    '''stores the settings init_capture_and_detector reads, window and ui settings are left to the caller'''
+    session_settings['roi'] = g_pool.u_r.get()
+    session_settings['capture_settings'] = g_pool.capture.class_name, g_pool.capture.get_init_dict()
+    session_settings['capture_manager_settings'] = g_pool.capture_manager.class_name, g_pool.capture_manager.get_init_dict()
+    session_settings['version'] = str(g_pool.version)
+    session_settings['last_pupil_detector'] = g_pool.pupil_detector.__class__.__name__
+    session_settings['pupil_detector_settings'] = g_pool.pupil_detector.get_settings()
+
+
+class Eye_Pipeline(object):
+    '''
+    Notification handling and the capture, record, publish and detect step
+    shared by the eye process and the headless eye process.
+
+    set_detector(detector_class) and roi_class are given by the process
+    as they differ in their ui handling. running turns False on ``eye_process.should_stop``.
+    '''
+
+    def __init__(self, g_pool, eye_id, ipc_socket, pupil_socket, set_detector, roi_class, doc, logger):
+        from shared_frames import Frame_Ring_Writer
+        self.g_pool = g_pool
+        self.eye_id = eye_id
+        self.ipc_socket = ipc_socket
+        self.pupil_socket = pupil_socket
+        self.set_detector = set_detector
+        self.roi_class = roi_class
+        self.doc = doc
+        self.logger = logger
+        self.running = True
+        self.frame = None
+        self.result = None
+        self.should_publish_frames = False
+        self.frame_publish_format = 'jpeg'
+        self.frame_publish_shared_memory = False
+        self.frame_ring_writer = Frame_Ring_Writer('eye{}'.format(eye_id))
+        g_pool.writer = None
+
+    def on_notify(self, notification):
+        from pupil_detectors import Detector_2D, Detector_3D
+        g_pool = self.g_pool
+        pupil_socket = self.pupil_socket
+        subject = notification['subject']
+        if subject.startswith('eye_process.should_stop'):
+            if notification['eye_id'] == self.eye_id:
+                self.running = False
+                return
+        elif subject == 'set_detection_mapping_mode':
+            if notification['mode'] == '3d':
+                if not isinstance(g_pool.pupil_detector, Detector_3D):
+                    self.set_detector(Detector_3D)
+            else:
+                if not isinstance(g_pool.pupil_detector, Detector_2D):
+                    self.set_detector(Detector_2D)
+        elif subject == 'recording.started':
+            if notification['record_eye'] and g_pool.capture.online:
+                self.start_recording(notification)
+        elif subject == 'recording.stopped':
+            self.stop_recording()
+        elif subject.startswith('meta.should_doc'):
+            self.ipc_socket.notify({
+                'subject': 'meta.doc',
+                'actor': g_pool.process,
+                'doc': self.doc
+            })
+        elif subject.startswith('frame_publishing.started'):
+            self.should_publish_frames = True
+            self.frame_publish_format = notification.get('format', 'jpeg')
+            self.frame_publish_shared_memory = notification.get('shared_memory', False)
+        elif subject.startswith('frame_publishing.stopped'):
+            self.should_publish_frames = False
+            self.frame_publish_format = 'jpeg'
+            self.frame_publish_shared_memory = False
+            self.frame_ring_writer.close()
+        elif subject.startswith('data_batching.started'):
+            pupil_socket.max_count = notification.get('max_count', 10)
+            pupil_socket.max_delay = notification.get('max_delay', .01)
+        elif subject.startswith('data_batching.stopped'):
+            pupil_socket.flush(force=True)
+            pupil_socket.max_count = 1
+        elif subject.startswith('compact_encoding.started'):
+            pupil_socket.compact = True
+        elif subject.startswith('compact_encoding.stopped'):
+            pupil_socket.compact = False
+        elif subject.startswith('sequence_numbers.started'):
+            pupil_socket.sequence_numbers = True
+        elif subject.startswith('sequence_numbers.stopped'):
+            pupil_socket.sequence_numbers = False
+        elif notification.get('target') == g_pool.process:
+            if subject.startswith('start_eye_capture'):
+                g_pool.replace_source(notification['name'], notification['args'])
+            elif subject == 'pupil_detector.set_property':
+                if not set_detector_property(g_pool.pupil_detector, notification['name'], notification['value']):
+                    self.logger.warning('{} has no property "{}".'.format(
+                        g_pool.pupil_detector.__class__.__name__, notification['name']))
+            elif subject == 'pupil_detector.set_roi':
+                g_pool.u_r.set(notification['roi'])
+
+        g_pool.capture.on_notify(notification)
+
+    def start_recording(self, notification):
+        from av_writer import JPEG_Writer, AV_Writer, Async_Writer
+        from ndsi import H264Writer
+        g_pool = self.g_pool
+        record_path = notification['rec_path']
+        raw_mode = notification['compression']
+        self.logger.info("Will save eye video to: {}".format(record_path))
+        video_path = os.path.join(record_path, "eye{}.mp4".format(self.eye_id))
+        if raw_mode and self.frame and g_pool.capture.jpeg_support:
+            g_pool.writer = JPEG_Writer(video_path, g_pool.capture.frame_rate)
+        elif hasattr(g_pool.capture._recent_frame, 'h264_buffer'):
+            g_pool.writer = H264Writer(video_path,
+                                       g_pool.capture.frame_size[0],
+                                       g_pool.capture.frame_size[1],
+                                       g_pool.capture.frame_rate)
+        else:
+            g_pool.writer = AV_Writer(video_path, g_pool.capture.frame_rate)
+        if notification.get('threaded_writer', False):
+            g_pool.writer = Async_Writer(g_pool.writer)
+
+    def stop_recording(self):
+        if self.g_pool.writer:
+            self.logger.info("Done recording.")
+            self.g_pool.writer.release()
+            self.g_pool.writer = None
+
+    def update(self, visualize=False):
+        '''grab a frame, record and publish it, detect the pupil and stream the result'''
+        g_pool = self.g_pool
+        event = {}
+        g_pool.capture.recent_events(event)
+        frame = self.frame = event.get('frame')
+        g_pool.capture_manager.recent_events(event)
+        if frame:
+            f_width, f_height = g_pool.capture.frame_size
+            if (g_pool.u_r.array_shape[0], g_pool.u_r.array_shape[1]) != (f_height, f_width):
+                g_pool.pupil_detector.on_resolution_change((g_pool.u_r.array_shape[1], g_pool.u_r.array_shape[0]), g_pool.capture.frame_size)
+                g_pool.u_r = self.roi_class((f_height, f_width))
+            if self.should_publish_frames:
+                self.publish_frame(frame)
+
+            if g_pool.writer:
+                # frames a threaded capture grabbed while the last loop iteration ran
+                for queued_frame in event.get('queued_frames', ()):
+                    g_pool.writer.write_video_frame(queued_frame)
+                g_pool.writer.write_video_frame(frame)
+
+            # pupil ellipse detection
+            self.result = g_pool.pupil_detector.detect(frame, g_pool.u_r, visualize)
+            self.result['id'] = self.eye_id
+
+            # stream the result
+            self.pupil_socket.send('pupil.{}'.format(self.eye_id), self.result)
+        self.pupil_socket.flush()
+        return frame
+
+    def publish_frame(self, frame):
+        try:
+            if self.frame_publish_format == "jpeg":
+                data = frame.jpeg_buffer
+            elif self.frame_publish_format == "yuv":
+                data = frame.yuv_buffer
+            elif self.frame_publish_format == "bgr":
+                data = frame.bgr
+            elif self.frame_publish_format == "gray":
+                data = frame.gray
+            else:
+                raise AttributeError()
+        except AttributeError:
+            return
+        datum = {
+            'width': frame.width,
+            'height': frame.height,
+            'index': frame.index,
+            'timestamp': frame.timestamp,
+            'format': self.frame_publish_format
+        }
+        if self.frame_publish_shared_memory:
+            datum['__shm__'] = self.frame_ring_writer.write(data)
+        else:
+            if self.frame_publish_format in ('bgr', 'gray'):
+                # zmq sends zero-copy buffers later, detection draws into these images
+                data = data.copy()
+            datum['__raw_data__'] = [data]
+        self.pupil_socket.send('frame.eye.{}'.format(self.eye_id), datum)
+
+    def cleanup(self):
+        # in case eye recording was still runnnig: Save&close
+        if self.g_pool.writer:
+            self.logger.info("Done recording eye.")
+            self.g_pool.writer.release()
+            self.g_pool.writer = None
+        self.frame_ring_writer.close()
+
+
 def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
         user_dir, version, eye_id, overwrite_cap_settings=None):
     """reads eye video and detects the pupil.
@@ -65,6 +353,15 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
        ``recording.stopped``: Stops recording eye video
        ``frame_publishing.started``: Starts frame publishing
        ``frame_publishing.stopped``: Stops frame publishing
+       ``data_batching.started``: Sends pupil data in batches (`max_count`, `max_delay`)
+       ``data_batching.stopped``: Sends pupil data datum by datum
+       ``compact_encoding.started``: Sends pupil data in the compact encoding of ``datum_schema.py``
+       ``compact_encoding.stopped``: Sends pupil data as msgpack maps
+       ``sequence_numbers.started``: Adds per topic sequence numbers to pupil data
+       ``sequence_numbers.stopped``: Sends pupil data without sequence numbers
+       ``start_eye_capture``: Replaces the capture source of `target`
+       ``pupil_detector.set_property``: Sets detector property `name` to `value` in `target`
+       ``pupil_detector.set_roi``: Sets the region of interest (`roi`: lX, lY, uX, uY) in `target`
 
     Emits notifications:
         ``eye_process.started``: Eye process started
@@ -72,6 +369,7 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
 
     Emits data:
         ``pupil.<eye id>``: Pupil data for eye with id ``<eye id>``
+        ``pupil.<eye id>.batch``: Batched pupil data, see ``zmq_tools.Msg_Batch_Streamer``
         ``frame.eye.<eye id>``: Eye frames with id ``<eye id>``
     """
 
@@ -81,7 +379,8 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
     import zmq_tools
     zmq_ctx = zmq.Context()
     ipc_socket = zmq_tools.Msg_Dispatcher(zmq_ctx, ipc_push_url)
-    pupil_socket = zmq_tools.Msg_Streamer(zmq_ctx, ipc_pub_url)
+    # pupil data is batched after a `data_batching.started` notification
+    pupil_socket = zmq_tools.Msg_Batch_Streamer(zmq_ctx, ipc_pub_url, max_count=1, zero_copy=True)
     notify_sub = zmq_tools.Msg_Receiver(zmq_ctx, ipc_sub_url, topics=("notify",))
 
     # logging setup
@@ -113,19 +412,10 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
         import psutil
 
         # helpers/utils
-        from uvc import get_time_monotonic
-        from file_methods import Persistent_Dict
-        from version_utils import VersionFormat
         from methods import normalize, denormalize, timer
-        from av_writer import JPEG_Writer, AV_Writer
-        from ndsi import H264Writer
-        from video_capture import source_classes
-        from video_capture import manager_classes
 
         # Pupil detectors
         from pupil_detectors import Detector_2D, Detector_3D
-        pupil_detectors = {Detector_2D.__name__: Detector_2D,
-                           Detector_3D.__name__: Detector_3D}
 
         # UI Platform tweaks
         if platform.system() == 'Linux':
@@ -143,21 +433,7 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
         camera_render_size = None
 
         # g_pool holds variables for this process
-        g_pool = Global_Container()
-
-        # make some constants avaiable
-        g_pool.user_dir = user_dir
-        g_pool.version = version
-        g_pool.app = 'capture'
-        g_pool.process = 'eye{}'.format(eye_id)
-        g_pool.timebase = timebase
-
-        g_pool.ipc_pub = ipc_socket
-
-        def get_timestamp():
-            return get_time_monotonic() - g_pool.timebase.value
-        g_pool.get_timestamp = get_timestamp
-        g_pool.get_now = get_time_monotonic
+        g_pool = init_eye_pool(timebase, ipc_socket, user_dir, version, eye_id)
 
         # Callback functions
         def on_resize(window, w, h):
@@ -230,10 +506,7 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
             g_pool.capture.on_drop(paths)
 
         # load session persistent settings
-        session_settings = Persistent_Dict(os.path.join(g_pool.user_dir, 'user_settings_eye{}'.format(eye_id)))
-        if VersionFormat(session_settings.get("version", '0.0')) != g_pool.version:
-            logger.info("Session setting are from a different version of this app. I will not use those.")
-            session_settings.clear()
+        session_settings = load_session_settings(g_pool, eye_id, logger)
 
         g_pool.iconified = False
         g_pool.capture = None
@@ -245,43 +518,8 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
                                          'roi': "Click and drag on the blue circles to adjust the region of interest. The region should be as small as possible, but large enough to capture all pupil movements.",
                                          'algorithm': "Algorithm display mode overlays a visualization of the pupil detection parameters on top of the eye video. Adjust parameters within the Pupil Detection menu below."}
 
-
-        capture_manager_settings = session_settings.get(
-            'capture_manager_settings', ('UVC_Manager',{}))
-
-        manager_class_name, manager_settings = capture_manager_settings
-        manager_class_by_name = {c.__name__:c for c in manager_classes}
-        g_pool.capture_manager = manager_class_by_name[manager_class_name](g_pool,**manager_settings)
-
-        if eye_id == 0:
-            cap_src = ["Pupil Cam1 ID0","HD-6000","Integrated Camera","HD USB Camera","USB 2.0 Camera"]
-        else:
-            cap_src = ["Pupil Cam1 ID1","HD-6000","Integrated Camera"]
-
-        # Initialize capture
-        default_settings = ('UVC_Source',{
-                            'preferred_names'  : cap_src,
-                            'frame_size': (640,480),
-                            'frame_rate': 90
-                            })
-
-        capture_source_settings = overwrite_cap_settings or session_settings.get('capture_settings', default_settings)
-        source_class_name, source_settings = capture_source_settings
-        source_class_by_name = {c.__name__:c for c in source_classes}
-        g_pool.capture = source_class_by_name[source_class_name](g_pool,**source_settings)
-        assert g_pool.capture
-
-        g_pool.u_r = UIRoi((g_pool.capture.frame_size[1],g_pool.capture.frame_size[0]))
-        roi_user_settings = session_settings.get('roi')
-        if roi_user_settings and tuple(roi_user_settings[-1]) == g_pool.u_r.get()[-1]:
-            g_pool.u_r.set(roi_user_settings)
-
-        pupil_detector_settings = session_settings.get(
-            'pupil_detector_settings', None)
-        last_pupil_detector = pupil_detectors[session_settings.get(
-            'last_pupil_detector', Detector_2D.__name__)]
-        g_pool.pupil_detector = last_pupil_detector(
-            g_pool, pupil_detector_settings)
+        source_class_by_name = init_capture_and_detector(g_pool, session_settings, eye_id,
+                                                         overwrite_cap_settings, UIRoi)
 
         def set_display_mode_info(val):
             g_pool.display_mode = val
@@ -373,17 +611,14 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
         g_pool.pupil_detector.init_ui()
         g_pool.capture.init_ui()
         g_pool.capture_manager.init_ui()
-        g_pool.writer = None
+        pipeline = Eye_Pipeline(g_pool, eye_id, ipc_socket, pupil_socket, set_detector, UIRoi, eye.__doc__, logger)
 
         def replace_source(source_class_name, source_settings):
             g_pool.capture.deinit_ui()
             g_pool.capture.cleanup()
             g_pool.capture = source_class_by_name[source_class_name](g_pool,**source_settings)
             g_pool.capture.init_ui()
-            if g_pool.writer:
-                logger.info("Done recording.")
-                g_pool.writer.release()
-                g_pool.writer = None
+            pipeline.stop_recording()
 
         g_pool.replace_source = replace_source # for ndsi capture
 
@@ -421,9 +656,6 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
         # set the last saved window size
         on_resize(main_window, *glfw.glfwGetFramebufferSize(main_window))
 
-        should_publish_frames = False
-        frame_publish_format = 'jpeg'
-
         # create a timer to control window update frequency
         window_update_timer = timer(1 / 60)
 
@@ -432,97 +664,20 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
 
         logger.warning('Process started.')
 
-        frame = None
-
         # Event loop
         while not glfw.glfwWindowShouldClose(main_window):
 
             if notify_sub.new_data:
                 t, notification = notify_sub.recv()
-                subject = notification['subject']
-                if subject.startswith('eye_process.should_stop'):
-                    if notification['eye_id'] == eye_id:
-                        break
-                elif subject == 'set_detection_mapping_mode':
-                    if notification['mode'] == '3d':
-                        if not isinstance(g_pool.pupil_detector, Detector_3D):
-                            set_detector(Detector_3D)
-                        detector_selector.read_only = True
-                    else:
-                        if not isinstance(g_pool.pupil_detector, Detector_2D):
-                            set_detector(Detector_2D)
-                        detector_selector.read_only = False
-                elif subject == 'recording.started':
-                    if notification['record_eye'] and g_pool.capture.online:
-                        record_path = notification['rec_path']
-                        raw_mode = notification['compression']
-                        logger.info("Will save eye video to: {}".format(record_path))
-                        video_path = os.path.join(record_path, "eye{}.mp4".format(eye_id))
-                        if raw_mode and frame and g_pool.capture.jpeg_support:
-                            g_pool.writer = JPEG_Writer(video_path, g_pool.capture.frame_rate)
-                        elif hasattr(g_pool.capture._recent_frame, 'h264_buffer'):
-                            g_pool.writer = H264Writer(video_path,
-                                                       g_pool.capture.frame_size[0],
-                                                       g_pool.capture.frame_size[1],
-                                                       g_pool.capture.frame_rate)
-                        else:
-                            g_pool.writer = AV_Writer(video_path, g_pool.capture.frame_rate)
-                elif subject == 'recording.stopped':
-                    if g_pool.writer:
-                        logger.info("Done recording.")
-                        g_pool.writer.release()
-                        g_pool.writer = None
-                elif subject.startswith('meta.should_doc'):
-                    ipc_socket.notify({
-                        'subject': 'meta.doc',
-                        'actor': 'eye{}'.format(eye_id),
-                        'doc': eye.__doc__
-                    })
-                elif subject.startswith('frame_publishing.started'):
-                    should_publish_frames = True
-                    frame_publish_format = notification.get('format', 'jpeg')
-                elif subject.startswith('frame_publishing.stopped'):
-                    should_publish_frames = False
-                    frame_publish_format = 'jpeg'
-                elif subject.startswith('start_eye_capture') and notification['target'] == g_pool.process:
-                    replace_source(notification['name'],notification['args'])
-
-                g_pool.capture.on_notify(notification)
-
-            # Get an image from the grabber
-            event = {}
-            g_pool.capture.recent_events(event)
-            frame = event.get('frame')
-            g_pool.capture_manager.recent_events(event)
+                pipeline.on_notify(notification)
+                if not pipeline.running:
+                    break
+                if notification['subject'] == 'set_detection_mapping_mode':
+                    detector_selector.read_only = notification['mode'] == '3d'
+
+            frame = pipeline.update(g_pool.display_mode == 'algorithm')
+            result = pipeline.result
             if frame:
-                f_width, f_height = g_pool.capture.frame_size
-                if (g_pool.u_r.array_shape[0], g_pool.u_r.array_shape[1]) != (f_height, f_width):
-                    g_pool.pupil_detector.on_resolution_change((g_pool.u_r.array_shape[1], g_pool.u_r.array_shape[0]), g_pool.capture.frame_size)
-                    g_pool.u_r = UIRoi((f_height, f_width))
-                if should_publish_frames:
-                    try:
-                        if frame_publish_format == "jpeg":
-                            data = frame.jpeg_buffer
-                        elif frame_publish_format == "yuv":
-                            data = frame.yuv_buffer
-                        elif frame_publish_format == "bgr":
-                            data = frame.bgr
-                        elif frame_publish_format == "gray":
-                            data = frame.gray
-                        else:
-                            raise AttributeError()
-                    except AttributeError:
-                        pass
-                    else:
-                        pupil_socket.send('frame.eye.%s'%eye_id,{
-                            'width': frame.width,
-                            'height': frame.height,
-                            'index': frame.index,
-                            'timestamp': frame.timestamp,
-                            'format': frame_publish_format,
-                            '__raw_data__': [data]
-                        })
-
                 t = frame.timestamp
                 dt, ts = t - ts, t
                 try:
@@ -530,16 +685,6 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
                 except ZeroDivisionError:
                     pass
 
-                if g_pool.writer:
-                    g_pool.writer.write_video_frame(frame)
-
-                # pupil ellipse detection
-                result = g_pool.pupil_detector.detect(frame, g_pool.u_r, g_pool.display_mode == 'algorithm')
-                result['id'] = eye_id
-
-                # stream the result
-                pupil_socket.send('pupil.%s'%eye_id,result)
-
             cpu_graph.update()
 
             # GL drawing
@@ -618,25 +763,17 @@ def eye(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
 
         # END while running
 
-        # in case eye recording was still runnnig: Save&close
-        if g_pool.writer:
-            logger.info("Done recording eye.")
-            g_pool.writer = None
+        pipeline.cleanup()
 
         glfw.glfwRestoreWindow(main_window)  # need to do this for windows os
         # save session persistent settings
+        save_session_settings(g_pool, session_settings)
         session_settings['gui_scale'] = g_pool.gui_user_scale
-        session_settings['roi'] = g_pool.u_r.get()
         session_settings['flip'] = g_pool.flip
         session_settings['display_mode'] = g_pool.display_mode
         session_settings['ui_config'] = g_pool.gui.configuration
-        session_settings['capture_settings'] = g_pool.capture.class_name, g_pool.capture.get_init_dict()
-        session_settings['capture_manager_settings'] = g_pool.capture_manager.class_name, g_pool.capture_manager.get_init_dict()
         session_settings['window_size'] = glfw.glfwGetWindowSize(main_window)
         session_settings['window_position'] = glfw.glfwGetWindowPos(main_window)
-        session_settings['version'] = str(g_pool.version)
-        session_settings['last_pupil_detector'] = g_pool.pupil_detector.__class__.__name__
-        session_settings['pupil_detector_settings'] = g_pool.pupil_detector.get_settings()
         session_settings.close()
 
         g_pool.capture.deinit_ui()
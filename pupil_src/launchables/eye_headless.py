@@ -0,0 +1,116 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+from .eye import Is_Alive_Manager, Eye_Pipeline
+from .eye import init_eye_pool, load_session_settings, init_capture_and_detector, save_session_settings
+
+
+def eye_headless(timebase, is_alive_flag, ipc_pub_url, ipc_sub_url, ipc_push_url,
+                 user_dir, version, eye_id, overwrite_cap_settings=None):
+    """reads eye video and detects the pupil without window, gl context or ui.
+
+    Grabs images from a capture.
+    Streams Pupil coordinates.
+    Uses the same session settings as the eye process with window.
+
+    Reacts to notifications:
+       ``set_detection_mapping_mode``: Sets detection method
+       ``eye_process.should_stop``: Stops the eye process
+       ``recording.started``: Starts recording eye video
+       ``recording.stopped``: Stops recording eye video
+       ``frame_publishing.started``: Starts frame publishing
+       ``frame_publishing.stopped``: Stops frame publishing
+       ``data_batching.started``: Sends pupil data in batches (`max_count`, `max_delay`)
+       ``data_batching.stopped``: Sends pupil data datum by datum
+       ``compact_encoding.started``: Sends pupil data in the compact encoding of ``datum_schema.py``
+       ``compact_encoding.stopped``: Sends pupil data as msgpack maps
+       ``sequence_numbers.started``: Adds per topic sequence numbers to pupil data
+       ``sequence_numbers.stopped``: Sends pupil data without sequence numbers
+       ``start_eye_capture``: Replaces the capture source of `target`
+       ``pupil_detector.set_property``: Sets detector property `name` to `value` in `target`
+       ``pupil_detector.set_roi``: Sets the region of interest (`roi`: lX, lY, uX, uY) in `target`
+
+    Emits notifications:
+        ``eye_process.started``: Eye process started
+        ``eye_process.stopped``: Eye process stopped
+
+    Emits data:
+        ``pupil.<eye id>``: Pupil data for eye with id ``<eye id>``
+        ``pupil.<eye id>.batch``: Batched pupil data, see ``zmq_tools.Msg_Batch_Streamer``
+        ``frame.eye.<eye id>``: Eye frames with id ``<eye id>``
+    """
+
+    # We deferr the imports becasue of multiprocessing.
+    # Otherwise the world process each process also loads the other imports.
+    import zmq
+    import zmq_tools
+    zmq_ctx = zmq.Context()
+    ipc_socket = zmq_tools.Msg_Dispatcher(zmq_ctx, ipc_push_url)
+    # pupil data is batched after a `data_batching.started` notification
+    pupil_socket = zmq_tools.Msg_Batch_Streamer(zmq_ctx, ipc_pub_url, max_count=1, zero_copy=True)
+    notify_sub = zmq_tools.Msg_Receiver(zmq_ctx, ipc_sub_url, topics=("notify",))
+
+    # logging setup
+    import logging
+    logger = logging.getLogger()
+    logger.handlers = []
+    logger.setLevel(logging.INFO)
+    logger.addHandler(zmq_tools.ZMQ_handler(zmq_ctx, ipc_push_url))
+    # create logger for the context of this function
+    logger = logging.getLogger(__name__)
+
+    with Is_Alive_Manager(is_alive_flag, ipc_socket, eye_id, logger):
+        from methods import Roi
+
+        # g_pool holds variables for this process
+        g_pool = init_eye_pool(timebase, ipc_socket, user_dir, version, eye_id)
+        g_pool.headless = True
+
+        # load session persistent settings
+        session_settings = load_session_settings(g_pool, eye_id, logger)
+        source_class_by_name = init_capture_and_detector(g_pool, session_settings, eye_id,
+                                                         overwrite_cap_settings, Roi)
+
+        def set_detector(new_detector):
+            g_pool.pupil_detector.cleanup()
+            g_pool.pupil_detector = new_detector(g_pool)
+
+        pipeline = Eye_Pipeline(g_pool, eye_id, ipc_socket, pupil_socket, set_detector, Roi, eye_headless.__doc__, logger)
+
+        def replace_source(source_class_name, source_settings):
+            g_pool.capture.cleanup()
+            g_pool.capture = source_class_by_name[source_class_name](g_pool, **source_settings)
+            pipeline.stop_recording()
+
+        g_pool.replace_source = replace_source  # for ndsi capture
+
+        logger.warning('Process started.')
+
+        # Event loop
+        while pipeline.running:
+            while notify_sub.new_data and pipeline.running:
+                t, notification = notify_sub.recv()
+                pipeline.on_notify(notification)
+            if pipeline.running:
+                pipeline.update()
+
+        # END while running
+
+        pipeline.cleanup()
+
+        # save session persistent settings, window and ui settings are left untouched
+        save_session_settings(g_pool, session_settings)
+        session_settings.close()
+
+        g_pool.pupil_detector.cleanup()
+        g_pool.capture_manager.cleanup()
+        g_pool.capture.cleanup()
+        logger.info("Process shutting down.")
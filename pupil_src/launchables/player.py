@@ -413,8 +413,7 @@ def player(rec_dir, ipc_pub_url, ipc_sub_url,
             # notify each plugin if there are new notifications:
             for n in new_notifications:
                 handle_notifications(n)
-                for p in g_pool.plugins:
-                    p.on_notify(n)
+                g_pool.plugins.on_notify(n)
 
             # grab new frame
             if g_pool.capture.play or g_pool.new_seek:
@@ -437,8 +436,7 @@ def player(rec_dir, ipc_pub_url, ipc_sub_url,
             events['gaze_positions'] = []
 
             # allow each Plugin to do its work.
-            for p in g_pool.plugins:
-                p.recent_events(events)
+            g_pool.plugins.recent_events(events)
 
             # check if a plugin need to be destroyed
             g_pool.plugins.clean()
@@ -450,8 +448,7 @@ def player(rec_dir, ipc_pub_url, ipc_sub_url,
                 gl_utils.glViewport(0, 0, *g_pool.camera_render_size)
                 g_pool.capture._recent_frame = frame
                 g_pool.capture.gl_display()
-                for p in g_pool.plugins:
-                    p.gl_display()
+                g_pool.plugins.gl_display()
 
                 gl_utils.glViewport(0, 0, *window_size)
 
@@ -24,6 +24,13 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
        ``start_plugin``: Starts given plugin with the given arguments
        ``eye_process.started``: Sets the detection method eye process
        ``service_process.should_stop``: Stops the service process
+       ``data_batching.started``: Sends gaze in batches (`max_count`, `max_delay`)
+       ``data_batching.stopped``: Sends gaze datum by datum
+       ``compact_encoding.started``: Sends gaze in the compact encoding of ``datum_schema.py``
+       ``compact_encoding.stopped``: Sends gaze as msgpack maps
+       ``sequence_numbers.started``: Adds per topic sequence numbers to gaze
+       ``sequence_numbers.stopped``: Sends gaze without sequence numbers
+       ``set_pupil_batching``: Limits pupil data mapped per batch (`max_count`, `max_latency`)
 
     Emits notifications:
         ``eye_process.should_start``
@@ -43,7 +50,7 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
     # This is not harmful but unnecessary.
 
     # general imports
-    from time import sleep
+    from time import sleep, perf_counter
     import logging
     import zmq
     import zmq_tools
@@ -51,7 +58,8 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
     # zmq ipc setup
     zmq_ctx = zmq.Context()
     ipc_pub = zmq_tools.Msg_Dispatcher(zmq_ctx, ipc_push_url)
-    gaze_pub = zmq_tools.Msg_Streamer(zmq_ctx, ipc_pub_url)
+    # gaze is batched after a `data_batching.started` notification
+    gaze_pub = zmq_tools.Msg_Batch_Streamer(zmq_ctx, ipc_pub_url, max_count=1)
     pupil_sub = zmq_tools.Msg_Receiver(zmq_ctx, ipc_sub_url, topics=('pupil',))
     notify_sub = zmq_tools.Msg_Receiver(zmq_ctx, ipc_sub_url, topics=('notify',))
 
@@ -136,6 +144,10 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
             session_settings.clear()
 
         g_pool.detection_mapping_mode = session_settings.get('detection_mapping_mode', '2d')
+        # pending pupil data are mapped and passed to the plugins in batches,
+        # a batch ends after max_count data or max_latency seconds of receiving
+        g_pool.pupil_batch_max_count = session_settings.get('pupil_batch_max_count', 100)
+        g_pool.pupil_batch_max_latency = session_settings.get('pupil_batch_max_latency', .005)
         g_pool.active_calibration_plugin = None
         g_pool.active_gaze_mapping_plugin = None
 
@@ -159,6 +171,23 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
                 ipc_pub.notify(n)
             elif subject == 'service_process.should_stop':
                 g_pool.service_should_run = False
+            elif subject == 'data_batching.started':
+                gaze_pub.max_count = n.get('max_count', 10)
+                gaze_pub.max_delay = n.get('max_delay', .01)
+            elif subject == 'data_batching.stopped':
+                gaze_pub.flush(force=True)
+                gaze_pub.max_count = 1
+            elif subject == 'compact_encoding.started':
+                gaze_pub.compact = True
+            elif subject == 'compact_encoding.stopped':
+                gaze_pub.compact = False
+            elif subject == 'sequence_numbers.started':
+                gaze_pub.sequence_numbers = True
+            elif subject == 'sequence_numbers.stopped':
+                gaze_pub.sequence_numbers = False
+            elif subject == 'set_pupil_batching':
+                g_pool.pupil_batch_max_count = max(1, int(n.get('max_count', g_pool.pupil_batch_max_count)))
+                g_pool.pupil_batch_max_latency = n.get('max_latency', g_pool.pupil_batch_max_latency)
             elif subject.startswith('meta.should_doc'):
                 ipc_pub.notify({
                     'subject': 'meta.doc',
@@ -182,24 +211,33 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
 
         # Event loop
         while g_pool.service_should_run:
-            socks = dict(poller.poll())
-            if pupil_sub.socket in socks:
-                t, p = pupil_sub.recv()
-                new_gaze_data = g_pool.active_gaze_mapping_plugin.on_pupil_datum(p)
-                for g in new_gaze_data:
-                    gaze_pub.send('gaze', g)
-
-                events = {}
-                events['gaze_positions'] = new_gaze_data
-                events['pupil_positions'] = [p]
-                for plugin in g_pool.plugins:
-                    plugin.recent_events(events=events)
+            # data left over from a full batch are not signaled by the socket again
+            pupil_pending = pupil_sub.new_data
+            socks = dict(poller.poll(0 if pupil_pending else None))
+            if pupil_pending or pupil_sub.socket in socks:
+                # drain pending pupil data, a batched message holds several
+                pupil_data = []
+                batch_end = perf_counter() + g_pool.pupil_batch_max_latency
+                while pupil_sub.new_data:
+                    t, p = pupil_sub.recv()
+                    pupil_data.append(p)
+                    if len(pupil_data) >= g_pool.pupil_batch_max_count or perf_counter() > batch_end:
+                        break
+                if pupil_data:
+                    new_gaze_data = g_pool.active_gaze_mapping_plugin.on_pupil_batch(pupil_data)
+                    for g in new_gaze_data:
+                        gaze_pub.send('gaze', g)
+                    gaze_pub.flush(force=True)
+
+                    events = {}
+                    events['gaze_positions'] = new_gaze_data
+                    events['pupil_positions'] = pupil_data
+                    g_pool.plugins.recent_events(events)
 
             if notify_sub.socket in socks:
                 t, n = notify_sub.recv()
                 handle_notifications(n)
-                for plugin in g_pool.plugins:
-                    plugin.on_notify(n)
+                g_pool.plugins.on_notify(n)
 
             # check if a plugin need to be destroyed
             g_pool.plugins.clean()
@@ -209,6 +247,8 @@ def service(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url, ipc_push_url, us
         session_settings['eye0_process_alive'] = eyes_are_alive[0].value
         session_settings['eye1_process_alive'] = eyes_are_alive[1].value
         session_settings['detection_mapping_mode'] = g_pool.detection_mapping_mode
+        session_settings['pupil_batch_max_count'] = g_pool.pupil_batch_max_count
+        session_settings['pupil_batch_max_latency'] = g_pool.pupil_batch_max_latency
         session_settings['audio_mode'] = audio.audio_mode
         session_settings.close()
 
@@ -59,7 +59,8 @@ def world(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url,
 
     # zmq ipc setup
     zmq_ctx = zmq.Context()
-    ipc_pub = zmq_tools.Msg_Dispatcher(zmq_ctx, ipc_push_url)
+    # zero-copy for frames published by Frame_Publisher
+    ipc_pub = zmq_tools.Msg_Dispatcher(zmq_ctx, ipc_push_url, zero_copy=True)
     notify_sub = zmq_tools.Msg_Receiver(zmq_ctx, ipc_sub_url, topics=('notify',))
 
     # log setup
@@ -423,8 +424,7 @@ def world(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url,
             # notify each plugin if there are new notifications:
             for n in new_notifications:
                 handle_notifications(n)
-                for p in g_pool.plugins:
-                    p.on_notify(n)
+                g_pool.plugins.on_notify(n)
 
 
             #a dictionary that allows plugins to post and read events
@@ -433,8 +433,7 @@ def world(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url,
             events['dt'] = get_dt()
 
             # allow each Plugin to do its work.
-            for p in g_pool.plugins:
-                p.recent_events(events)
+            g_pool.plugins.recent_events(events)
 
             # check if a plugin need to be destroyed
             g_pool.plugins.clean()
@@ -444,6 +443,8 @@ def world(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url,
             del events['gaze_positions']  # sent earlier
             if 'frame' in events:
                 del events['frame']  # send explicity with frame publisher
+            if 'queued_frames' in events:
+                del events['queued_frames']
             if 'depth_frame' in events:
                 del events['depth_frame']
             if 'audio_packets' in events:
@@ -459,8 +460,7 @@ def world(timebase, eyes_are_alive, ipc_pub_url, ipc_sub_url,
             if window_should_update() and gl_utils.is_window_visible(main_window):
 
                 gl_utils.glViewport(0, 0, *camera_render_size)
-                for p in g_pool.plugins:
-                    p.gl_display()
+                g_pool.plugins.gl_display()
 
                 gl_utils.glViewport(0, 0, *window_size)
                 unused_elements = g_pool.gui.update()
@@ -14,11 +14,13 @@ import os, sys, platform
 # sys.argv.append('profiled')
 # sys.argv.append('debug')
 # sys.argv.append('service')
+# sys.argv.append('ipc_stats')
+# sys.argv.append('headless')  # service with eye processes without windows
 
 app = 'capture'
 
 if getattr(sys, 'frozen', False):
-    if 'pupil_service' in sys.executable:
+    if 'pupil_service' in sys.executable or 'headless' in sys.argv:
         app = 'service'
     elif 'pupil_player' in sys.executable:
         app = 'player'
@@ -26,7 +28,7 @@ if getattr(sys, 'frozen', False):
     user_dir = os.path.expanduser(os.path.join('~', 'pupil_{}_settings'.format(app)))
     version_file = os.path.join(sys._MEIPASS, '_version_string_')
 else:
-    if 'service' in sys.argv:
+    if 'service' in sys.argv or 'headless' in sys.argv:
         app = 'service'
     if 'player' in sys.argv:
         app = 'player'
@@ -75,8 +77,11 @@ else:
     from launchables.service import service
     from launchables.eye import eye
     from launchables.player import player
+if 'headless' in sys.argv:
+    from launchables.eye_headless import eye_headless as eye
 from launchables.player import player_drop
 from launchables.marker_detectors import circle_detector
+from delayed_notifications import delay_proxy
 
 
 def clear_settings(user_dir):
@@ -104,32 +109,9 @@ def launcher():
         pub.connect(ipc_pub_url)
 
         while True:
-            m = pull.recv_multipart()
-            pub.send_multipart(m)
-
-
-    #The delay proxy handles delayed notififications.
-    def delay_proxy(ipc_pub_url,ipc_sub_url):
-        ctx = zmq.Context.instance()
-        sub = zmq_tools.Msg_Receiver(ctx,ipc_sub_url,('delayed_notify',))
-        pub = zmq_tools.Msg_Dispatcher(ctx,ipc_pub_url)
-        poller = zmq.Poller()
-        poller.register(sub.socket, zmq.POLLIN)
-        waiting_notifications = {}
-
-        while True:
-            if poller.poll(timeout=250):
-                #Recv new delayed notification and store it.
-                topic,n = sub.recv()
-                n['_notify_time_'] = time()+n['delay']
-                waiting_notifications[n['subject']] = n
-            #When a notifications time has come, pop from dict and send it as notification
-            for s,n in list(waiting_notifications.items()):
-                if n['_notify_time_'] < time():
-                    del n['_notify_time_']
-                    del n['delay']
-                    del waiting_notifications[s]
-                    pub.notify(n)
+            # forward without copying, frames can be large
+            m = pull.recv_multipart(copy=False)
+            pub.send_multipart(m, copy=False)
 
 
     #Recv log records from other processes.
@@ -187,7 +169,17 @@ def launcher():
 
     # Starting communication threads:
     # A ZMQ Proxy Device serves as our IPC Backbone
-    ipc_backbone_thread = Thread(target=zmq.proxy, args=(xsub_socket,xpub_socket))
+    if 'ipc_stats' in sys.argv:
+        # instrumented proxy, publishes per topic throughput and latency as `stats.ipc`
+        from ipc_stats import instrumented_proxy
+        try:
+            from uvc import get_time_monotonic
+        except ImportError:
+            from time import monotonic as get_time_monotonic
+        get_ipc_time = lambda: get_time_monotonic() - timebase.value
+        ipc_backbone_thread = Thread(target=instrumented_proxy, args=(xsub_socket,xpub_socket,get_ipc_time))
+    else:
+        ipc_backbone_thread = Thread(target=zmq.proxy, args=(xsub_socket,xpub_socket))
     ipc_backbone_thread.setDaemon(True)
     ipc_backbone_thread.start()
 
@@ -199,6 +191,7 @@ def launcher():
     log_thread.setDaemon(True)
     log_thread.start()
 
+    #The delay proxy handles delayed notififications.
     delay_thread = Thread(target=delay_proxy, args=(ipc_push_url,ipc_sub_url))
     delay_thread.setDaemon(True)
     delay_thread.start()
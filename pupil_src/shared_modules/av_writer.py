@@ -32,6 +32,7 @@ import png
 from threading import Thread
 from threading import Event
 import multiprocessing as mp
+import queue
 
 
 """
@@ -126,31 +127,38 @@ class AV_Writer(object):
         self.current_frame_idx = 0
         self.audio_packets_decoded = 0
 
-    def write_video_frame(self, input_frame):
+    def prepare_frame(self, input_frame, detach=False):
+        '''
+        image data of input_frame for write_prepared.
+        detach: copy image data that the caller may still change (bgr images plugins draw into)
+        '''
+        if input_frame.yuv_buffer is not None:
+            # decoded per frame, nobody draws into it
+            planes = input_frame.yuv422
+            pix_fmt = 'yuv422p'
+        else:
+            planes = (input_frame.img.copy() if detach else input_frame.img,)
+            pix_fmt = 'bgr24'
+        return input_frame.width, input_frame.height, input_frame.timestamp, pix_fmt, planes
+
+    def write_prepared(self, prepared):
+        width, height, timestamp, pix_fmt, planes = prepared
         if not self.configured:
-            self.video_stream.height = input_frame.height
-            self.video_stream.width = input_frame.width
+            self.video_stream.height = height
+            self.video_stream.width = width
             self.configured = True
-            self.start_time = input_frame.timestamp
-            if input_frame.yuv_buffer is not None:
-                self.frame = av.VideoFrame(input_frame.width, input_frame.height, 'yuv422p')
-            else:
-                self.frame = av.VideoFrame(input_frame.width,input_frame.height, 'bgr24')
+            self.start_time = timestamp
+            self.frame = av.VideoFrame(width, height, pix_fmt)
             if self.use_timestamps:
                 self.frame.time_base = self.time_base
             else:
                 self.frame.time_base = Fraction(1,self.fps)
 
-        if input_frame.yuv_buffer is not None:
-            y, u, v = input_frame.yuv422
-            self.frame.planes[0].update(y)
-            self.frame.planes[1].update(u)
-            self.frame.planes[2].update(v)
-        else:
-            self.frame.planes[0].update(input_frame.img)
+        for plane, data in zip(self.frame.planes, planes):
+            plane.update(data)
 
         if self.use_timestamps:
-            self.frame.pts = int((input_frame.timestamp-self.start_time)/self.time_base)
+            self.frame.pts = int((timestamp-self.start_time)/self.time_base)
         else:
             # our timebase is 1/30  so a frame idx is the correct pts for an fps recorded video.
             self.frame.pts = self.current_frame_idx
@@ -159,7 +167,7 @@ class AV_Writer(object):
         if packet:
             self.container.mux(packet)
         self.current_frame_idx += 1
-        self.timestamps.append(input_frame.timestamp)
+        self.timestamps.append(timestamp)
         if self.audio_export:
             for audio_packet in self.audio_rec.demux():
                 if self.audio_packets_decoded >= len(self.audio_ts):
@@ -179,6 +187,9 @@ class AV_Writer(object):
                 if audio_pts * self.audio_export.time_base > self.frame.pts * self.time_base:
                     break  # wait for next image
 
+    def write_video_frame(self, input_frame):
+        self.write_prepared(self.prepare_frame(input_frame))
+
     def close(self):
         # flush encoder
         while 1:
@@ -224,20 +235,28 @@ class JPEG_Writer(object):
 
         self.write_video_frame_compressed = self.write_video_frame
 
-    def write_video_frame(self, input_frame):
+    def prepare_frame(self, input_frame, detach=False):
+        '''jpeg data of input_frame for write_prepared, the buffer is not copied'''
+        return input_frame.width, input_frame.height, input_frame.timestamp, input_frame.jpeg_buffer
+
+    def write_prepared(self, prepared):
+        width, height, timestamp, jpeg_buffer = prepared
         if not self.configured:
-            self.video_stream.height = input_frame.height
-            self.video_stream.width = input_frame.width
+            self.video_stream.height = height
+            self.video_stream.width = width
             self.configured = True
 
         packet = Packet()
-        packet.payload = input_frame.jpeg_buffer
+        packet.payload = jpeg_buffer
         # we are setting the packet pts manually this uses a different timebase av.frame!
         packet.dts = int(self.frame_count/self.video_stream.time_base/self.fps)
         packet.pts = int(self.frame_count/self.video_stream.time_base/self.fps)
         self.frame_count += 1
         self.container.mux(packet)
-        self.timestamps.append(input_frame.timestamp)
+        self.timestamps.append(timestamp)
+
+    def write_video_frame(self, input_frame):
+        self.write_prepared(self.prepare_frame(input_frame))
 
     def close(self):
         try:
@@ -252,6 +271,90 @@ class JPEG_Writer(object):
 
 
 
+class Async_Writer(object):
+    """
+    Encodes and writes the frames of a writer on a separate thread.
+        - writer: AV_Writer, JPEG_Writer, H264Writer or any object with write_video_frame and release
+        - queue_size: number of frames waiting for the encoder at most
+        - overflow: 'block' the caller while the queue is full or 'drop' frames.
+          Recordings should block, dropped frames leave gaps in the video.
+
+    Frame data is taken out of the frame on the caller's thread if the writer
+    has prepare_frame/write_prepared, otherwise the frame itself is queued.
+    write_video_frame returns False for dropped frames, they are not written and have no timestamp.
+    release() writes all queued frames before it releases the writer.
+    """
+
+    def __init__(self, writer, queue_size=30, overflow='block'):
+        assert overflow in ('drop', 'block')
+        self.writer = writer
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.prepare = getattr(writer, 'prepare_frame', None)
+        self.write = writer.write_prepared if self.prepare else writer.write_video_frame
+        self.written = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.max_queued = 0
+        self.error = None
+        self.thread = Thread(target=self._run, name='Encoder', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(item)
+            except Exception as e:
+                logger.error('Encoder thread stopped: {}'.format(e))
+                self.error = e
+                return
+            self.written += 1
+
+    def write_video_frame(self, input_frame):
+        if self.error is not None:
+            raise self.error
+        item = self.prepare(input_frame, detach=True) if self.prepare else input_frame
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return False
+            self.blocked += 1
+            while True:
+                # the encoder thread stops draining the queue when it fails
+                if self.error is not None:
+                    raise self.error
+                try:
+                    self.queue.put(item, timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+        return True
+
+    write_video_frame_compressed = write_video_frame
+
+    def release(self):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        log = logger.warning if self.dropped else logger.debug
+        log('Encoder thread wrote {} frames, dropped {}, blocked {} times, at most {} queued.'.format(
+            self.written, self.dropped, self.blocked, self.max_queued))
+        self.writer.release()
+
+    def close(self):
+        self.release()
+
+
 class LosslessPNG_Writer(object):
     """
     Writer for uncompressed PNGs
@@ -12,35 +12,119 @@ See COPYING and COPYING.LESSER for license details.
 import logging
 logger = logging.getLogger(__name__)
 import itertools
+from bisect import bisect_right
+
+
+class Interval_Set(object):
+    """Set of integer indices stored as sorted, disjoint and non-touching intervals.
+
+    Membership and next_missing are a binary search. add and discard search the same way
+    but may insert into or delete from the interval lists, which is O(number of intervals).
+    Cached frames are mostly visited in order, so the lists stay short in practice.
+    intervals() enumerates ranges as [first,last] (inclusive), the format used for the
+    cache bars and surface events.
+    """
+
+    def __init__(self, ranges=()):
+        # half open intervals [start,stop)
+        self._starts = []
+        self._stops = []
+        self._count = 0
+        for first, last in ranges:
+            self._starts.append(first)
+            self._stops.append(last + 1)
+            self._count += last + 1 - first
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, i):
+        k = bisect_right(self._starts, i) - 1
+        return k >= 0 and i < self._stops[k]
+
+    def add(self, i):
+        k = bisect_right(self._starts, i) - 1
+        if k >= 0 and i < self._stops[k]:
+            return
+        touches_left = k >= 0 and self._stops[k] == i
+        touches_right = k + 1 < len(self._starts) and self._starts[k + 1] == i + 1
+        if touches_left and touches_right:
+            self._stops[k] = self._stops[k + 1]
+            del self._starts[k + 1]
+            del self._stops[k + 1]
+        elif touches_left:
+            self._stops[k] = i + 1
+        elif touches_right:
+            self._starts[k + 1] = i
+        else:
+            self._starts.insert(k + 1, i)
+            self._stops.insert(k + 1, i + 1)
+        self._count += 1
+
+    def discard(self, i):
+        k = bisect_right(self._starts, i) - 1
+        if k < 0 or i >= self._stops[k]:
+            return
+        start, stop = self._starts[k], self._stops[k]
+        if start == i and stop == i + 1:
+            del self._starts[k]
+            del self._stops[k]
+        elif start == i:
+            self._starts[k] = i + 1
+        elif stop == i + 1:
+            self._stops[k] = i
+        else:
+            # split interval
+            self._stops[k] = i
+            self._starts.insert(k + 1, i + 1)
+            self._stops.insert(k + 1, stop)
+        self._count -= 1
+
+    def next_missing(self, i):
+        '''smallest index >= i that is not in the set'''
+        k = bisect_right(self._starts, i) - 1
+        if k >= 0 and i < self._stops[k]:
+            return self._stops[k]
+        return i
+
+    def intervals(self):
+        return [[start, stop - 1] for start, stop in zip(self._starts, self._stops)]
+
+    def __getstate__(self):
+        return self._starts, self._stops, self._count
+
+    def __setstate__(self, state):
+        self._starts, self._stops, self._count = state
+
 
 class Cache_List(list):
     """Cache list is a list of False
         [False,False,False]
         with update() 'False' can be overwritten with a result (anything not 'False')
-        self.visited_ranges show ranges where the cache contect is False
+        self.visited_ranges show ranges where the cache contect is not False
         self.positive_ranges show ranges where the cache does not evaluate as 'False' using eval_fn
         this allows to use ranges a a way of showing where no caching has happed (default) or whatever you do with eval_fn
         self.complete indicated that the cache list has no unknowns aka False
+        Both range types are kept in Interval_Sets and are updated incrementally.
     """
 
     def __init__(self, init_list,positive_eval_fn=None):
         super().__init__(init_list)
 
         self.visited_eval_fn = lambda x: x!=False
-        self._visited_ranges = init_ranges(l = self,eval_fn = self.visited_eval_fn )
-        self._togo = self.count(False)
+        self._visited = Interval_Set(init_ranges(l = self,eval_fn = self.visited_eval_fn ))
         self.length = len(self)
 
         if positive_eval_fn == None:
             self.positive_eval_fn = lambda x: False
-            self._positive_ranges = []
+            self._positive = Interval_Set()
         else:
             self.positive_eval_fn = positive_eval_fn
-            self._positive_ranges = init_ranges(l = self,eval_fn = self.positive_eval_fn )
+            self._positive = Interval_Set(init_ranges(l = self,eval_fn = self.positive_eval_fn ))
 
     @property
     def visited_ranges(self):
-        return self._visited_ranges
+        return self._visited.intervals()
 
     @visited_ranges.setter
     def visited_ranges(self, value):
@@ -48,41 +132,40 @@ class Cache_List(list):
 
     @property
     def positive_ranges(self):
-        return self._positive_ranges
+        return self._positive.intervals()
 
     @positive_ranges.setter
     def positive_ranges(self, value):
         raise Exception("Read only")
 
+    @property
+    def visited(self):
+        return self._visited
 
     @property
     def complete(self):
-        return self._togo == 0
+        return len(self._visited) == self.length
 
     @complete.setter
     def complete(self, value):
         raise Exception("Read only")
 
-
     def update(self,key,item):
         if self[key] != False:
             logger.warning("You are overwriting a precached result.")
-            self[key] = item
-            self._visited_ranges = init_ranges(l = self,eval_fn = self.visited_eval_fn )
-            self._positive_ranges = init_ranges(l = self,eval_fn = self.positive_eval_fn )
-
-        elif item != False:
-            #unvisited
-            self._togo -= 1
-            self[key] = item
-
-            update_ranges(self._visited_ranges,key)
-            if self.positive_eval_fn(item):
-                update_ranges(self._positive_ranges,key)
-        else:
+        elif item == False:
             #writing False to list entry already false, do nothing
-            pass
+            return
+        self[key] = item
 
+        if self.visited_eval_fn(item):
+            self._visited.add(key)
+        else:
+            self._visited.discard(key)
+        if self.positive_eval_fn(item):
+            self._positive.add(key)
+        else:
+            self._positive.discard(key)
 
     def to_list(self):
         return list(self)
@@ -99,31 +182,6 @@ def init_ranges(l,eval_fn):
             ranges.append([l,i])
     return ranges
 
-def update_ranges(l,i):
-    for _range in l:
-        #most common case: extend a range
-        if i == _range[0]-1:
-            _range[0] = i
-            merge_ranges(l)
-            return
-        elif i == _range[1]+1:
-            _range[1] = i
-            merge_ranges(l)
-            return
-    #somewhere outside of range proximity
-    l.append([i,i])
-    l.sort(key=lambda x: x[0])
-
-def merge_ranges(l):
-    for i in range(len(l)-1):
-        if l[i][1] == l[i+1][0]-1:
-            #merge touching fields
-            l[i] = ([l[i][0],l[i+1][1]])
-            #del second field
-            del l[i+1]
-            return
-    return
-
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -131,4 +189,4 @@ if __name__ == '__main__':
     cl.update(0,1)
     cl.update(4,1)
     print(cl.positive_ranges)
-    print(cl)
\ No newline at end of file
+    print(cl)
@@ -31,6 +31,17 @@ def _clamp_norm_point(pos):
     return min(100.,max(-100.,pos[0])),min(100.,max(-100.,pos[1]))
 
 
+# below this size looping over the data is faster than numpy's per call overhead
+vectorize_min_batch = 64
+
+
+def _map_norm_pos_batch(map_fn, pupil_list):
+    '''apply a monocular map function of calibrate.make_map_function to all norm_pos at once'''
+    norm_pos = np.array([p['norm_pos'] for p in pupil_list], dtype=np.float64)
+    x, y = map_fn((norm_pos[:, 0], norm_pos[:, 1]))
+    return list(zip(x.tolist(), y.tolist()))
+
+
 class Gaze_Mapping_Plugin(Plugin):
     '''base class for all gaze mapping routines'''
     uniqueness = 'by_base_class'
@@ -51,6 +62,17 @@ class Gaze_Mapping_Plugin(Plugin):
             results.extend(self.on_pupil_datum(p))
         return results
 
+    def on_pupil_batch(self, pupil_list):
+        '''map live pupil data received together.
+
+        Unlike map_batch this keeps the state of on_pupil_datum,
+        the result equals calling on_pupil_datum for each datum in order.
+        '''
+        results = []
+        for p in pupil_list:
+            results.extend(self.on_pupil_datum(p))
+        return results
+
     def add_menu(self):
         super().add_menu()
         self.menu_icon.order = 0.31
@@ -72,6 +94,12 @@ class Monocular_Gaze_Mapper_Base(Gaze_Mapping_Plugin):
         else:
             return []
 
+    def on_pupil_batch(self, pupil_list):
+        return self._map_monocular_batch([p for p in pupil_list if p['confidence'] >= self.min_pupil_confidence])
+
+    def _map_monocular_batch(self, pupil_list):
+        return [g for g in map(self._map_monocular, pupil_list) if g]
+
 
 class Binocular_Gaze_Mapper_Base(Gaze_Mapping_Plugin):
     """Base class to implement the map callback"""
@@ -155,6 +183,12 @@ class Monocular_Gaze_Mapper(Monocular_Gaze_Mapper_Base,Gaze_Mapping_Plugin):
         gaze_point = self.map_fn(p['norm_pos'])
         return {'topic':'gaze','norm_pos':gaze_point,'confidence':p['confidence'],'id':p['id'],'timestamp':p['timestamp'],'base_data':[p]}
 
+    def _map_monocular_batch(self, pupil_list):
+        if len(pupil_list) < vectorize_min_batch:
+            return super()._map_monocular_batch(pupil_list)
+        gaze_points = _map_norm_pos_batch(self.map_fn, pupil_list)
+        return [{'topic':'gaze','norm_pos':gaze_point,'confidence':p['confidence'],'id':p['id'],'timestamp':p['timestamp'],'base_data':[p]}
+                for p, gaze_point in zip(pupil_list, gaze_points)]
 
     def get_init_dict(self):
         return {'params':self.params}
@@ -172,6 +206,19 @@ class Dual_Monocular_Gaze_Mapper(Monocular_Gaze_Mapper_Base,Gaze_Mapping_Plugin)
         gaze_point = self.map_fns[p['id']](p['norm_pos'])
         return {'topic':'gaze','norm_pos':gaze_point,'confidence':p['confidence'],'id':p['id'],'timestamp':p['timestamp'],'base_data':[p]}
 
+    def _map_monocular_batch(self, pupil_list):
+        if len(pupil_list) < vectorize_min_batch:
+            return super()._map_monocular_batch(pupil_list)
+        gaze_points = [None] * len(pupil_list)
+        for eye_id, map_fn in enumerate(self.map_fns):
+            indices = [idx for idx, p in enumerate(pupil_list) if p['id'] == eye_id]
+            if indices:
+                mapped = _map_norm_pos_batch(map_fn, [pupil_list[idx] for idx in indices])
+                for idx, gaze_point in zip(indices, mapped):
+                    gaze_points[idx] = gaze_point
+        return [{'topic':'gaze','norm_pos':gaze_point,'confidence':p['confidence'],'id':p['id'],'timestamp':p['timestamp'],'base_data':[p]}
+                for p, gaze_point in zip(pupil_list, gaze_points)]
+
     def get_init_dict(self):
         return {'params0':self.params0,'params1':self.params1}
 
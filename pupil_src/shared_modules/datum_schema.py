@@ -0,0 +1,217 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Compact encoding of pupil, gaze and fixation datums.
+
+A datum that matches a known schema is encoded as a list [schema_id, value, ...]
+with the values in the order of the schema fields, instead of a map with
+repeated key names. Nested dicts with fixed keys (ellipse, circle_3d, ...) are
+flattened the same way, the 'base_data' of gaze and fixations are encoded recursively.
+Schema constants (topic, detection method) are not sent at all.
+Datums that do not match a schema exactly are left as dicts.
+
+Compact datums are always wrapped in a msgpack ext type (ext_code), so they
+can not be confused with other list payloads.
+On the IPC (Msg_Streamer(compact=True)) the ext type is the payload and its list may have
+one extra trailing element: the message sequence number. Msg_Receiver decodes compact
+payloads transparently, batched data are decoded when they are returned by recv().
+In files (file_methods.save_object(compact=True)) compact datums are stored the same way,
+file_methods.load_object decodes them to dicts.
+
+Schema ids are never reused. New or changed layouts get new ids.
+'''
+
+import msgpack
+from itertools import product
+
+schema_version = 1
+# msgpack ext type code of compact datums in files
+ext_code = 1
+
+_plain, _flat, _datums = range(3)
+
+
+class Datum_Schema(object):
+    """Field layout of one kind of datum.
+
+    fields: key names or (key, sub keys) for nested dicts with fixed keys.
+    datum_lists: keys of fields that hold lists of datums (base_data).
+    constants: key: value pairs all datums of this kind share.
+    """
+
+    def __init__(self, schema_id, constants, fields, datum_lists=()):
+        self.schema_id = schema_id
+        self.constants = constants
+        self.fields = []
+        for field in fields:
+            if isinstance(field, tuple):
+                self.fields.append((field[0], _flat, field[1]))
+            elif field in datum_lists:
+                self.fields.append((field, _datums, None))
+            else:
+                self.fields.append((field, _plain, None))
+        self.keys = frozenset(constants) | frozenset(f[0] for f in self.fields)
+        # number of list elements of an encoded datum
+        self.size = len(self.fields) + 1
+
+    def encode(self, datum):
+        '''compact list of datum or None if it does not match'''
+        for key, value in self.constants.items():
+            if datum[key] != value:
+                return None
+        values = [self.schema_id]
+        try:
+            for key, kind, sub_keys in self.fields:
+                value = datum[key]
+                if kind is _flat:
+                    if len(value) != len(sub_keys):
+                        return None
+                    values.append([value[k] for k in sub_keys])
+                elif kind is _datums:
+                    values.append([encode(d) for d in value])
+                else:
+                    values.append(value)
+        except (KeyError, TypeError, IndexError):
+            return None
+        return values
+
+    def decode(self, values):
+        '''datum dict of a compact list, trailing extra elements are ignored'''
+        datum = dict(self.constants)
+        for (key, kind, sub_keys), value in zip(self.fields, values[1:]):
+            if kind is _flat:
+                datum[key] = dict(zip(sub_keys, value))
+            elif kind is _datums:
+                datum[key] = [decode(d) if isinstance(d, list) else d for d in value]
+            else:
+                datum[key] = value
+        return datum
+
+
+schemas = {}
+_schemas_by_keys = {}
+
+
+def register(schema):
+    assert schema.schema_id not in schemas, 'schema ids are never reused'
+    schemas[schema.schema_id] = schema
+    _schemas_by_keys.setdefault(schema.keys, []).append(schema)
+
+
+ellipse = ('ellipse', ('center', 'axes', 'angle'))
+pupil_2d_fields = ('id', 'timestamp', 'confidence', 'norm_pos', 'diameter', ellipse)
+register(Datum_Schema(1, {'topic': 'pupil', 'method': '2d c++'}, pupil_2d_fields))
+register(Datum_Schema(2, {'topic': 'pupil', 'method': '3d c++'}, pupil_2d_fields + (
+    'diameter_3d', ('circle_3d', ('center', 'normal', 'radius')), ('sphere', ('center', 'radius')),
+    ('projected_sphere', ('center', 'axes', 'angle')), 'model_confidence', 'model_id',
+    'model_birth_timestamp', 'theta', 'phi')))
+
+gaze_fields = ('timestamp', 'confidence', 'norm_pos', 'base_data')
+# 2d mappers
+register(Datum_Schema(3, {'topic': 'gaze'}, gaze_fields, ('base_data',)))
+register(Datum_Schema(4, {'topic': 'gaze'}, gaze_fields + ('id',), ('base_data',)))
+# 3d mappers, monocular and binocular
+register(Datum_Schema(5, {'topic': 'gaze'}, gaze_fields + ('eye_center_3d', 'gaze_normal_3d', 'gaze_point_3d'), ('base_data',)))
+register(Datum_Schema(6, {'topic': 'gaze'}, gaze_fields + ('eye_centers_3d', 'gaze_normals_3d', 'gaze_point_3d'), ('base_data',)))
+
+# fixations, with optional 3d gaze point, frame indices (offline) and id
+fixation_fields = ('timestamp', 'confidence', 'norm_pos', 'base_data', 'dispersion', 'method', 'duration')
+for schema_id, (point_3d, frame_indices, fixation_id) in enumerate(product((False, True), repeat=3), start=7):
+    fields = fixation_fields
+    fields += ('gaze_point_3d',) if point_3d else ()
+    fields += ('start_frame_index', 'end_frame_index', 'mid_frame_index') if frame_indices else ()
+    fields += ('id',) if fixation_id else ()
+    register(Datum_Schema(schema_id, {'topic': 'fixation'}, fields, ('base_data',)))
+
+
+def encode(datum):
+    '''compact list of datum or datum itself if no schema matches'''
+    for schema in _schemas_by_keys.get(frozenset(datum), ()):
+        values = schema.encode(datum)
+        if values is not None:
+            return values
+    return datum
+
+
+def decode(values):
+    '''datum dict of a compact list'''
+    return schemas[values[0]].decode(values)
+
+
+def to_ext(datum):
+    '''msgpack ext type of datum, or datum itself if no schema matches'''
+    values = encode(datum)
+    if values is datum:
+        return datum
+    return pack(values)
+
+
+def pack(values):
+    '''msgpack ext type of a compact list'''
+    return msgpack.ExtType(ext_code, msgpack.packb(values, use_bin_type=True))
+
+
+def unpack(ext):
+    '''compact list of a msgpack ext type or None if it is not a known compact datum'''
+    if not isinstance(ext, msgpack.ExtType) or ext.code != ext_code:
+        return None
+    values = msgpack.unpackb(ext.data, encoding='utf-8')
+    if not values or values[0] not in schemas:
+        return None
+    return values
+
+
+def ext_hook(code, data):
+    if code == ext_code:
+        return decode(msgpack.unpackb(data, encoding='utf-8'))
+    return msgpack.ExtType(code, data)
+
+
+def compact_lists(object_):
+    '''copy of a datum list or a dict of datum lists (like pupil_data) with compact ext type datums'''
+    if isinstance(object_, dict):
+        return {key: compact_lists(value) if isinstance(value, list) else value for key, value in object_.items()}
+    return [to_ext(datum) if isinstance(datum, dict) else datum for datum in object_]
+
+
+def bench(count=20000):
+    '''bytes per datum and msgpack encode/decode time of map and compact encoding'''
+    from time import perf_counter
+    pupil_2d = {'topic': 'pupil', 'confidence': .93, 'ellipse': {'center': (96.51, 48.12), 'axes': (30.22, 35.81), 'angle': 89.3},
+                'diameter': 35.81, 'norm_pos': (.503, .749), 'timestamp': 5123.45678, 'method': '2d c++', 'id': 0}
+    pupil_3d = dict(pupil_2d, method='3d c++', diameter_3d=3.8,
+                    circle_3d={'center': (1.2, -0.3, 40.1), 'normal': (-.1, .2, -.97), 'radius': 1.9},
+                    sphere={'center': (2.4, -2.3, 52.1), 'radius': 12.}, model_confidence=.8, model_id=3,
+                    projected_sphere={'center': (101.2, 52.3), 'axes': (120.3, 120.3), 'angle': 90.},
+                    model_birth_timestamp=5100.123, theta=1.71, phi=-1.67)
+    gaze_3d = {'topic': 'gaze', 'norm_pos': (.45, .52), 'eye_centers_3d': {0: [20., 15., -20.], 1: [-40., 15., -20.]},
+               'gaze_normals_3d': {0: [-.1, .1, .98], 1: [.1, .1, .98]}, 'gaze_point_3d': [-10., 40., 500.],
+               'confidence': .9, 'timestamp': 5123.4567, 'base_data': [pupil_3d, dict(pupil_3d, id=1)]}
+    for name, datum in (('pupil 2d', pupil_2d), ('pupil 3d', pupil_3d), ('gaze 3d binocular', gaze_3d)):
+        assert decode(msgpack.unpackb(msgpack.packb(encode(datum), use_bin_type=True), encoding='utf-8')) == \
+            msgpack.unpackb(msgpack.packb(datum, use_bin_type=True), encoding='utf-8')
+        print(name)
+        for encoding, enc, dec in (('map', lambda d: d, lambda v: v), ('compact', encode, decode)):
+            packed = msgpack.packb(enc(datum), use_bin_type=True)
+            start = perf_counter()
+            for i in range(count):
+                msgpack.packb(enc(datum), use_bin_type=True)
+            encoded = perf_counter()
+            for i in range(count):
+                dec(msgpack.unpackb(packed, encoding='utf-8'))
+            decoded = perf_counter()
+            print('  {:>8}: {:5d} bytes, encode {:.2f} us, decode {:.2f} us'.format(
+                  encoding, len(packed), 1e6 * (encoded - start) / count, 1e6 * (decoded - encoded) / count))
+
+
+if __name__ == '__main__':
+    bench()
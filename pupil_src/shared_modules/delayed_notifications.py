@@ -0,0 +1,136 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+import heapq
+from math import ceil
+from itertools import count
+from time import monotonic
+import zmq
+import zmq_tools
+
+
+class Delayed_Notifications(object):
+    """Pending delayed notifications ordered by deadline in a heap.
+
+    A notification replaces the pending notification with the same subject,
+    unless it sets 'allow_duplicates': True. Replaced entries stay in the heap
+    and are skipped when they come up, so add() and pop_due() cost O(log n).
+    """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self._heap = []
+        # subject: counter of the entry that is currently pending for this subject
+        self._pending_subjects = {}
+        self._counter = count()
+
+    def add(self, notification):
+        deadline = self.clock() + notification.pop('delay')
+        entry_id = next(self._counter)
+        if notification.pop('allow_duplicates', False):
+            subject = None
+        else:
+            subject = notification['subject']
+            self._pending_subjects[subject] = entry_id
+        heapq.heappush(self._heap, (deadline, entry_id, subject, notification))
+
+    def _drop_replaced(self):
+        while self._heap:
+            deadline, entry_id, subject, n = self._heap[0]
+            if subject is None or self._pending_subjects.get(subject) == entry_id:
+                return
+            heapq.heappop(self._heap)
+
+    @property
+    def next_deadline(self):
+        self._drop_replaced()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        '''notifications whose deadline has passed, in deadline order'''
+        if now is None:
+            now = self.clock()
+        due = []
+        self._drop_replaced()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, entry_id, subject, n = heapq.heappop(self._heap)
+            if subject is not None:
+                del self._pending_subjects[subject]
+            due.append(n)
+            self._drop_replaced()
+        return due
+
+
+def delay_proxy(ipc_pub_url, ipc_sub_url):
+    '''
+    forward `delayed_notify.<subject>` messages as notifications after their `delay` (in seconds).
+    Sleeps until the next deadline or the next delayed notification.
+    '''
+    ctx = zmq.Context.instance()
+    sub = zmq_tools.Msg_Receiver(ctx, ipc_sub_url, ('delayed_notify',))
+    pub = zmq_tools.Msg_Dispatcher(ctx, ipc_pub_url)
+    poller = zmq.Poller()
+    poller.register(sub.socket, zmq.POLLIN)
+    pending = Delayed_Notifications()
+
+    while True:
+        deadline = pending.next_deadline
+        if deadline is None:
+            timeout = None
+        else:
+            # poll timeouts are whole ms, round up instead of spinning through the last fraction
+            timeout = max(0, ceil((deadline - pending.clock()) * 1e3))
+        poller.poll(timeout)
+        while sub.new_data:
+            topic, n = sub.recv()
+            pending.add(n)
+        for n in pending.pop_due():
+            pub.notify(n)
+
+
+def bench(count=2000, max_delay=2., rate=1000.):
+    '''
+    lateness of delayed notifications sent through delay_proxy over tcp loopback,
+    `count` notifications sent at `rate` Hz with random delays of up to `max_delay` seconds.
+    '''
+    import threading
+    import random
+    from time import sleep
+    import numpy as np
+    ctx = zmq.Context.instance()
+    ipc_sub = ctx.socket(zmq.PUB)
+    sub_port = ipc_sub.bind_to_random_port('tcp://127.0.0.1')
+    ipc_push = ctx.socket(zmq.PULL)
+    push_port = ipc_push.bind_to_random_port('tcp://127.0.0.1')
+    threading.Thread(target=delay_proxy, args=('tcp://127.0.0.1:{}'.format(push_port),
+                                               'tcp://127.0.0.1:{}'.format(sub_port)), daemon=True).start()
+    # wait for the subscription
+    sleep(1.)
+
+    def send():
+        for i in range(count):
+            n = {'subject': 'bench.{}'.format(i), 'delay': random.uniform(0, max_delay)}
+            n['due'] = monotonic() + n['delay']
+            ipc_sub.send_multipart((('delayed_notify.' + n['subject']).encode(), zmq_tools.serializer.dumps(n, use_bin_type=True)))
+            sleep(1. / rate)
+    threading.Thread(target=send, daemon=True).start()
+
+    received = []
+    for i in range(count):
+        received.append((ipc_push.recv_multipart()[1], monotonic()))
+    lateness = [t - zmq_tools.serializer.loads(payload, encoding='utf-8')['due'] for payload, t in received]
+    lateness = np.array(lateness) * 1e3
+    print('{} notifications, lateness ms: mean {:.2f}, median {:.2f}, 99% {:.2f}, max {:.2f}'.format(
+          count, lateness.mean(), np.median(lateness), np.percentile(lateness, 99), lateness.max()))
+
+
+if __name__ == '__main__':
+    bench()
@@ -15,6 +15,7 @@ import msgpack
 import os
 import numpy as np
 import traceback as tb
+import datum_schema
 import logging
 logger = logging.getLogger(__name__)
 UnpicklingError = pickle.UnpicklingError
@@ -55,7 +56,7 @@ def load_object(file_path,allow_legacy=True):
     with open(file_path, 'rb') as fh:
         try:
             gc.disable()  # speeds deserialization up.
-            data = msgpack.unpack(fh, encoding='utf-8')
+            data = msgpack.unpack(fh, encoding='utf-8', ext_hook=datum_schema.ext_hook)
         except Exception as e:
             if not allow_legacy:
                 raise e
@@ -67,7 +68,13 @@ def load_object(file_path,allow_legacy=True):
     return data
 
 
-def save_object(object_, file_path):
+def save_object(object_, file_path, compact=False):
+    '''
+    serialize object_ with msgpack.
+    compact=True stores the pupil, gaze and fixation datums of a datum list or of
+    a dict of datum lists (like pupil_data) in the encoding of datum_schema.py.
+    load_object() returns them as dicts.
+    '''
 
     def ndarrray_to_list(o, _warned=[False]): # Use a mutlable default arg to hold a fn interal temp var.
         if isinstance(o, np.ndarray):
@@ -77,6 +84,8 @@ def save_object(object_, file_path):
             return o.tolist()
         return o
 
+    if compact:
+        object_ = datum_schema.compact_lists(object_)
     file_path = os.path.expanduser(file_path)
     with open(file_path, 'wb') as fh:
         msgpack.pack(object_, fh, use_bin_type=True,default=ndarrray_to_list)
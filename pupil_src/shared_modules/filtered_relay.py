@@ -0,0 +1,180 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Server side filtering for remote subscribers.
+
+A client registers a subscription spec through Pupil Remote:
+    requester.send_string('FILTER', flags=zmq.SNDMORE)
+    requester.send(msgpack.dumps({'topic': 'gaze', 'min_confidence': .8, 'max_rate': 30,
+                                  'fields': ['norm_pos', 'timestamp']}))
+    reply = msgpack.loads(requester.recv(), encoding='utf-8')
+    # {'port': relay port, 'topic': 'filtered.<id>.'}
+and subscribes to reply['topic'] on reply['port']. Messages arrive
+on 'filtered.<id>.<original topic>' with the usual msgpack payload.
+
+Spec keys:
+    topic: topic prefix (required)
+    min_confidence: drop data with lower 'confidence'
+    max_rate: at most this many data per second and topic (by datum timestamp)
+    decimation: only every nth datum per topic
+    fields: only send these keys of each datum. Frames keep their
+            raw data if '__raw_data__' is a field or no fields are given.
+
+A spec is removed when its subscriber unsubscribes or disconnects,
+or if nobody subscribed to it within `subscribe_timeout` seconds.
+'''
+
+from time import monotonic
+from itertools import count
+import zmq
+import zmq_tools
+import logging
+logger = logging.getLogger(__name__)
+
+filtered_prefix = 'filtered.'
+subscribe_timeout = 30.
+
+
+class Subscription_Spec(object):
+    """Filter, rate limit and projection of one remote subscription"""
+
+    keys = ('topic', 'min_confidence', 'max_rate', 'decimation', 'fields')
+
+    def __init__(self, spec_id, spec):
+        unknown = set(spec) - set(self.keys)
+        if unknown:
+            raise ValueError('Unknown spec keys: {}'.format(', '.join(sorted(unknown))))
+        self.topic = str(spec['topic'])
+        self.min_confidence = float(spec.get('min_confidence', 0.))
+        max_rate = spec.get('max_rate')
+        self.min_interval = 1. / float(max_rate) if max_rate else 0.
+        self.decimation = int(spec.get('decimation', 1))
+        if self.decimation < 1:
+            raise ValueError('decimation must be at least 1')
+        fields = spec.get('fields')
+        self.fields = None if fields is None else [str(f) for f in fields]
+        self.out_prefix = '{}{}.'.format(filtered_prefix, spec_id)
+        self.registered = monotonic()
+        self.subscribed = False
+        # per original topic: number of matching data, timestamp the next datum is due
+        self._matched = {}
+        self._next_due = {}
+
+    def filter(self, topic, datum):
+        '''datum to send or None'''
+        if self.min_confidence and datum.get('confidence', 1.) < self.min_confidence:
+            return None
+        if self.decimation > 1:
+            matched = self._matched.get(topic, 0)
+            self._matched[topic] = matched + 1
+            if matched % self.decimation:
+                return None
+        if self.min_interval:
+            ts = datum.get('timestamp')
+            if ts is None:
+                ts = monotonic()
+            due = self._next_due.get(topic)
+            if due is not None and due - self.min_interval <= ts < due:
+                return None
+            if due is not None and due - self.min_interval <= ts < due + self.min_interval:
+                # keep the rate when data arrive at a multiple of it
+                self._next_due[topic] = due + self.min_interval
+            else:
+                # first datum or timestamps jumped forward or backward
+                self._next_due[topic] = ts + self.min_interval
+        if self.fields is None:
+            return datum
+        return {key: datum[key] for key in self.fields if key in datum}
+
+
+def relay_loop(ctx, pipe, ipc_sub_url, bind_url):
+    '''
+    thread loop of the relay, see zhelper.zthread_fork.
+    Pipe commands: 'Add' + msgpack spec -> 'OK' + msgpack {'port','topic'} or 'Error' + reason, 'Exit'.
+    '''
+    sub = zmq_tools.Msg_Receiver(ctx, ipc_sub_url, block_until_connected=False)
+    xpub = ctx.socket(zmq.XPUB)
+    xpub.bind(bind_url)
+    port = int(xpub.last_endpoint.decode('utf8').split(':')[-1])
+    poller = zmq.Poller()
+    poller.register(pipe, zmq.POLLIN)
+    poller.register(sub.socket, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+
+    specs = {}  # out prefix: spec
+    topic_refs = {}  # upstream topic: number of specs using it
+    spec_ids = count()
+
+    def remove(spec):
+        del specs[spec.out_prefix]
+        topic_refs[spec.topic] -= 1
+        if not topic_refs[spec.topic]:
+            del topic_refs[spec.topic]
+            sub.unsubscribe(spec.topic)
+        logger.debug('Removed filtered subscription {}'.format(spec.out_prefix))
+
+    while True:
+        items = dict(poller.poll(1000))
+        if pipe in items:
+            cmd = pipe.recv_string()
+            if cmd == 'Exit':
+                break
+            elif cmd == 'Add':
+                try:
+                    spec = Subscription_Spec(next(spec_ids), zmq_tools.serializer.loads(pipe.recv(), encoding='utf-8'))
+                except Exception as e:
+                    pipe.send_string('Error', flags=zmq.SNDMORE)
+                    pipe.send_string('Filter spec mal-formatted: {}'.format(e))
+                else:
+                    specs[spec.out_prefix] = spec
+                    if spec.topic not in topic_refs:
+                        topic_refs[spec.topic] = 0
+                        sub.subscribe(spec.topic)
+                    topic_refs[spec.topic] += 1
+                    pipe.send_string('OK', flags=zmq.SNDMORE)
+                    pipe.send(zmq_tools.serializer.dumps({'port': port, 'topic': spec.out_prefix}, use_bin_type=True))
+
+        # subscription changes of remote clients
+        while xpub.get(zmq.EVENTS) & zmq.POLLIN:
+            msg = xpub.recv()
+            subscribed, prefix = msg[0] == 1, msg[1:].decode('utf-8', 'replace')
+            spec = specs.get(prefix)
+            if spec:
+                if subscribed:
+                    spec.subscribed = True
+                else:
+                    remove(spec)
+
+        while sub.new_data:
+            topic, datum = sub.recv()
+            for spec in list(specs.values()):
+                if not spec.subscribed or not topic.startswith(spec.topic):
+                    continue
+                out = spec.filter(topic, datum)
+                if out is None:
+                    continue
+                raw_data = out.get('__raw_data__')
+                if raw_data is None:
+                    frames = [(spec.out_prefix + topic).encode('utf-8'), zmq_tools.serializer.dumps(out, use_bin_type=True)]
+                else:
+                    payload = {key: value for key, value in out.items() if key != '__raw_data__'}
+                    frames = [(spec.out_prefix + topic).encode('utf-8'), zmq_tools.serializer.dumps(payload, use_bin_type=True)]
+                    frames.extend(raw_data)
+                xpub.send_multipart(frames, copy=False)
+
+        now = monotonic()
+        for spec in list(specs.values()):
+            if not spec.subscribed and now - spec.registered > subscribe_timeout:
+                remove(spec)
+
+    xpub.close(linger=0)
+    del sub
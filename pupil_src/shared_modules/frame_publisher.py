@@ -11,18 +11,30 @@ See COPYING and COPYING.LESSER for license details.
 from plugin import Plugin
 from pyglui import ui
 import numpy as np
+from shared_frames import Frame_Ring_Writer
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 class Frame_Publisher(Plugin):
+    """Publishes world frames under the topic "frame.world".
+
+    With shared_memory the frames are written to a ring in shared memory
+    and the messages only carry a reference (see shared_frames.py).
+    Only subscribers on this computer can read them. Remote subscribers are detected
+    only when they ask Pupil Remote for the SUB port from another host. Clients that
+    connect to the SUB port directly or through a tunnel are not detected. They receive
+    '__frame_unavailable__' messages without '__raw_data__'. Turn shared memory off for them.
+    """
     icon_chr = chr(0xec17)
     icon_font = 'pupil_icons'
 
-    def __init__(self,g_pool,format='jpeg'):
+    def __init__(self,g_pool,format='jpeg',shared_memory=False):
         super().__init__(g_pool)
         self._format = format
+        self._shared_memory = shared_memory
+        self.ring_writer = Frame_Ring_Writer('world')
 
     def init_ui(self):
         self.add_menu()
@@ -30,6 +42,8 @@ class Frame_Publisher(Plugin):
         self.menu.label = 'Frame Publisher'
         self.menu.append(ui.Info_Text(help_str))
         self.menu.append(ui.Selector('format',self,selection=["jpeg","yuv","bgr","gray"], labels=["JPEG", "YUV", "BGR", "Gray Image"],label='Format'))
+        self.menu.append(ui.Info_Text("Shared memory is faster but only works for subscribers on this computer. It is turned off when a remote client asks Pupil Remote for the SUB port. Turn it off yourself for clients that connect to the SUB port directly or through a tunnel, they do not receive frame data otherwise."))
+        self.menu.append(ui.Switch('shared_memory',self,label='Use shared memory'))
 
     def deinit_ui(self):
         self.remove_menu()
@@ -57,15 +71,22 @@ class Frame_Publisher(Plugin):
             # blob = memoryview(np.asarray(data).data)
             blob = data
 
-            events['frame.world'] = [{
+            datum = {
                 'topic': 'frame',
                 'width': frame.width,
                 'height': frame.height,
                 'index': frame.index,
                 'timestamp': frame.timestamp,
-                'format': self.format,
-                '__raw_data__': [blob]
-            }]
+                'format': self.format
+            }
+            if self.shared_memory:
+                datum['__shm__'] = self.ring_writer.write(blob)
+            else:
+                if self.format in ('bgr', 'gray'):
+                    # zmq sends zero-copy buffers later, visualization plugins draw into these images
+                    blob = blob.copy()
+                datum['__raw_data__'] = [blob]
+            events['frame.world'] = [datum]
 
     def on_notify(self,notification):
         """Publishes frame data in several formats
@@ -73,6 +94,7 @@ class Frame_Publisher(Plugin):
         Reacts to notifications:
             ``eye_process.started``: Re-emits ``frame_publishing.started``
             ``frame_publishing.set_format``: Sets image format specified in ``format`` field
+            ``frame_publishing.remote_subscriber``: Falls back to sending frames through the IPC
 
         Emits notifications:
            ``frame_publishing.started``: Frame publishing started
@@ -84,12 +106,16 @@ class Frame_Publisher(Plugin):
         elif notification['subject'] == 'frame_publishing.set_format':
             # update format and trigger notification
             self.format = notification['format']
+        elif notification['subject'] == 'frame_publishing.remote_subscriber' and self.shared_memory:
+            logger.warning('Remote subscriber detected. Frames are not published through shared memory anymore.')
+            self.shared_memory = False
 
     def get_init_dict(self):
-        return {'format':self.format}
+        return {'format':self.format,'shared_memory':self.shared_memory}
 
     def cleanup(self):
         self.notify_all({'subject':'frame_publishing.stopped'})
+        self.ring_writer.close()
 
     @property
     def format(self):
@@ -98,4 +124,13 @@ class Frame_Publisher(Plugin):
     @format.setter
     def format(self,value):
         self._format = value
-        self.notify_all({'subject':'frame_publishing.started','format':value})
+        self.notify_all({'subject':'frame_publishing.started','format':value,'shared_memory':self.shared_memory})
+
+    @property
+    def shared_memory(self):
+        return self._shared_memory
+
+    @shared_memory.setter
+    def shared_memory(self,value):
+        self._shared_memory = value
+        self.notify_all({'subject':'frame_publishing.started','format':self.format,'shared_memory':value})
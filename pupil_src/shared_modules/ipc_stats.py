@@ -0,0 +1,184 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Instrumented replacement for zmq.proxy(xsub, xpub) on the IPC backbone.
+
+Counts messages and bytes per topic prefix and samples the latency between
+datum timestamps and proxy time. The stats are published on the backbone as
+`stats.ipc` every `interval` seconds:
+    {'topic': 'stats.ipc', 'timestamp': proxy time, 'interval': seconds,
+     'topics': {prefix: {'messages', 'bytes', 'msg_rate', 'byte_rate', 'max_size',
+                         'latency_mean', 'latency_max', 'latency_samples'}}}
+
+Run this file to print the busiest topics of a running Pupil Capture/Service:
+    python ipc_stats.py [--host 127.0.0.1] [--port 50020] [--top 10]
+'''
+
+import logging
+from time import monotonic
+import zmq
+from zmq_tools import serializer, unpack_datums
+
+logger = logging.getLogger(__name__)
+
+stats_topic = 'stats.ipc'
+
+
+def topic_prefix(topic, depth):
+    '''first `depth` dot separated parts of a topic'''
+    return b'.'.join(topic.split(b'.', depth)[:depth])
+
+
+class Topic_Stats(object):
+    """Message counters and latency samples of one topic prefix"""
+
+    __slots__ = ('messages', 'bytes', 'max_size', 'latency_sum', 'latency_max', 'latency_samples', 'next_sample')
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.max_size = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        self.latency_samples = 0
+        self.next_sample = 0.
+
+    def add_latency(self, latency):
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_samples += 1
+
+    def to_dict(self, interval):
+        return {'messages': self.messages,
+                'bytes': self.bytes,
+                'msg_rate': self.messages / interval,
+                'byte_rate': self.bytes / interval,
+                'max_size': self.max_size,
+                'latency_mean': self.latency_sum / self.latency_samples if self.latency_samples else None,
+                'latency_max': self.latency_max if self.latency_samples else None,
+                'latency_samples': self.latency_samples}
+
+
+class IPC_Stats(object):
+    """Per topic prefix statistics of the messages passing the proxy.
+
+    Latency is sampled at most once per `sample_interval` per prefix because it
+    needs the payload to be deserialized. Batches and compact datums are unpacked
+    like zmq_tools.Msg_Receiver does, every datum of a sampled batch is sampled.
+    Datums without a numeric 'timestamp' are not sampled.
+    """
+
+    def __init__(self, get_timestamp, prefix_depth=2, sample_interval=.1):
+        self.get_timestamp = get_timestamp
+        self.prefix_depth = prefix_depth
+        self.sample_interval = sample_interval
+        self.topics = {}
+
+    def add(self, msg):
+        '''account for a multipart message (list of zmq.Frame or bytes)'''
+        topic = msg[0].bytes if isinstance(msg[0], zmq.Frame) else msg[0]
+        prefix = topic_prefix(topic, self.prefix_depth)
+        try:
+            stats = self.topics[prefix]
+        except KeyError:
+            stats = self.topics[prefix] = Topic_Stats()
+        size = sum(len(part) for part in msg)
+        stats.messages += 1
+        stats.bytes += size
+        stats.max_size = max(stats.max_size, size)
+
+        now = monotonic()
+        if len(msg) > 1 and now >= stats.next_sample:
+            stats.next_sample = now + self.sample_interval
+            try:
+                payload = serializer.loads(msg[1].bytes if isinstance(msg[1], zmq.Frame) else msg[1], encoding='utf-8')
+                _, datums = unpack_datums(topic.decode('utf-8'), payload)
+            except Exception:
+                # not every message is msgpack serialized
+                return
+            now = self.get_timestamp()
+            for datum in datums:
+                timestamp = datum.get('timestamp') if isinstance(datum, dict) else None
+                if isinstance(timestamp, (int, float)):
+                    stats.add_latency(now - timestamp)
+
+    def collect(self, interval):
+        '''stats of all prefixes since the last call'''
+        report = {prefix.decode('utf-8', 'replace'): stats.to_dict(interval) for prefix, stats in self.topics.items()}
+        self.topics = {}
+        return report
+
+
+def instrumented_proxy(xsub, xpub, get_timestamp, interval=1., prefix_depth=2):
+    '''
+    zmq.proxy(xsub, xpub) that counts the traffic and publishes `stats.ipc` on xpub.
+    Never returns, run it in a thread.
+    '''
+    stats = IPC_Stats(get_timestamp, prefix_depth)
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    last_report = monotonic()
+
+    while True:
+        timeout = max(0, last_report + interval - monotonic())
+        for socket, _ in poller.poll(timeout * 1000):
+            if socket is xsub:
+                msg = xsub.recv_multipart(copy=False)
+                stats.add(msg)
+                xpub.send_multipart(msg, copy=False)
+            else:
+                # (un)subscriptions travel upstream
+                xsub.send_multipart(xpub.recv_multipart())
+
+        now = monotonic()
+        if now - last_report >= interval:
+            report = {'topic': stats_topic, 'timestamp': get_timestamp(),
+                      'interval': now - last_report, 'topics': stats.collect(now - last_report)}
+            last_report = now
+            xpub.send_string(stats_topic, flags=zmq.SNDMORE)
+            xpub.send(serializer.dumps(report, use_bin_type=True))
+
+
+def print_top_topics(report, top=10):
+    topics = sorted(report['topics'].items(), key=lambda item: item[1]['byte_rate'], reverse=True)
+    print('{:<32} {:>10} {:>12} {:>10} {:>12} {:>12}'.format('topic', 'msg/s', 'KB/s', 'max KB', 'latency ms', 'max lat ms'))
+    for prefix, s in topics[:top]:
+        latency = '{:.2f}'.format(1e3 * s['latency_mean']) if s['latency_mean'] is not None else '-'
+        latency_max = '{:.2f}'.format(1e3 * s['latency_max']) if s['latency_max'] is not None else '-'
+        print('{:<32} {:>10.1f} {:>12.1f} {:>10.1f} {:>12} {:>12}'.format(
+              prefix, s['msg_rate'], s['byte_rate'] / 1e3, s['max_size'] / 1e3, latency, latency_max))
+    print()
+
+
+if __name__ == '__main__':
+    import argparse
+    from zmq_tools import Msg_Receiver
+    parser = argparse.ArgumentParser(description='Print the busiest topics on the Pupil IPC backbone.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50020, help='Pupil Remote port')
+    parser.add_argument('--top', type=int, default=10, help='number of topics to show')
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    requester = ctx.socket(zmq.REQ)
+    requester.connect('tcp://{}:{}'.format(args.host, args.port))
+    requester.send_string('SUB_PORT')
+    sub_port = requester.recv_string()
+    monitor = Msg_Receiver(ctx, 'tcp://{}:{}'.format(args.host, sub_port), topics=(stats_topic,))
+    print('Waiting for {} (start Pupil with the "ipc_stats" argument)'.format(stats_topic))
+    try:
+        while True:
+            topic, report = monitor.recv()
+            print_top_topics(report, args.top)
+    except KeyboardInterrupt:
+        pass
@@ -153,14 +153,10 @@ class Marker_Auto_Trim_Marks(Plugin):
                 in_id = self.in_marker_id
                 out_id = self.out_marker_id
                 logger.debug("Looking for trim mark markers: {},{}".format(in_id, out_id))
-                in_out_signal = [0]*len(marker_tracker_plugin.cache)
-                for idx,frame in enumerate(marker_tracker_plugin.cache):
-                    # marker = {'id':msg,'verts':r,'verts_norm':r_norm,'centroid':centroid,"frames_since_true_detection":0}
-                    for marker in frame:
-                        if marker['id'] == in_id:
-                            in_out_signal[idx] +=1
-                        if marker['id'] == out_id:
-                            in_out_signal[idx] -=1
+                in_out_signal = np.zeros(len(marker_tracker_plugin.cache))
+                frame_indices,marker_ids = marker_tracker_plugin.cache.marker_ids()
+                np.add.at(in_out_signal,frame_indices[marker_ids == in_id],1)
+                np.add.at(in_out_signal,frame_indices[marker_ids == out_id],-1)
 
                 # make a smooth signal
                 in_out_smooth = np.convolve(in_out_signal,[2./30]*30,mode='same') #mean filter with sum 2 and len 60,
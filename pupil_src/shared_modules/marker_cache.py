@@ -0,0 +1,218 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+import os
+import numpy as np
+from cache_list import Interval_Set
+import logging
+logger = logging.getLogger(__name__)
+
+# one record per detected marker. verts are kept in the (4,1,2) layout used by the detector.
+marker_dtype = np.dtype([('frame', '<i4'),
+                         ('id', '<i4'),
+                         ('id_confidence', '<f4'),
+                         ('verts', '<f4', (4, 1, 2))])
+
+
+class Marker_Cache(object):
+    """Frame indexed square marker cache backed by flat arrays.
+
+    Marker records (frame index, marker id, id confidence, verts) are appended
+    to `<base_path>.records` in the order they are reported. A per frame offset
+    table (`<base_path>.offsets.npy`) holds the first record and the record
+    count of each frame, -1 marks frames that have not been searched yet.
+
+    Records are memory mapped, marker dicts are only created when a frame is requested:
+        cache[idx] -> False (not searched yet) or a list of marker dicts
+        cache.update(idx, markers)
+
+    Records added by update() are kept in memory until tail_size of them have
+    been collected, then the records file is mapped again.
+
+    With read_only=True the files are never written. This is used to read
+    the cache from background processes after the owner has called save().
+    """
+
+    tail_size = 4096
+
+    def __init__(self, base_path, frame_count, read_only=False):
+        self.base_path = base_path
+        self.read_only = read_only
+        self.records_path = base_path + '.records'
+        self.offsets_path = base_path + '.offsets.npy'
+        self.length = frame_count
+
+        self._offsets = None
+        try:
+            offsets = np.load(self.offsets_path)
+            record_count = os.path.getsize(self.records_path) // marker_dtype.itemsize
+        except (IOError, ValueError):
+            pass
+        else:
+            if offsets.shape == (frame_count, 2) and np.all(offsets[:, 0] + offsets[:, 1] <= record_count):
+                self._offsets = offsets
+            else:
+                logger.debug('Marker cache does not match the recording. Rebuilding marker cache.')
+
+        if self._offsets is None:
+            self.clear()
+        else:
+            self._record_count = record_count
+            self._records_file = None if read_only else open(self.records_path, 'ab')
+            self._map_records()
+            self._visited = Interval_Set(bool_ranges(self._offsets[:, 0] >= 0))
+
+    def _map_records(self):
+        if self._records_file:
+            self._records_file.flush()
+        if self._record_count:
+            self._records = np.memmap(self.records_path, dtype=marker_dtype, mode='r', shape=(self._record_count,))
+        else:
+            self._records = np.empty(0, dtype=marker_dtype)
+        # first record index -> records of each update since the last mapping
+        self._tail = {}
+        self._tail_count = 0
+
+    def clear(self):
+        if getattr(self, '_records_file', None):
+            self._records_file.close()
+        self._records = np.empty(0, dtype=marker_dtype)
+        self._tail = {}
+        self._tail_count = 0
+        if self.read_only:
+            self._records_file = None
+        else:
+            # replace instead of truncating the file, other processes might still map the old records
+            open(self.records_path + '.tmp', 'wb').close()
+            os.replace(self.records_path + '.tmp', self.records_path)
+            self._records_file = open(self.records_path, 'ab')
+        self._record_count = 0
+        self._offsets = np.full((self.length, 2), -1, dtype=np.int64)
+        self._offsets[:, 1] = 0
+        self._visited = Interval_Set()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self.length))]
+        start, count = self._offsets[key]
+        if start < 0:
+            return False
+        if count == 0:
+            # frames without markers share their start with the next frame written
+            return []
+        if start + count > self._records.shape[0]:
+            return records_to_markers(self._tail[start])
+        return records_to_markers(self._records[start:start + count])
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    @property
+    def visited(self):
+        return self._visited
+
+    @property
+    def visited_count(self):
+        return len(self._visited)
+
+    @property
+    def visited_ranges(self):
+        return self._visited.intervals()
+
+    @property
+    def complete(self):
+        return len(self._visited) == self.length
+
+    def update(self, key, markers):
+        if self._offsets[key, 0] >= 0:
+            # the old records stay in the file but are no longer referenced
+            logger.warning("You are overwriting a precached result.")
+        records = markers_to_records(key, markers)
+        self._records_file.write(records.tobytes())
+        self._tail[self._record_count] = records
+        self._tail_count += len(markers)
+        self._offsets[key] = self._record_count, len(markers)
+        self._visited.add(key)
+        self._record_count += len(markers)
+        if self._tail_count >= self.tail_size:
+            self._map_records()
+
+    def marker_ids(self):
+        '''(frame indices, marker ids) of all cached markers'''
+        if self._records.shape[0] < self._record_count:
+            self._map_records()
+        starts, counts = self._offsets[:, 0], self._offsets[:, 1]
+        visited = np.flatnonzero(starts >= 0)
+        if not visited.shape[0]:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        frames = np.repeat(visited, counts[visited])
+        record_idx = np.repeat(starts[visited] - np.cumsum(counts[visited]) + counts[visited], counts[visited])
+        record_idx += np.arange(frames.shape[0])
+        return frames, np.asarray(self._records['id'][record_idx])
+
+    def save(self):
+        self._records_file.flush()
+        np.save(self.offsets_path, self._offsets)
+
+    def close(self):
+        if self._records_file:
+            self.save()
+            self._records_file.close()
+        self._records = None
+
+
+def markers_to_records(frame_idx, markers):
+    records = np.empty(len(markers), dtype=marker_dtype)
+    records['frame'] = frame_idx
+    records['id'] = [m['id'] for m in markers]
+    records['id_confidence'] = [m['id_confidence'] for m in markers]
+    records['verts'] = np.array([m['verts'] for m in markers], dtype=np.float32).reshape(-1, 4, 1, 2)
+    return records
+
+
+def records_to_markers(records):
+    verts = np.asarray(records['verts'])
+    centroids = verts.sum(axis=1) / 4.
+    edges = verts - np.roll(verts, 1, axis=1)
+    perimeters = np.sqrt((edges.astype(np.float64)**2).sum(axis=-1)).sum(axis=(1, 2))
+    return [{'id': m_id, 'id_confidence': conf, 'verts': v, 'perimeter': p, 'centroid': c[0]}
+            for m_id, conf, v, p, c in zip(records['id'].tolist(), records['id_confidence'].tolist(),
+                                            verts.tolist(), perimeters.tolist(), centroids.tolist())]
+
+
+def bool_ranges(mask):
+    '''[[first,last],...] index ranges where mask is True'''
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return (edges.reshape(-1, 2) - (0, 1)).tolist()
+
+
+if __name__ == '__main__':
+    import tempfile
+    def marker(m_id):
+        return {'id': m_id, 'id_confidence': 1., 'verts': [[[0, 0]], [[1, 0]], [[1, 1]], [[0, 1]]]}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = Marker_Cache(os.path.join(tmp, 'cache'), 4)
+        # empty frames between non-empty ones, read back from the tail and after mapping
+        cache.update(0, [marker(1), marker(2)])
+        cache.update(1, [])
+        cache.update(2, [marker(7), marker(8), marker(9)])
+        for mapped in (False, True):
+            if mapped:
+                cache._map_records()
+            ids = [[m['id'] for m in cache[i]] if cache[i] is not False else False for i in range(4)]
+            assert ids == [[1, 2], [], [7, 8, 9], False], ids
+        cache.close()
+    print('ok')
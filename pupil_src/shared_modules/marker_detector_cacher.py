@@ -9,103 +9,227 @@ See COPYING and COPYING.LESSER for license details.
 ---------------------------------------------------------------------------~(*)
 '''
 
+# chunks are cut at keyframes, but never shorter than min and (if possible) never longer than max frames
+min_chunk_size = 120
+max_chunk_size = 900
+# workers report results in batches of this many frames or after this many seconds
+batch_size = 30
+batch_interval = 0.5
+
 
 class Global_Container(object):
     pass
 
 
-def fill_cache(visited_list, video_file_path, q, seek_idx, run,min_marker_perimeter, invert_image):
+def keyframe_indices(cap):
     '''
-    this function is part of marker_detector it is run as a seperate process.
-    it must be kept in a seperate file for namespace sanatisation
+    demux (without decoding) the video stream of a File_Source and
+    return the sorted frame indices of all keyframes.
+    '''
+    keyframes = []
+    for packet in cap.container.demux(cap.video_stream):
+        if packet.pts is not None and packet.is_keyframe:
+            keyframes.append(cap.pts_to_idx(packet.pts))
+    cap.seek_to_frame(0)
+    keyframes.sort()
+    return keyframes
+
+
+def make_chunks(keyframes, frame_count, visited):
+    '''
+    split [0,frame_count) into [start,stop) chunks that start on keyframes whenever possible.
+    Chunks that only contain visited frames are dropped.
+    '''
+    cuts = [0]
+    for k in keyframes:
+        if k - cuts[-1] >= min_chunk_size and k < frame_count:
+            # cut before max length if there are keyframes far apart
+            while k - cuts[-1] > max_chunk_size:
+                cuts.append(cuts[-1] + max_chunk_size)
+            cuts.append(k)
+    while frame_count - cuts[-1] > max_chunk_size:
+        cuts.append(cuts[-1] + max_chunk_size)
+    cuts.append(frame_count)
+
+    chunks = []
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+        if visited.next_missing(start) < stop:
+            chunks.append((start, stop))
+    return chunks
+
+
+def claim_chunk(chunks, chunk_state, seek_idx, playhead, lock):
+    '''
+    pick the next pending chunk for a worker.
+    The chunk containing the last requested seek position goes first,
+    then chunks in the future of it, then chunks in the past.
+    '''
+    with lock:
+        if seek_idx.value != -1:
+            playhead.value = seek_idx.value
+            seek_idx.value = -1
+        pending = [i for i, state in enumerate(chunk_state) if state == 0]
+        if not pending:
+            return None
+        for i in pending:
+            if chunks[i][1] > playhead.value:
+                break
+        else:
+            i = pending[0]
+        chunk_state[i] = 1
+        return i
+
+
+def fill_chunks(chunks, chunk_state, visited, video_file_path, q, seek_idx, playhead, lock, run, min_marker_perimeter, invert_image):
+    '''
+    worker process of the marker cacher: claims chunks and detects markers
+    in all of their unvisited frames using its own File_Source.
     '''
     import os
     import logging
+    from time import time
     logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()))
-    logger.debug('Started cacher process for Marker Detector')
+    logger.debug('Started cacher worker for Marker Detector')
     from video_capture import File_Source, EndofVideoFileError, FileSeekError
     from square_marker_detect import detect_markers_robust
     aperture = 9
-    markers = []
     cap = File_Source(Global_Container(), video_file_path)
+    batch = []
+    last_flush = time()
 
-    def next_unvisited_idx(frame_idx):
-        try:
-            visited = visited_list[frame_idx]
-        except IndexError:
-            visited = True  # trigger search
+    def report(idx, markers):
+        nonlocal last_flush
+        # object passed will only be pickeled when collected from other process! need to make a copy ot avoid overwrite!!!
+        batch.append((idx, markers[:]))
+        if len(batch) >= batch_size or time() - last_flush > batch_interval:
+            flush()
 
-        if not visited:
-            next_unvisited = frame_idx
-        else:
-            # find next unvisited site in the future
-            try:
-                next_unvisited = visited_list.index(False, frame_idx)
-            except ValueError:
-                # any thing in the past?
+    def flush():
+        nonlocal last_flush
+        if batch:
+            q.put(batch[:])
+            batch[:] = []
+        last_flush = time()
+
+    def fill_chunk(start, stop):
+        markers = []
+        next_frame = visited.next_missing(start)
+        while next_frame < stop:
+            if not run.value:
+                return
+            if next_frame != cap.get_frame_index() + 1:
+                # we need to seek:
+                logger.debug("Seeking to Frame {}".format(next_frame))
                 try:
-                    next_unvisited = visited_list.index(False, 0, frame_idx)
-                except ValueError:
-                    # no unvisited sites left. Done!
-                    logger.debug("Caching completed.")
-                    next_unvisited = None
-        return next_unvisited
-
-    def handle_frame(next_frame):
-        if next_frame != cap.get_frame_index() + 1:
-            # we need to seek:
-            logger.debug("Seeking to Frame {}".format(next_frame))
+                    cap.seek_to_frame(next_frame)
+                except FileSeekError:
+                    # could not seek to requested position
+                    logger.warning("Could not evaluate frame: {}.".format(next_frame))
+                    report(next_frame, [])  # we cannot look at the frame, report no detection
+                    next_frame = visited.next_missing(next_frame + 1)
+                    continue
+                # seeking invalidates prev markers for the detector
+                markers = []
+
             try:
-                cap.seek_to_frame(next_frame)
-            except FileSeekError:
-                # could not seek to requested position
-                logger.warning("Could not evaluate frame: {}.".format(next_frame))
-                visited_list[next_frame] = True  # this frame is now visited.
-                q.put((next_frame, []))  # we cannot look at the frame, report no detection
+                frame = cap.get_frame()
+            except EndofVideoFileError:
+                logger.debug("Video File's last frame(s) not accesible")
+                # could not read the rest of the chunk
+                while next_frame < stop:
+                    logger.warning("Could not evaluate frame: {}.".format(next_frame))
+                    report(next_frame, [])  # we cannot look at the frame, report no detection
+                    next_frame = visited.next_missing(next_frame + 1)
                 return
-            # seeking invalidates prev markers for the detector
-            markers[:] = []
-
-        try:
-            frame = cap.get_frame()
-        except EndofVideoFileError:
-            logger.debug("Video File's last frame(s) not accesible")
-
-            # could not read frame
-            logger.warning("Could not evaluate frame: {}.".format(next_frame))
-            visited_list[next_frame] = True  # this frame is now visited.
-            q.put((next_frame, []))  # we cannot look at the frame, report no detection
-            return
-
-        markers[:] = detect_markers_robust(frame.gray,
-                                           grid_size=5,
-                                           prev_markers=markers,
-                                           min_marker_perimeter=min_marker_perimeter,
-                                           aperture=aperture,
-                                           visualize=0,
-                                           true_detect_every_frame=1,
-                                           invert_image=invert_image)
-
-        visited_list[frame.index] = True
-        q.put((frame.index, markers[:]))  # object passed will only be pickeled when collected from other process! need to make a copy ot avoid overwrite!!!
 
-    while run.value:
-        next_frame = cap.get_frame_index()
-        if seek_idx.value != -1:
-            next_frame = seek_idx.value
-            seek_idx.value = -1
-            logger.debug("User required seek. Marker caching at Frame: {}".format(next_frame))
+            markers = detect_markers_robust(frame.gray,
+                                            grid_size=5,
+                                            prev_markers=markers,
+                                            min_marker_perimeter=min_marker_perimeter,
+                                            aperture=aperture,
+                                            visualize=0,
+                                            true_detect_every_frame=1,
+                                            invert_image=invert_image)
+            report(frame.index, markers)
+            next_frame = visited.next_missing(frame.index + 1)
 
-        # check the visited list
-        next_frame = next_unvisited_idx(next_frame)
-        if next_frame is None:
-            # we are done here:
+    while run.value:
+        chunk_idx = claim_chunk(chunks, chunk_state, seek_idx, playhead, lock)
+        if chunk_idx is None:
             break
-        else:
-            handle_frame(next_frame)
+        start, stop = chunks[chunk_idx]
+        logger.debug("Caching chunk [{}, {})".format(start, stop))
+        fill_chunk(start, stop)
+        flush()
+        chunk_state[chunk_idx] = 2
 
-    logger.debug("Closing Cacher Process")
+    logger.debug("Closing Cacher worker")
     cap.cleanup()
+    if run.value:
+        flush()
+    else:
+        # the consumer is shutting down and might not drain the queue anymore
+        q.cancel_join_thread()
+    q.close()
+
+
+def fill_cache(visited, video_file_path, q, seek_idx, run, min_marker_perimeter, invert_image, worker_count=None):
+    '''
+    this function is part of marker_detector it is run as a seperate process.
+    it must be kept in a seperate file for namespace sanatisation
+
+    The video is split into keyframe-aligned chunks that are filled by a pool of
+    `fill_chunks` worker processes. Results are put into `q` as lists of (frame index, markers).
+    '''
+    import os
+    import logging
+    import platform
+    import multiprocessing
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()))
+    logger.debug('Started cacher process for Marker Detector')
+    from video_capture import File_Source
+    if platform.system() == 'Darwin':
+        mp = multiprocessing.get_context("fork")
+    else:
+        mp = multiprocessing.get_context()
+
+    cap = File_Source(Global_Container(), video_file_path)
+    frame_count = len(cap.timestamps)
+    try:
+        keyframes = keyframe_indices(cap)
+    except Exception as e:
+        logger.debug("Could not read keyframes: {}".format(e))
+        keyframes = []
+    cap.cleanup()
+
+    chunks = make_chunks(keyframes, frame_count, visited)
+    if not chunks:
+        logger.debug("Caching completed.")
+        q.close()
+        run.value = False
+        return
+
+    if worker_count is None:
+        worker_count = max(1, mp.cpu_count() - 1)
+    worker_count = min(worker_count, len(chunks))
+    logger.debug("Caching {} chunks with {} workers".format(len(chunks), worker_count))
+
+    # 0: pending, 1: claimed by a worker, 2: done
+    chunk_state = mp.Array('b', len(chunks), lock=False)
+    playhead = mp.Value('i', max(seek_idx.value, 0), lock=False)
+    lock = mp.Lock()
+    workers = [mp.Process(target=fill_chunks, name='Marker Cacher {}'.format(i),
+                          args=(chunks, chunk_state, visited, video_file_path, q, seek_idx,
+                                playhead, lock, run, min_marker_perimeter, invert_image))
+               for i in range(worker_count)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    if all(state == 2 for state in chunk_state):
+        logger.debug("Caching completed.")
+    logger.debug("Closing Cacher Process")
     q.close()
     run.value = False
     return
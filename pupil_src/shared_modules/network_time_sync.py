@@ -15,6 +15,7 @@ import threading
 import asyncore
 import struct
 from random import random
+from collections import deque
 
 import logging
 logger = logging.getLogger(__name__)
@@ -154,6 +155,12 @@ class Clock_Sync_Follower(threading.Thread):
         # is this node synced?
         self.in_sync = False
 
+        # telemetry of the last estimate, see sync_quality
+        self.offset = None
+        self.drift = None
+        self.rtt = None
+        self.estimates = 0
+
         self.start()
 
     def run(self):
@@ -162,32 +169,12 @@ class Clock_Sync_Follower(threading.Thread):
             if result:
                 offset, jitter = result
                 self.sync_jitter = jitter
+                self.offset = offset
+                self.estimates += 1
                 if abs(offset) > max(jitter, self.tolerance):
-                    if abs(offset) > self.min_jump:
-                        if self.jump_time(offset):
-                            self.in_sync = True
-                            self.offset_remains = False
-                            logger.debug('Time adjusted by {}ms.'.format(offset/self.ms))
-                        else:
-                            self.in_sync = True
-                            self.offset_remains = True
-                            sleep(self.retry_interval)
-                            continue
-                    else:
-                        # print 'time slewed required  %sms.'%(offset/self.ms)
-                        for x in range(self.slew_iterations):
-                            slew_time = max(-self.max_slew, min(self.max_slew, offset))
-                            # print offset/self.ms,slew_time/self.ms
-                            self.slew_time(slew_time)
-                            offset -= slew_time
-                            logger.debug('Time slewed by: {}ms'.format(slew_time/self.ms))
-
-                            self.in_sync = not bool(offset)
-                            self.offset_remains = not self.in_sync
-                            if abs(offset) > 0:
-                                sleep(self.slew_interval)
-                            else:
-                                break
+                    if not self._adjust(offset):
+                        sleep(self.retry_interval)
+                        continue
                 else:
                     logger.debug('No clock adjustent.')
                     self.in_sync = True
@@ -201,14 +188,43 @@ class Clock_Sync_Follower(threading.Thread):
 
             sleep(random())  # wait for a bit to balance load with other nodes.
 
-    def _get_offset(self):
+    def _adjust(self, offset):
+        '''jump or slew the clock by offset, False if the jump was refused'''
+        if abs(offset) > self.min_jump:
+            if self.jump_time(offset):
+                self.in_sync = True
+                self.offset_remains = False
+                logger.debug('Time adjusted by {}ms.'.format(offset/self.ms))
+            else:
+                self.in_sync = True
+                self.offset_remains = True
+                return False
+        else:
+            # print 'time slewed required  %sms.'%(offset/self.ms)
+            for x in range(self.slew_iterations):
+                slew_time = max(-self.max_slew, min(self.max_slew, offset))
+                # print offset/self.ms,slew_time/self.ms
+                self.slew_time(slew_time)
+                offset -= slew_time
+                logger.debug('Time slewed by: {}ms'.format(slew_time/self.ms))
+
+                self.in_sync = not bool(offset)
+                self.offset_remains = not self.in_sync
+                if abs(offset) > 0:
+                    sleep(self.slew_interval)
+                else:
+                    break
+        return True
+
+    def _probe(self, count):
+        '''`count` round trips to the master as (t0, t1, t2) tuples or None'''
         try:
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.settimeout(1.)
             server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             server_socket.connect((self.host, self.port))
             times = []
-            for request in range(60):
+            for request in range(count):
                 t0 = self.get_time()
                 server_socket.send(b'sync')
                 message = server_socket.recv(8)
@@ -217,25 +233,37 @@ class Clock_Sync_Follower(threading.Thread):
                 times.append((t0, t1, t2))
 
             server_socket.close()
+            return times
 
-            times.sort(key=lambda t: t[2]-t[0])
-            times = times[:int(len(times)*0.69)]
-            # delays = [t2-t0 for t0, t1, t2 in times]
-            offsets = [t0-((t1+(t2-t0)/2)) for t0, t1, t2 in times]
-            mean_offset = sum(offsets)/len(offsets)
-            offset_jitter = sum([abs(mean_offset-o)for o in offsets])/len(offsets)
-            # mean_delay = sum(delays)/len(delays)
-            # delay_jitter = sum([abs(mean_delay-o)for o in delays])/len(delays)
-
-            # logger.debug('offset: %s (%s),delay %s(%s)'%(mean_offset/self.ms,offset_jitter/self.ms,mean_delay/self.ms,delay_jitter/self.ms))
-            return mean_offset, offset_jitter
-
-        except socket.error as e:
+        except (socket.error, struct.error) as e:
+            # struct.error: connection closed during the request
             logger.debug('{} for {}:{}'.format(e, self.host, self.port))
             return None
-        # except Exception as e:
-        #     logger.error(str(e))
-        #     return 0,0
+
+    def _get_offset(self):
+        times = self._probe(60)
+        if not times:
+            return None
+
+        times.sort(key=lambda t: t[2]-t[0])
+        times = times[:int(len(times)*0.69)]
+        # delays = [t2-t0 for t0, t1, t2 in times]
+        offsets = [t0-((t1+(t2-t0)/2)) for t0, t1, t2 in times]
+        mean_offset = sum(offsets)/len(offsets)
+        offset_jitter = sum([abs(mean_offset-o)for o in offsets])/len(offsets)
+        self.rtt = times[0][2] - times[0][0]
+        # mean_delay = sum(delays)/len(delays)
+        # delay_jitter = sum([abs(mean_delay-o)for o in delays])/len(delays)
+
+        # logger.debug('offset: %s (%s),delay %s(%s)'%(mean_offset/self.ms,offset_jitter/self.ms,mean_delay/self.ms,delay_jitter/self.ms))
+        return mean_offset, offset_jitter
+
+    @property
+    def sync_quality(self):
+        '''last estimate: clock offset, drift (s/s), min round trip time and offset jitter in seconds'''
+        return {'host': self.host, 'in_sync': self.in_sync and not self.offset_remains,
+                'offset': self.offset, 'drift': self.drift, 'rtt': self.rtt,
+                'jitter': self.sync_jitter, 'estimates': self.estimates}
 
     def stop(self):
         self.running = False
@@ -253,50 +281,238 @@ class Clock_Sync_Follower(threading.Thread):
         else:
             return "Connecting to {}".format(self.host)
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    from uvc import get_time_monotonic
-    # from time import time as get_time_monotonic
-    #### A Note on system clock jitter
-    # during tests using a Mac and Linux machine on a 3ms latency network with network jitter of ~50us
-    # it became apparent that even on Linux not all clocks are created equal:
-    # on MacOS time.time appears to have low jitter (<1ms)
-    # on Linux (Ubunut Python 2.7) time.time shows more jitter (<3ms)
-    # it is thus recommended for Linux to use uvc.get_time_monotonic.
-    master = Clock_Sync_Master(get_time_monotonic)
-    port = master.port
-    host = "127.0.0.1"
+
+def weighted_linear_fit(points):
+    '''least squares line through (x, y, weight) points as (intercept, slope)'''
+    w_sum = sum(w for x, y, w in points)
+    x_mean = sum(x*w for x, y, w in points)/w_sum
+    y_mean = sum(y*w for x, y, w in points)/w_sum
+    var = sum(w*(x-x_mean)**2 for x, y, w in points)
+    if var <= 0.:
+        return y_mean, 0.
+    slope = sum(w*(x-x_mean)*(y-y_mean) for x, y, w in points)/var
+    return y_mean-slope*x_mean, slope
+
+
+class Filtered_Clock_Sync_Follower(Clock_Sync_Follower):
+    '''
+    A follower that estimates offset and drift of the local clock over many probes.
+
+    Each poll sends `burst_size` probes and keeps the `min_rtt_fraction` with the
+    lowest round trip times, whose median offset is one measurement.
+    A linear fit over the last `history` measurements, weighted by round trip time,
+    gives the offset and drift. The drift is slewed out between polls.
+    The poll interval doubles from `min_interval` up to `interval` while the clock
+    stays within tolerance and drops back to `min_interval` after larger offsets.
+    Uses the same clock service as Clock_Sync_Follower.
+    '''
+    burst_size = 100
+    min_rtt_fraction = 0.2
+    history = 16
+    min_interval = 1.0
+    drift_interval = 1.0
+    # larger fits come from too few measurements or clock changes
+    max_drift = 500*Clock_Sync_Follower.us
+    # measurements this far off the fit mean the master clock changed
+    max_residual = Clock_Sync_Follower.min_jump
+
+    def __init__(self, host, port, interval, time_fn, jump_fn, slew_fn):
+        # sum of all adjustments, measurements are stored relative to the unadjusted clock
+        self.correction = 0.
+        self.measurements = deque(maxlen=self.history)
+        self.poll_interval = self.min_interval
+        self._jump_fn = jump_fn
+        self._slew_fn = slew_fn
+        super().__init__(host, port, interval, time_fn, self._jump_and_track, self._slew_and_track)
+
+    def _jump_and_track(self, offset):
+        if self._jump_fn(offset):
+            self.correction += offset
+            return True
+        return False
+
+    def _slew_and_track(self, offset):
+        self._slew_fn(offset)
+        self.correction += offset
+
+    def run(self):
+        while self.running:
+            result = self._measure()
+            if result is None:
+                logger.debug('Failed to connect. Retrying')
+                self.in_sync = False
+                sleep(self.retry_interval)
+                continue
+
+            t, offset, rtt, jitter = result
+            self.rtt = rtt
+            self.sync_jitter = jitter
+            point = (t+self.correction, offset+self.correction, 1./max(rtt, self.us)**2)
+            if len(self.measurements) > 2:
+                intercept, slope = weighted_linear_fit(self.measurements)
+                if abs(intercept+slope*point[0]-point[1]) > self.max_residual:
+                    logger.debug('Clock offset changed by more than {}ms. Restarting estimation.'.format(self.max_residual/self.ms))
+                    self.measurements.clear()
+            self.measurements.append(point)
+
+            intercept, slope = weighted_linear_fit(self.measurements)
+            self.drift = max(-self.max_drift, min(self.max_drift, slope))
+            offset = intercept+slope*point[0]-self.correction
+            self.offset = offset
+            self.estimates += 1
+
+            # the fit is more precise than the jitter of single probes
+            if abs(offset) > self.tolerance:
+                if not self._adjust(offset):
+                    sleep(self.retry_interval)
+                    continue
+            else:
+                self.in_sync = True
+                self.offset_remains = False
+            if abs(offset) > max(jitter, self.tolerance):
+                self.poll_interval = self.min_interval
+            elif len(self.measurements) > 2:
+                self.poll_interval = min(self.interval, 2*self.poll_interval)
+            self._follow_drift(self.poll_interval+random())
+
+    def _measure(self):
+        '''(local time, offset, min round trip time, offset jitter) of one burst of probes'''
+        times = self._probe(self.burst_size)
+        if not times:
+            return None
+        times.sort(key=lambda t: t[2]-t[0])
+        times = times[:max(3, int(len(times)*self.min_rtt_fraction))]
+        # the master read its clock half a round trip after t0
+        offsets = sorted(t0+(t2-t0)/2-t1 for t0, t1, t2 in times)
+        offset = offsets[len(offsets)//2]
+        jitter = sorted(abs(o-offset) for o in offsets)[len(offsets)//2]
+        t = sorted((t0+t2)/2 for t0, t1, t2 in times)[len(times)//2]
+        return t, offset, times[0][2]-times[0][0], jitter
+
+    def _follow_drift(self, duration):
+        '''wait for duration and slew out the estimated drift meanwhile'''
+        end = self.get_time()+duration
+        last = self.get_time()
+        while self.running:
+            now = self.get_time()
+            if now >= end:
+                break
+            sleep(min(self.drift_interval, end-now))
+            if self.drift and len(self.measurements) > 2:
+                now = self.get_time()
+                self.slew_time(self.drift*(now-last))
+                last = now
+
+    def __str__(self):
+        if self.in_sync and not self.offset_remains:
+            return 'Synced with {}:{}, offset {:.3f}ms, drift {:.1f}ppm, rtt {:.2f}ms'.format(
+                self.host, self.port, self.offset/self.ms, (self.drift or 0.)/self.us, self.rtt/self.ms)
+        return super().__str__()
+
+
+
+def _serve_clock(pipe, latency, jitter):
+    '''clock master process for run_harness, its clock is the shared monotonic clock'''
+    from time import monotonic
+    from random import expovariate
+
+    def delayed_time():
+        # request and reply are delayed like on a busy network
+        sleep(latency+expovariate(1./jitter) if jitter else latency)
+        t = monotonic()
+        sleep(latency+expovariate(1./jitter) if jitter else latency)
+        return t
+    master = Clock_Sync_Master(delayed_time if latency or jitter else monotonic)
+    pipe.send(master.port)
+    pipe.recv()
+    master.stop()
+
+
+def run_harness(follower_cls=Filtered_Clock_Sync_Follower, duration=60., offset=0.05, drift=50e-6,
+                latency=0., jitter=0.002, interval=10., threshold=0.001):
+    '''
+    Sync a simulated clock with a master in a second process and measure the error.
+
+    The follower clock starts `offset` seconds ahead and runs `drift` s/s fast.
+    Both processes read the same monotonic clock, so the true error is known.
+    Returns the time until the error stayed below `threshold` and the error after that.
+    '''
+    from time import monotonic
+    from multiprocessing import Process, Pipe
+
+    pipe, child_pipe = Pipe()
+    master = Process(target=_serve_clock, args=(child_pipe, latency, jitter), daemon=True)
+    master.start()
+    port = pipe.recv()
+
+    start = monotonic()
     epoch = 0.0
-    # sleep(3)
-    # master.stop()
 
     def get_time():
-        return get_time_monotonic()+epoch
+        return offset+start+(monotonic()-start)*(1+drift)-epoch
 
     def jump_time(offset):
-        global epoch
-        epoch -= offset
+        nonlocal epoch
+        epoch += offset
         return True
 
-    def slew_time(offset):
-        global epoch
-        epoch -= offset
+    follower = follower_cls('127.0.0.1', port, interval, get_time, jump_time, jump_time)
+    errors = []
+    while monotonic()-start < duration:
+        sleep(0.05)
+        errors.append((monotonic()-start, get_time()-monotonic()))
+    follower.terminate()
+    pipe.send('stop')
+    master.join()
+
+    converged = None
+    for idx in range(len(errors)-1, -1, -1):
+        if abs(errors[idx][1]) > threshold:
+            break
+        converged = idx
+    report = {'follower': follower_cls.__name__, 'duration': duration, 'estimates': follower.estimates,
+              'drift': follower.drift, 'convergence_time': None, 'median_error': None, 'p95_error': None,
+              'max_error': None}
+    if converged is not None:
+        residual = sorted(abs(e) for t, e in errors[converged:])
+        report['convergence_time'] = errors[converged][0]
+        report['median_error'] = residual[len(residual)//2]
+        report['p95_error'] = residual[int(0.95*(len(residual)-1))]
+        report['max_error'] = residual[-1]
+    return report
 
-    def jump_time_dummy(offset):
-        return True
-
-    def slew_time_dummy(offset):
-        pass
 
-    slave = Clock_Sync_Follower(host,port=port,interval=10,time_fn=get_time,jump_fn=jump_time,slew_fn=slew_time)
-    # slave1 = Clock_Sync_Follower(host,port=port,interval=10,time_fn=get_time,jump_fn=jump_time_dummy,slew_fn=slew_time_dummy)
-    # slave2 = Clock_Sync_Follower(host,port=port,interval=10,time_fn=get_time,jump_fn=jump_time_dummy,slew_fn=slew_time_dummy)
-    # slave3 = Clock_Sync_Follower(host,port=port,interval=10,time_fn=get_time,jump_fn=jump_time_dummy,slew_fn=slew_time_dummy)
-    for x in range(10):
-        sleep(4)
-        print(slave)
-        # print "offset:%f, jitter: %f"%(epoch,slave.sync_jitter)
-    print('shutting down')
-    slave.stop()
-    master.stop()
-    print('good bye')
+if __name__ == '__main__':
+    import argparse
+    #### A Note on system clock jitter
+    # during tests using a Mac and Linux machine on a 3ms latency network with network jitter of ~50us
+    # it became apparent that even on Linux not all clocks are created equal:
+    # on MacOS time.time appears to have low jitter (<1ms)
+    # on Linux (Ubunut Python 2.7) time.time shows more jitter (<3ms)
+    # it is thus recommended for Linux to use uvc.get_time_monotonic.
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Measure clock sync convergence against a local master process.')
+    parser.add_argument('--follower', choices=('filtered', 'classic', 'both'), default='both')
+    parser.add_argument('--duration', type=float, default=60., help='seconds per follower')
+    parser.add_argument('--offset', type=float, default=0.05, help='initial follower offset in s')
+    parser.add_argument('--drift', type=float, default=50., help='follower drift in ppm')
+    parser.add_argument('--latency', type=float, default=0., help='added one way latency in s')
+    parser.add_argument('--jitter', type=float, default=0.002, help='mean of the added exponential one way delay in s')
+    parser.add_argument('--interval', type=float, default=10., help='(maximal) sync interval in s')
+    parser.add_argument('--threshold', type=float, default=0.001, help='error in s that counts as converged')
+    args = parser.parse_args()
+
+    followers = {'filtered': [Filtered_Clock_Sync_Follower], 'classic': [Clock_Sync_Follower],
+                 'both': [Clock_Sync_Follower, Filtered_Clock_Sync_Follower]}[args.follower]
+    for follower_cls in followers:
+        report = run_harness(follower_cls, args.duration, args.offset, args.drift*1e-6,
+                             args.latency, args.jitter, args.interval, args.threshold)
+        print(follower_cls.__name__)
+        if report['convergence_time'] is None:
+            print('    not converged to {:.3f}ms in {:.0f}s'.format(args.threshold*1e3, args.duration))
+            continue
+        print('    converged after {:.1f}s, {} estimates'.format(report['convergence_time'], report['estimates']))
+        print('    error after convergence: median {:.3f}ms, p95 {:.3f}ms, max {:.3f}ms'.format(
+            report['median_error']*1e3, report['p95_error']*1e3, report['max_error']*1e3))
+        if report['drift'] is not None:
+            print('    estimated drift {:.1f}ppm (true {:.1f}ppm)'.format(report['drift']*1e6, args.drift))
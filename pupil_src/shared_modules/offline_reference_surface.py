@@ -15,12 +15,168 @@ from gl_utils import cvmat_to_glmat
 from glfw import *
 from OpenGL.GL import *
 from pyglui.cygl.utils import Named_Texture
-from cache_list import Cache_List
-from reference_surface import Reference_Surface
+from cache_list import Cache_List, Interval_Set
+from marker_cache import Marker_Cache
+from reference_surface import Reference_Surface, marker_corners_norm, perspective_transforms, perspective_transform_batch
+import background_helper as bh
 
 import logging
 logger = logging.getLogger(__name__)
 
+# surface locations are computed in background in chunks of this many frames
+cache_chunk_size = 100
+
+
+class Empty(object):
+    pass
+
+
+class Heatmap_Histograms(object):
+    """2D gaze histograms of a surface, accumulated per block of frames.
+
+    Frames are added once the surface has been located in them. Prefix sums over
+    the blocks are computed on demand, so the histogram of any frame range is the
+    difference of two cumulative histograms plus the frames of at most two partial blocks.
+    """
+    max_cells = 2**20
+
+    def __init__(self, frame_count, grid, min_confidence):
+        self.grid = grid
+        self.min_confidence = min_confidence
+        self.frame_count = frame_count
+        self.block_size = max(64, -(-frame_count * grid[0] * grid[1] // self.max_cells))
+        block_count = -(-frame_count // self.block_size)
+        self.blocks = np.zeros((block_count,) + grid, dtype=np.uint32)
+        self.accumulated = Interval_Set()
+        self._cumulative = None
+
+    def bin(self, norm_pos):
+        '''histogram bins of surface positions, like np.histogram2d(1-y, x, bins=grid, range=[[0,1],[0,1]])'''
+        rows, cols = 1. - norm_pos[:, 1], norm_pos[:, 0]
+        inside = (rows >= 0) & (rows <= 1) & (cols >= 0) & (cols <= 1)
+        rows = np.minimum((rows[inside] * self.grid[0]).astype(np.int64), self.grid[0] - 1)
+        cols = np.minimum((cols[inside] * self.grid[1]).astype(np.int64), self.grid[1] - 1)
+        return inside, rows, cols
+
+    def histogram_of(self, mapped):
+        hist = np.zeros(self.grid)
+        mapped = mapped.select(mapped.confidence >= self.min_confidence)
+        inside, rows, cols = self.bin(mapped.norm_pos)
+        np.add.at(hist, (rows, cols), 1)
+        return hist
+
+    def add(self, frames, mapped):
+        for idx in frames:
+            self.accumulated.add(idx)
+        mapped = mapped.select(mapped.confidence >= self.min_confidence)
+        inside, rows, cols = self.bin(mapped.norm_pos)
+        blocks = mapped.frame_idx[inside] // self.block_size
+        np.add.at(self.blocks, (blocks, rows, cols), 1)
+        self._cumulative = None
+
+    def histogram(self, start, stop, map_range):
+        '''
+        histogram of frames [start,stop).
+        map_range(start,stop) has to return the Surface_Mapped_Data of a frame range
+        and is used for the frames of partial blocks
+        '''
+        if self._cumulative is None:
+            self._cumulative = np.zeros((self.blocks.shape[0] + 1,) + self.grid, dtype=np.int64)
+            np.cumsum(self.blocks, axis=0, out=self._cumulative[1:])
+        first_block = -(-start // self.block_size)
+        stop_block = stop // self.block_size
+        if first_block >= stop_block:
+            return self.histogram_of(map_range(start, stop))
+        hist = (self._cumulative[stop_block] - self._cumulative[first_block]).astype(np.float64)
+        if start < first_block * self.block_size:
+            hist += self.histogram_of(map_range(start, first_block * self.block_size))
+        if stop_block * self.block_size < stop:
+            hist += self.histogram_of(map_range(stop_block * self.block_size, stop))
+        return hist
+
+
+def chunks_outward(start_idx, frame_count, chunk_size):
+    '''
+    frame chunks starting at start_idx and alternating between future and past
+    '''
+    start_idx = min(max(start_idx, 0), frame_count)
+    fwd, bwd = start_idx, start_idx
+    while fwd < frame_count or bwd > 0:
+        if fwd < frame_count:
+            yield range(fwd, min(fwd + chunk_size, frame_count))
+            fwd += chunk_size
+        if bwd > 0:
+            yield range(max(bwd - chunk_size, 0), bwd)
+            bwd -= chunk_size
+
+
+def locate_surface_in_background(surface, marker_cache_path, frame_count, start_idx, done, min_marker_perimeter, min_id_confidence):
+    '''
+    generator for bh.Task_Proxy: yields (progress, [(frame_idx, cache entry), ...]) per chunk.
+    surface is a picklable stand-in with the attributes Reference_Surface._get_location needs.
+    Frames in the Interval_Set done and frames that have no cached markers are skipped.
+    '''
+    marker_cache = Marker_Cache(marker_cache_path, frame_count, read_only=True)
+    handled = 0
+    for chunk in chunks_outward(start_idx, frame_count, cache_chunk_size):
+        # chunks alternate between future and past, corners are only smoothed within a chunk
+        surface.old_corners_robust = None
+        results = []
+        for idx in chunk:
+            if idx in done:
+                continue
+            visible_markers = marker_cache[idx]
+            if visible_markers is False:
+                continue
+            res = Reference_Surface._get_location(surface, visible_markers, min_marker_perimeter, min_id_confidence, locate_3d=False)
+            results.append((idx, res if res['detected'] else None))
+        handled += len(chunk)
+        yield handled / frame_count, results
+    marker_cache.close()
+
+
+def rebuild_surface_cache_in_background(surface, stale_entries, transform, *locate_args):
+    '''
+    generator for bh.Task_Proxy: re-derives the located stale_entries [(frame_idx, cache entry), ...]
+    after the surface uv space was changed by transform, then continues like locate_surface_in_background.
+    '''
+    if stale_entries:
+        yield 0., transform_cache_entries(stale_entries, transform, surface.g_pool.capture.intrinsics, surface.use_distortion)
+    yield from locate_surface_in_background(surface, *locate_args)
+
+
+def transform_cache_entries(entries, transform, intrinsics, use_distortion):
+    """
+    Re-derive cached locations [(frame_idx, cache entry), ...] after the surface uv space was changed by transform.
+    uv_new = transform * uv_old, thus the marker-fitted homographies become:
+        m_to_undistored_norm_space_new = m_to_undistored_norm_space_old * transform^-1
+        m_from_undistored_norm_space_new = transform * m_from_undistored_norm_space_old
+    The screen homographies are computed from the (re)distorted surface corners like in _get_location,
+    but for all frames at once. Inter-frame corner smoothing is not applied here.
+    """
+    m_to_undist = np.array([entry['m_to_undistored_norm_space'] for idx, entry in entries], dtype=np.float64)
+    m_from_undist = np.array([entry['m_from_undistored_norm_space'] for idx, entry in entries], dtype=np.float64)
+    m_to_undist = np.einsum('fij,jk->fik', m_to_undist, np.linalg.inv(transform))
+    m_from_undist = np.einsum('ij,fjk->fik', transform, m_from_undist)
+
+    corners = np.broadcast_to(marker_corners_norm, (len(entries), 4, 2))
+    corners_undistored_space = perspective_transform_batch(corners, m_to_undist).reshape(-1, 1, 2)
+    corners_redistorted = intrinsics.projectPoints(cv2.convertPointsToHomogeneous(corners_undistored_space), use_distortion=use_distortion)
+    corners_redistorted = corners_redistorted.reshape(-1, 4, 2) / intrinsics.resolution
+    corners_redistorted[..., -1] = 1 - corners_redistorted[..., -1]
+
+    m_to_screen = perspective_transforms(marker_corners_norm, corners_redistorted)
+    m_from_screen = perspective_transforms(corners_redistorted, marker_corners_norm)
+    transformed = []
+    for i, (idx, entry) in enumerate(entries):
+        entry = dict(entry)
+        entry['m_to_undistored_norm_space'] = m_to_undist[i]
+        entry['m_from_undistored_norm_space'] = m_from_undist[i]
+        entry['m_to_screen'] = m_to_screen[i]
+        entry['m_from_screen'] = m_from_screen[i]
+        transformed.append((idx, entry))
+    return transformed
+
 
 class Offline_Reference_Surface(Reference_Surface):
     """docstring for Offline_Reference_Surface"""
@@ -28,6 +184,12 @@ class Offline_Reference_Surface(Reference_Surface):
         super().__init__(g_pool, name, saved_definition)
         self.g_pool = g_pool
         self.cache = None
+        self.cache_task = None
+        # cache and accumulated uv transform from before the surface vertices were moved
+        self._stale_cache = None
+        self._stale_transform = None
+        self._heatmap_histograms = None
+        self._heatmap_sources = None
 
         self.metrics_gazecount = None
         self.metrics_texture = None
@@ -77,16 +239,91 @@ class Offline_Reference_Surface(Reference_Surface):
         else:
             # update where marker cache is not False but surface cache is still false
             # this happens when the markercache was incomplete when this fn was run before
-            for i in range(len(marker_cache)):
-                if self.cache[i] is False and marker_cache[i] is not False:
+            for first, last in marker_cache.visited_ranges:
+                i = self.cache.visited.next_missing(first)
+                while i <= last:
                     self.cache.update(i, self.answer_caching_request(marker_cache, i, min_marker_perimeter, min_id_confidence))
+                    i = self.cache.visited.next_missing(i + 1)
                     # iterations +=1
         # return iterations
 
-    def init_cache(self, marker_cache, min_marker_perimeter, min_id_confidence):
-        if self.defined:
+    def init_cache(self, marker_cache, min_marker_perimeter, min_id_confidence, start_idx=0):
+        """
+        (re)build the surface cache without blocking the caller. A background task
+            - re-derives all cached homographies by a vectorized transform first,
+              if only vertices were moved since the last cache.
+            - locates the remaining frames from the marker cache,
+              starting at start_idx and moving outward.
+        Results are collected in fetch_cache_task()
+        """
+        if not self.defined:
+            return
+        self.cancel_cache_task()
+        stale_entries = []
+        transform = self._stale_transform
+        if self._stale_cache is not None and transform is not None:
+            logger.debug("Re-deriving surface '{}' positons cache from moved vertices".format(self.name))
+            stale = self._stale_cache
+            # frames where the surface was not found stay valid, located frames are filled in by the task
+            stale_entries = [(idx, stale[idx]) for first, last in stale.positive_ranges for idx in range(first, last + 1)]
+            self.cache = Cache_List([None if entry is None else False for entry in stale], positive_eval_fn=stale.positive_eval_fn)
+            done = Interval_Set(stale.visited_ranges)
+        else:
             logger.debug("Full update of surface '{}' positons cache".format(self.name))
-            self.cache = Cache_List([self.answer_caching_request(marker_cache, i, min_marker_perimeter, min_id_confidence) for i in range(len(marker_cache))], positive_eval_fn=lambda x:  (x is not False) and (x is not None))
+            self.cache = Cache_List([False] * len(marker_cache), positive_eval_fn=lambda x:  (x is not False) and (x is not None))
+            done = self.cache.visited
+        self._stale_cache = None
+        self._stale_transform = None
+
+        if not stale_entries and self.cache.complete:
+            return
+        # the background process reads a snapshot of the marker cache from disk.
+        marker_cache.save()
+        surface = Empty()
+        surface.markers = self.markers
+        surface.use_distortion = self.use_distortion
+        surface.real_world_size = self.real_world_size
+        surface.old_corners_robust = None
+        surface.g_pool = Empty()
+        surface.g_pool.capture = Empty()
+        surface.g_pool.capture.intrinsics = self.g_pool.capture.intrinsics
+        generator_args = (surface, stale_entries, transform, marker_cache.base_path, len(marker_cache), start_idx, done,
+                          min_marker_perimeter, min_id_confidence)
+        self.cache_task = bh.Task_Proxy('Surface cache {}'.format(self.name), rebuild_surface_cache_in_background, args=generator_args)
+
+    def fetch_cache_task(self):
+        """
+        move results of the background task into the cache.
+        returns True when the task has just completed
+        """
+        if self.cache_task is None:
+            return False
+        try:
+            for progress, results in self.cache_task.fetch():
+                for idx, entry in results:
+                    # entries might have been set by update_cache() in the meantime
+                    if self.cache[idx] is False:
+                        self.cache.update(idx, entry)
+                self.update_heatmap_histograms()
+        except Exception as e:
+            logger.error("Locating surface '{}' in the background failed: {}".format(self.name, e))
+            self.cancel_cache_task()
+            return False
+        if self.cache_task.completed:
+            self.cache_task = None
+            return True
+        return False
+
+    def cancel_cache_task(self):
+        if self.cache_task is not None:
+            self.cache_task.cancel()
+            self.cache_task = None
+
+    def invalidate_cache(self):
+        self.cancel_cache_task()
+        self.cache = None
+        self._stale_cache = None
+        self._stale_transform = None
 
     def answer_caching_request(self, marker_cache, frame_index, min_marker_perimeter, min_id_confidence):
         visible_markers = marker_cache[frame_index]
@@ -101,16 +338,23 @@ class Offline_Reference_Surface(Reference_Surface):
             return None
 
     def move_vertex(self, vert_idx, new_pos):
-        super().move_vertex(vert_idx,new_pos)
+        transform = super().move_vertex(vert_idx,new_pos)
+        # keep the last complete state to re-derive the cache from once editing is done.
+        if self.cache is not None:
+            self.cancel_cache_task()
+            self._stale_cache = self.cache
+            self._stale_transform = np.eye(3)
+        if self._stale_transform is not None:
+            self._stale_transform = np.dot(transform, self._stale_transform)
         self.cache = None
 
     def add_marker(self, marker, visible_markers, min_marker_perimeter, min_id_confidence):
         super().add_marker(marker, visible_markers, min_marker_perimeter, min_id_confidence)
-        self.cache = None
+        self.invalidate_cache()
 
     def remove_marker(self, marker):
         super().remove_marker(marker)
-        self.cache = None
+        self.invalidate_cache()
 
     def gaze_on_srf_by_frame_idx(self, frame_index, m_from_screen):
         return self.map_data_to_surface(self.g_pool.gaze_positions_by_frame[frame_index], m_from_screen)
@@ -140,20 +384,56 @@ class Offline_Reference_Surface(Reference_Surface):
             glMatrixMode(GL_MODELVIEW)
             glPopMatrix()
 
+    def located_frames(self, section):
+        """
+        frame indices in section (a slice) where the surface was found
+        and the stacked (F,3,3) m_from_screen homographies of these frames
+        """
+        start, stop, _ = section.indices(len(self.cache))
+        frames = [idx for first, last in self.cache.positive_ranges for idx in range(max(first, start), min(last + 1, stop))]
+        m_from_screen = np.array([self.cache[idx]['m_from_screen'] for idx in frames], dtype=np.float64).reshape(-1, 3, 3)
+        return frames, m_from_screen
+
+    def map_section_to_surface(self, data_by_frame, section):
+        # batch map all data of frames in section where the surface was found
+        return self.map_frames_to_surface(data_by_frame, *self.located_frames(section))
+
+    def update_heatmap_histograms(self):
+        """
+        add frames, in which the surface has been located since the last call, to the heatmap histograms.
+        Histograms are reset when the cache, the gaze data, the heatmap grid or the confidence threshold changed.
+        """
+        if self.cache is None or not self.defined:
+            self._heatmap_histograms = None
+            return
+        gaze_by_frame = self.g_pool.gaze_positions_by_frame
+        sources = id(self.cache), id(gaze_by_frame), self.heatmap_grid, self.g_pool.min_data_confidence
+        if sources != self._heatmap_sources:
+            self._heatmap_histograms = Heatmap_Histograms(len(self.cache), self.heatmap_grid, self.g_pool.min_data_confidence)
+            self._heatmap_sources = sources
+
+        accumulated = self._heatmap_histograms.accumulated
+        frames = []
+        for first, last in self.cache.positive_ranges:
+            idx = accumulated.next_missing(first)
+            while idx <= last:
+                frames.append(idx)
+                idx = accumulated.next_missing(idx + 1)
+        if frames:
+            m_from_screen = np.array([self.cache[idx]['m_from_screen'] for idx in frames], dtype=np.float64).reshape(-1, 3, 3)
+            self._heatmap_histograms.add(frames, self.map_frames_to_surface(gaze_by_frame, frames, m_from_screen))
+
     def generate_heatmap(self, section):
         if self.cache is None:
             logger.warning('Surface cache is not build yet.')
             return
 
-        all_gaze = []
-        for frame_idx, c_e in enumerate(self.cache[section]):
-            if c_e:
-                frame_idx += section.start
-                for gp in self.gaze_on_srf_by_frame_idx(frame_idx, c_e['m_from_screen']):
-                    if gp['confidence'] >= self.g_pool.min_data_confidence:
-                        all_gaze.append(gp['norm_pos'])
-
-        self._generate_heatmap(all_gaze)
+        self.update_heatmap_histograms()
+        start, stop, _ = section.indices(len(self.cache))
+        map_range = lambda start, stop: self.map_section_to_surface(self.g_pool.gaze_positions_by_frame, slice(start, stop))
+        hist = self._heatmap_histograms.histogram(start, stop, map_range)
+        if hist.any():
+            self._generate_heatmap_from_histogram(hist)
 
     def visible_count_in_section(self,section):
         #section is a slice
@@ -161,19 +441,14 @@ class Offline_Reference_Surface(Reference_Surface):
         #If cache is not available on frames it is reported as not visible
         if self.cache is None:
             return 0
-        section_cache = self.cache[section]
-        return sum(map(bool,section_cache))
+        start, stop, _ = section.indices(len(self.cache))
+        return sum(max(min(last + 1, stop) - max(first, start), 0) for first, last in self.cache.positive_ranges)
 
     def gaze_on_srf_in_section(self,section=slice(0,None)):
         #section is a slice
-        #return number of gazepoints that are on surface in section
+        #return gazepoints that are on surface in section as Surface_Mapped_Data
         #If cache is not available on frames it is reported as not visible
         if self.cache is None:
             return []
-        gaze_on_srf = []
-        for frame_idx,c_e in enumerate(self.cache[section]):
-            frame_idx+=section.start
-            if c_e:
-                gaze_on_srf += [gp for gp in self.gaze_on_srf_by_frame_idx(frame_idx,c_e['m_from_screen']) if gp['on_srf']]
-        return gaze_on_srf
-
+        gaze = self.map_section_to_surface(self.g_pool.gaze_positions_by_frame, section)
+        return gaze.select(gaze.on_srf)
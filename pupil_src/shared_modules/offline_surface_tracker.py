@@ -17,11 +17,10 @@ import csv
 from ctypes import c_bool
 
 import gl_utils
-from itertools import chain
 from OpenGL.GL import *
 from methods import normalize
 from file_methods import Persistent_Dict
-from cache_list import Cache_List
+from marker_cache import Marker_Cache
 from glfw import *
 from pyglui import ui
 from pyglui.cygl.utils import *
@@ -35,6 +34,8 @@ logger = logging.getLogger(__name__)
 from surface_tracker import Surface_Tracker
 from square_marker_detect import draw_markers, m_marker_to_screen
 from offline_reference_surface import Offline_Reference_Surface
+from reference_surface import data_arrays
+from surface_export import surface_export_data, export_surface, gaze_on_srf_with_cv2
 
 import multiprocessing
 import platform
@@ -47,48 +48,60 @@ else:
 class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
     """
     Special version of surface tracker for use with videofile source.
-    It uses a seperate process to search all frames in the world video file for markers.
-     - self.cache is a list containing marker positions for each frame.
+    It uses a pool of seperate processes to search all frames in the world video file for markers.
+     - self.cache is a Marker_Cache containing marker positions for each frame.
      - self.surfaces[i].cache is a list containing surface positions for each frame
     Both caches are build up over time. The marker cache is also session persistent.
     See marker_tracker.py for more info on this marker tracker.
     """
 
-    def __init__(self,g_pool,mode="Show Markers and Surfaces",min_marker_perimeter = 100,invert_image=False,robust_detection=True):
-        super().__init__(g_pool,mode,min_marker_perimeter,invert_image,robust_detection,)
+    def __init__(self,g_pool,mode="Show Markers and Surfaces",min_marker_perimeter = 100,invert_image=False,robust_detection=True,roi_detection=False):
+        super().__init__(g_pool,mode,min_marker_perimeter,invert_image,robust_detection,roi_detection)
         self.order = .2
-        self.marker_cache_version = 2
+        self.marker_cache_version = 3
         self.min_marker_perimeter_cacher = 20  #find even super small markers. The surface locater will filter using min_marker_perimeter
         self.timeline_line_height = 16
+        self.heatmap_section = None
 
         self.load_marker_cache()
         self.init_marker_cacher()
         for s in self.surfaces:
-            s.init_cache(self.cache,self.min_marker_perimeter,self.min_id_confidence)
+            s.init_cache(self.cache,self.min_marker_perimeter,self.min_id_confidence,self.g_pool.capture.get_frame_index())
         self.recalculate()
 
     def load_marker_cache(self):
         #check if marker cache is available from last session
         self.persistent_cache = Persistent_Dict(os.path.join(self.g_pool.rec_dir,'square_marker_cache'))
         version = self.persistent_cache.get('version',0)
-        cache = self.persistent_cache.get('marker_cache',None)
-        if cache is None:
-            self.cache = Cache_List([False for _ in self.g_pool.timestamps])
+        legacy_cache = self.persistent_cache.pop('marker_cache',None)
+        self.cache = Marker_Cache(os.path.join(self.g_pool.rec_dir,'square_marker_cache'),len(self.g_pool.timestamps))
+        if version == 0:
+            self.cache.clear()
             self.persistent_cache['version'] = self.marker_cache_version
             self.persistent_cache['inverted_markers'] = self.invert_image
+        elif version == 2 and legacy_cache is not None and len(legacy_cache) == len(self.cache):
+            # convert msgpack marker cache of earlier versions to the compact format.
+            self.cache.clear()
+            for idx,markers in enumerate(legacy_cache):
+                if markers is not False:
+                    self.cache.update(idx,markers)
+            self.cache.save()
+            self.persistent_cache['version'] = self.marker_cache_version
+            self.invert_image = self.persistent_cache.get('inverted_markers',False)
+            logger.debug("Converted marker cache to version {}.".format(self.marker_cache_version))
         elif version != self.marker_cache_version:
             self.persistent_cache['version'] = self.marker_cache_version
             self.invert_image = self.persistent_cache.get('inverted_markers',False)
-            self.cache = Cache_List([False for _ in self.g_pool.timestamps])
+            self.cache.clear()
             logger.debug("Marker cache version missmatch. Rebuilding marker cache.")
         else:
-            self.cache = Cache_List(cache)
             #we overwrite the inverted_image setting from init with the one save in the marker cache.
             self.invert_image = self.persistent_cache.get('inverted_markers',False)
-            logger.debug("Loaded marker cache {} / {} frames had been searched before".format(len(self.cache)-self.cache.count(False),len(self.cache)) )
+            logger.debug("Loaded marker cache {} / {} frames had been searched before".format(self.cache.visited_count,len(self.cache)) )
+        del legacy_cache
 
     def clear_marker_cache(self):
-        self.cache = Cache_List([False for _ in self.g_pool.timestamps])
+        self.cache.clear()
         self.persistent_cache['version'] = self.marker_cache_version
 
     def load_surface_definitions_from_file(self):
@@ -137,8 +150,9 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
 
         def set_invert_image(val):
             self.invert_image = val
-            self.invalidate_marker_cache()
+            # surface tasks read the marker cache file, stop them first
             self.invalidate_surface_caches()
+            self.invalidate_marker_cache()
 
         self.menu.elements[:] = []
         self.menu.append(ui.Switch('invert_image',self,setter=set_invert_image,label='Use inverted markers'))
@@ -186,6 +200,7 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
         self.update_gui_markers()
 
     def remove_surface(self, i):
+        self.surfaces[i].cancel_cache_task()
         super().remove_surface(i)
         self.timeline.height -= self.timeline_line_height
 
@@ -195,10 +210,7 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
         out_mark = self.g_pool.seek_control.trim_right
         section = slice(in_mark,out_mark)
 
-        # calc heatmaps
-        for s in self.surfaces:
-            if s.defined:
-                s.generate_heatmap(section)
+        self.update_heatmaps(section)
 
         # calc distirbution accross all surfaces.
         results = []
@@ -225,9 +237,16 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             s.metrics_texture = Named_Texture()
             s.metrics_texture.update_from_ndarray(heatmap)
 
+    def update_heatmaps(self, section):
+        # heatmaps are differences of cumulative histograms, cheap enough to follow the trim marks
+        self.heatmap_section = section.start, section.stop
+        for s in self.surfaces:
+            if s.defined:
+                s.generate_heatmap(section)
+
     def invalidate_surface_caches(self):
         for s in self.surfaces:
-            s.cache = None
+            s.invalidate_cache()
 
     def recent_events(self,events):
         frame = events.get('frame')
@@ -242,6 +261,13 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             # tell precacher that it better have every thing from here on analyzed
             self.seek_marker_cacher(frame.index)
 
+        # collect surface locations computed in background
+        for s in self.surfaces:
+            if s.fetch_cache_task():
+                self.notify_all({'subject':'surfaces_changed','delay':1})
+            if s.cache_task and self.timeline:
+                self.timeline.refresh()
+
         events['surfaces'] = []
         # locate surfaces
         for s in self.surfaces:
@@ -250,6 +276,11 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             if s.detected:
                 events['surfaces'].append({'name':s.name,'uid':s.uid,'m_to_screen':s.m_to_screen.tolist(),'m_from_screen':s.m_from_screen.tolist(),'gaze_on_srf': s.gaze_on_srf, 'timestamp':frame.timestamp,'camera_pose_3d':s.camera_pose_3d.tolist() if s.camera_pose_3d is not None else None})
 
+        if self.mode == "Show Heatmaps":
+            section = self.g_pool.seek_control.trim_left, self.g_pool.seek_control.trim_right
+            if section != self.heatmap_section:
+                self.update_heatmaps(slice(*section))
+
         if self.mode == "Show marker IDs":
             draw_markers(frame.img,self.markers)
 
@@ -267,7 +298,7 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
                 # update srf with no or invald cache:
                 for s in self.surfaces:
                     if s.cache == None:
-                        s.init_cache(self.cache,self.min_marker_perimeter,self.min_id_confidence)
+                        s.init_cache(self.cache,self.min_marker_perimeter,self.min_id_confidence,frame.index)
                         self.notify_all({'subject':'surfaces_changed','delay':1})
 
         # allow surfaces to open/close windows
@@ -278,28 +309,31 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
                 s.open_window()
 
     def invalidate_marker_cache(self):
+        for s in self.surfaces:
+            s.cancel_cache_task()
         self.close_marker_cacher()
         self.clear_marker_cache()
         self.init_marker_cacher()
 
     def init_marker_cacher(self):
         from marker_detector_cacher import fill_cache
-        visited_list = [False if x is False else True for x in self.cache]
+        visited = self.cache.visited
         video_file_path =  self.g_pool.capture.source_path
         self.cache_queue = mp.Queue()
         self.cacher_seek_idx = mp.Value('i',0)
         self.cacher_run = mp.Value(c_bool,True)
-        self.cacher = mp.Process(target=fill_cache, args=(visited_list,video_file_path,self.cache_queue,self.cacher_seek_idx,self.cacher_run,self.min_marker_perimeter_cacher,self.invert_image))
+        self.cacher = mp.Process(target=fill_cache, args=(visited,video_file_path,self.cache_queue,self.cacher_seek_idx,self.cacher_run,self.min_marker_perimeter_cacher,self.invert_image))
         self.cacher.start()
 
     def update_marker_cache(self):
         while not self.cache_queue.empty():
-            idx,c_m = self.cache_queue.get()
-            self.cache.update(idx,c_m)
+            # the cacher workers report results in batches of (idx, markers)
+            for idx,c_m in self.cache_queue.get():
+                self.cache.update(idx,c_m)
 
-            for s in self.surfaces:
-                s.update_cache(self.cache, min_marker_perimeter=self.min_marker_perimeter,
-                               min_id_confidence=self.min_id_confidence, idx=idx)
+                for s in self.surfaces:
+                    s.update_cache(self.cache, min_marker_perimeter=self.min_marker_perimeter,
+                                   min_id_confidence=self.min_id_confidence, idx=idx)
             if self.cacher_run.value is False:
                 self.recalculate()
             if self.timeline:
@@ -341,19 +375,27 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             draw_polyline(cached_ranges, color=color, line_type=GL_LINES, thickness=scale * 4)
 
             # Lines where surfaces have been found in video
+            # and, while surface caches are being computed, where they have been searched
             cached_surfaces = []
             for s in self.surfaces:
                 found_at = []
+                searched = []
                 if s.cache is not None:
                     for r in s.cache.positive_ranges:  # [[0,1],[3,4]]
                         found_at += (r[0], 0), (r[1], 0)  # [(0,0),(1,0),(3,0),(4,0)]
-                    cached_surfaces.append(found_at)
+                    if s.cache_task:
+                        for r in s.cache.visited_ranges:
+                            searched += (r[0], 0), (r[1], 0)
+                cached_surfaces.append((found_at, searched))
 
             color = RGBA(0, .7, .3, .8)
+            progress_color = RGBA(.8, .6, .2, .4)
 
-            for s in cached_surfaces:
+            for found_at, searched in cached_surfaces:
                 glTranslatef(0, scale * self.timeline_line_height, 0)
-                draw_polyline(s, color=color, line_type=GL_LINES, thickness=scale * 2)
+                if searched:
+                    draw_polyline(searched, color=progress_color, line_type=GL_LINES, thickness=scale * 1)
+                draw_polyline(found_at, color=color, line_type=GL_LINES, thickness=scale * 2)
 
     def draw_labels(self, width, height, scale):
         self.glfont.set_size(self.timeline_line_height * .8 * scale)
@@ -422,20 +464,22 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             csv_writer = csv.writer(csvfile, delimiter=',')
 
             # gaze distribution report
-            gaze_in_section = list(chain(*self.g_pool.gaze_positions_by_frame[section]))
-            not_on_any_srf = set([gp['timestamp'] for gp in gaze_in_section])
+            gaze = data_arrays(self.g_pool.gaze_positions_by_frame)
+            start, stop, _ = section.indices(len(gaze.offsets) - 1)
+            gaze_ts_in_section = gaze.timestamp[gaze.offsets[start]:gaze.offsets[max(start, stop)]]
+            not_on_any_srf = np.unique(gaze_ts_in_section)
 
-            csv_writer.writerow(('total_gaze_point_count',len(gaze_in_section)))
+            csv_writer.writerow(('total_gaze_point_count',gaze_ts_in_section.shape[0]))
             csv_writer.writerow((''))
             csv_writer.writerow(('surface_name','gaze_count'))
 
             for s in self.surfaces:
-                gaze_on_srf  = s.gaze_on_srf_in_section(section)
-                gaze_on_srf = set([gp['base_data']['timestamp'] for gp in gaze_on_srf])
-                not_on_any_srf -= gaze_on_srf
-                csv_writer.writerow( (s.name, len(gaze_on_srf)) )
+                gaze_on_srf = gaze_on_srf_with_cv2(s, self.g_pool.gaze_positions_by_frame, section)
+                gaze_on_srf = np.unique(gaze_on_srf.timestamp) if len(gaze_on_srf) else np.empty(0)
+                not_on_any_srf = np.setdiff1d(not_on_any_srf, gaze_on_srf, assume_unique=True)
+                csv_writer.writerow( (s.name, gaze_on_srf.shape[0]) )
 
-            csv_writer.writerow(('not_on_any_surface', len(not_on_any_srf) ) )
+            csv_writer.writerow(('not_on_any_surface', not_on_any_srf.shape[0] ) )
             logger.info("Created 'surface_gaze_distribution.csv' file")
 
 
@@ -458,55 +502,21 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
             logger.info("Created 'surface_events.csv' file")
 
 
-        for s in self.surfaces:
-            # per surface names:
-            surface_name = '_'+s.name.replace('/','')+'_'+s.uid
-
-            #save surface_positions as csv
-            with open(os.path.join(metrics_dir,'srf_positons'+surface_name+'.csv'),'w',encoding='utf-8',newline='') as csvfile:
-                csv_writer =csv.writer(csvfile, delimiter=',')
-                csv_writer.writerow(('frame_idx','timestamp','m_to_screen','m_from_screen','detected_markers'))
-                for idx,ts,ref_srf_data in zip(range(len(self.g_pool.timestamps)),self.g_pool.timestamps,s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            csv_writer.writerow( (idx,ts,ref_srf_data['m_to_screen'],ref_srf_data['m_from_screen'],ref_srf_data['detected_markers']) )
-
-
-            # save gaze on srf as csv.
-            with open(os.path.join(metrics_dir,'gaze_positions_on_surface'+surface_name+'.csv'),'w',encoding='utf-8',newline='') as csvfile:
-                csv_writer = csv.writer(csvfile, delimiter=',')
-                csv_writer.writerow(('world_timestamp','world_frame_idx','gaze_timestamp','x_norm','y_norm','x_scaled','y_scaled','on_srf'))
-                for idx,ts,ref_srf_data in zip(range(len(self.g_pool.timestamps)),self.g_pool.timestamps,s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            for gp in s.gaze_on_srf_by_frame_idx(idx,ref_srf_data['m_from_screen']):
-                                csv_writer.writerow( (ts,idx,gp['base_data']['timestamp'],gp['norm_pos'][0],gp['norm_pos'][1],gp['norm_pos'][0]*s.real_world_size['x'],gp['norm_pos'][1]*s.real_world_size['y'],gp['on_srf']) )
-
-
-            # save fixation on srf as csv.
-            with open(os.path.join(metrics_dir,'fixations_on_surface'+surface_name+'.csv'),'w',encoding='utf-8',newline='') as csvfile:
-                csv_writer = csv.writer(csvfile, delimiter=',')
-                csv_writer.writerow(('id','start_timestamp','duration','start_frame','end_frame','norm_pos_x','norm_pos_y','x_scaled','y_scaled','on_srf'))
-                fixations_on_surface = []
-                for idx,ref_srf_data in zip(range(len(self.g_pool.timestamps)),s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            for f in s.fixations_on_srf_by_frame_idx(idx,ref_srf_data['m_from_screen']):
-                                fixations_on_surface.append(f)
-
-                removed_duplicates = dict([(f['base_data']['id'],f) for f in fixations_on_surface]).values()
-                for f_on_s in removed_duplicates:
-                    f = f_on_s['base_data']
-                    f_x,f_y = f_on_s['norm_pos']
-                    f_on_srf = f_on_s['on_srf']
-                    csv_writer.writerow( (f['id'],f['timestamp'],f['duration'],f['start_frame_index'],f['end_frame_index'],f_x,f_y,f_x*s.real_world_size['x'],f_y*s.real_world_size['y'],f_on_srf) )
-
-
-            logger.info("Saved surface positon gaze and fixation data for '{}' with uid:'{}'".format(s.name,s.uid))
-
-            if s.heatmap is not None:
+        # per surface files are written in parallel by worker processes
+        export_data = [surface_export_data(s, self.g_pool.timestamps, self.g_pool.gaze_positions_by_frame,
+                                           self.g_pool.fixations_by_frame, in_mark, out_mark) for s in self.surfaces]
+        if len(export_data) > 1:
+            pool = mp.Pool(min(len(export_data), mp.cpu_count()))
+            results = pool.starmap(export_surface, [(metrics_dir, srf) for srf in export_data])
+            pool.close()
+            pool.join()
+        else:
+            results = [export_surface(metrics_dir, srf) for srf in export_data]
+
+        for name, uid, saved_heatmap in results:
+            logger.info("Saved surface positon gaze and fixation data for '{}' with uid:'{}'".format(name,uid))
+            if saved_heatmap:
                 logger.info("Saved Heatmap as .png file.")
-                cv2.imwrite(os.path.join(metrics_dir,'heatmap'+surface_name+'.png'),s.heatmap)
 
 
         logger.info("Done exporting reference surface data.")
@@ -543,8 +553,9 @@ class Offline_Surface_Tracker(Surface_Tracker, Analysis_Plugin_Base):
 
         self.close_marker_cacher()
         self.persistent_cache['inverted_markers'] = self.invert_image
-        self.persistent_cache["marker_cache"] = self.cache.to_list()
         self.persistent_cache.close()
+        self.cache.close()
 
         for s in self.surfaces:
+            s.cancel_cache_task()
             s.close_window()
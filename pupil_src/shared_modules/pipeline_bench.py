@@ -0,0 +1,260 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Headless benchmark of the eye to gaze pipeline with synthetic frames, no cameras,
+windows or OpenGL needed:
+
+    python pipeline_bench.py [--source pupil | path/to/eye0.mp4] [--frames 2000] [--rate 0]
+                             [--size 192x192] [--detector 2d|3d|none] [--record] [--threaded-writer]
+
+Every frame passes these stages:
+    capture: make the synthetic frame (see synthetic_frames.py)
+    detect:  pupil detection, the ground truth pupil is used with --detector none
+    ipc:     pupil datum through an XSUB/XPUB proxy over tcp loopback, like the IPC backbone
+    map:     gaze mapping with a Monocular_Gaze_Mapper
+    record:  write the frame with AV_Writer (--record)
+--rate 0 runs as fast as possible. Frame timestamps are spaced by 1/rate
+(or 1/30s) so the pipeline sees a regular stream faster than real time.
+Stages whose modules are not available are skipped.
+'''
+
+import os
+import tempfile
+import threading
+from time import perf_counter, sleep
+import numpy as np
+import zmq
+import zmq_tools
+from synthetic_frames import Synthetic_Frame, Moving_Pupil_Generator, Video_Replay_Generator
+import logging
+logger = logging.getLogger(__name__)
+
+stages = ('capture', 'detect', 'ipc', 'map', 'record')
+
+
+class Stage_Stats(object):
+    """Durations of one pipeline stage"""
+
+    def __init__(self):
+        self.durations = []
+
+    def add(self, duration):
+        self.durations.append(duration)
+
+    def summary(self):
+        d = np.array(self.durations) * 1e3
+        return {'count': d.shape[0], 'per_s': 1e3 / d.mean(), 'mean_ms': d.mean(), 'p50_ms': np.median(d),
+                'p95_ms': np.percentile(d, 95), 'p99_ms': np.percentile(d, 99), 'max_ms': d.max()}
+
+
+class G_Pool(object):
+    pass
+
+
+def ground_truth_datum(generator, frame, eye_id=0):
+    '''pupil datum of the generated pupil, used instead of detection'''
+    pupil = generator.pupil(frame.index)
+    w, h = generator.frame_size
+    return {'topic': 'pupil', 'id': eye_id, 'timestamp': frame.timestamp, 'confidence': 1.,
+            'norm_pos': (pupil['center'][0] / w, 1 - pupil['center'][1] / h),
+            'diameter': max(pupil['axes']), 'method': '2d c++', 'ellipse': pupil}
+
+
+def make_detector(name):
+    if name == 'none':
+        return None
+    try:
+        # builds the detectors when running from source, which fails without the build dependencies
+        from pupil_detectors import Detector_2D, Detector_3D
+        from methods import Roi
+    except Exception as e:
+        logger.warning('Detection skipped, using ground truth: {}'.format(e))
+        return None
+    g_pool = G_Pool()
+    detector = (Detector_3D if name == '3d' else Detector_2D)(g_pool)
+    roi = None
+
+    def detect(frame):
+        nonlocal roi
+        if roi is None:
+            roi = Roi(frame.img.shape)
+        return detector.detect(frame, roi, False)
+    return detect
+
+
+def make_mapper():
+    try:
+        from calibration_routines.gaze_mappers import Monocular_Gaze_Mapper
+    except ImportError as e:
+        logger.warning('Gaze mapping skipped: {}'.format(e))
+        return None
+    # identity mapping, 7 parameter polynomial
+    params = ((1., 0., 0., 0., 0., 0., 0.), (0., 1., 0., 0., 0., 0., 0.), 7)
+    return Monocular_Gaze_Mapper(G_Pool(), params).on_pupil_datum
+
+
+def make_writer(path, fps, threaded):
+    try:
+        from av_writer import AV_Writer, Async_Writer
+    except ImportError as e:
+        logger.warning('Recording skipped: {}'.format(e))
+        return None
+    writer = AV_Writer(path, fps=fps)
+    return Async_Writer(writer, overflow='block') if threaded else writer
+
+
+class IPC_Loop(object):
+    """Msg_Streamer -> XSUB/XPUB proxy -> Msg_Receiver over tcp loopback"""
+
+    def __init__(self, ctx):
+        xsub = ctx.socket(zmq.XSUB)
+        xpub = ctx.socket(zmq.XPUB)
+        pub_port = xsub.bind_to_random_port('tcp://127.0.0.1')
+        sub_port = xpub.bind_to_random_port('tcp://127.0.0.1')
+        self.control = ctx.socket(zmq.PAIR)
+        self.control.bind('inproc://pipeline_bench_proxy')
+        control = ctx.socket(zmq.PAIR)
+        control.connect('inproc://pipeline_bench_proxy')
+        self.proxy_thread = threading.Thread(target=self._proxy, args=(xsub, xpub, control), daemon=True)
+        self.proxy_thread.start()
+        self.pub = zmq_tools.Msg_Streamer(ctx, 'tcp://127.0.0.1:{}'.format(pub_port))
+        self.sub = zmq_tools.Msg_Receiver(ctx, 'tcp://127.0.0.1:{}'.format(sub_port), topics=('pupil',))
+        # wait until the subscription reached the publisher
+        while True:
+            self.pub.send('pupil.warmup', {'topic': 'pupil.warmup'})
+            if self.sub.socket.poll(10):
+                break
+        while self.sub.new_data:
+            self.sub.recv()
+
+    @staticmethod
+    def _proxy(xsub, xpub, control):
+        zmq.proxy_steerable(xsub, xpub, None, control)
+        for socket in (xsub, xpub, control):
+            socket.close(linger=0)
+
+    def roundtrip(self, datum):
+        self.pub.send('pupil.{}'.format(datum['id']), datum)
+        topic, datum = self.sub.recv()
+        return datum
+
+    def close(self):
+        self.control.send(b'TERMINATE')
+        self.proxy_thread.join()
+        self.control.close(linger=0)
+        self.pub.socket.close(linger=0)
+        self.sub.socket.close(linger=0)
+
+
+def run(generator, frame_count=2000, rate=0., detector='2d', record=False, threaded_writer=False):
+    '''run frame_count frames through the pipeline and return the stage stats'''
+    stats = {stage: Stage_Stats() for stage in stages}
+    latency = Stage_Stats()
+    detect = make_detector(detector)
+    map_gaze = make_mapper()
+    ctx = zmq.Context()
+    ipc = IPC_Loop(ctx)
+    writer = None
+    rec_dir = None
+    if record:
+        rec_dir = tempfile.mkdtemp(prefix='pipeline_bench_')
+        writer = make_writer(os.path.join(rec_dir, 'eye0.mp4'), rate or 30, threaded_writer)
+    errors = []
+
+    frame_interval = 1. / (rate or 30.)
+    start = perf_counter()
+    for index in range(frame_count):
+        if rate:
+            # pace like a camera, do not try to catch up on late frames
+            wait = start + index * frame_interval - perf_counter()
+            if wait > 0:
+                sleep(wait)
+        t0 = perf_counter()
+        frame = Synthetic_Frame(index * frame_interval, generator.make_image(index), index)
+        t1 = perf_counter()
+        stats['capture'].add(t1 - t0)
+
+        if detect:
+            datum = detect(frame)
+            datum['id'] = 0
+            if hasattr(generator, 'pupil') and datum['confidence'] > .6:
+                truth = generator.pupil(index)['center']
+                errors.append(np.hypot(datum['ellipse']['center'][0] - truth[0], datum['ellipse']['center'][1] - truth[1]))
+            t2 = perf_counter()
+            stats['detect'].add(t2 - t1)
+        else:
+            datum = ground_truth_datum(generator, frame) if hasattr(generator, 'pupil') else \
+                {'topic': 'pupil', 'id': 0, 'timestamp': frame.timestamp, 'confidence': 1., 'norm_pos': (.5, .5)}
+            t2 = perf_counter()
+
+        datum = ipc.roundtrip(datum)
+        t3 = perf_counter()
+        stats['ipc'].add(t3 - t2)
+
+        if map_gaze:
+            map_gaze(datum)
+            t4 = perf_counter()
+            stats['map'].add(t4 - t3)
+        else:
+            t4 = t3
+        latency.add(t4 - t0)
+
+        if writer:
+            writer.write_video_frame(frame)
+            stats['record'].add(perf_counter() - t4)
+
+    if writer:
+        release_start = perf_counter()
+        writer.release()
+        logger.info('Flushing the writer took {:.1f} ms'.format(1e3 * (perf_counter() - release_start)))
+    duration = perf_counter() - start
+    ipc.close()
+    ctx.term()
+    return {'frames': frame_count, 'duration': duration, 'fps': frame_count / duration,
+            'stages': {stage: s.summary() for stage, s in stats.items() if s.durations},
+            'latency': latency.summary(),
+            'detection_error_px': float(np.median(errors)) if errors else None,
+            'rec_dir': rec_dir}
+
+
+def print_report(report):
+    print('{frames} frames in {duration:.2f} s: {fps:.1f} frames/s'.format(**report))
+    print('{:<10} {:>10} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'per s', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'))
+    rows = [(stage, report['stages'][stage]) for stage in stages if stage in report['stages']]
+    rows.append(('latency', report['latency']))
+    for name, s in rows:
+        print('{:<10} {per_s:>10.1f} {mean_ms:>9.3f} {p50_ms:>9.3f} {p95_ms:>9.3f} {max_ms:>9.3f}'.format(name, **s))
+    if report['detection_error_px'] is not None:
+        print('median pupil center error: {:.2f} px'.format(report['detection_error_px']))
+    if report['rec_dir']:
+        print('recording: {}'.format(report['rec_dir']))
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Benchmark the eye to gaze pipeline with synthetic frames.')
+    parser.add_argument('--source', default='pupil', help='"pupil" for generated frames or a video file to replay')
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0., help='frames per second, 0 runs as fast as possible')
+    parser.add_argument('--size', default='192x192', help='size of generated frames')
+    parser.add_argument('--detector', choices=('2d', '3d', 'none'), default='2d')
+    parser.add_argument('--record', action='store_true', help='write the frames with AV_Writer')
+    parser.add_argument('--threaded-writer', action='store_true', help='encode on a separate thread')
+    args = parser.parse_args()
+
+    if args.source == 'pupil':
+        generator = Moving_Pupil_Generator(tuple(int(v) for v in args.size.split('x')))
+    else:
+        generator = Video_Replay_Generator(args.source, max_frames=args.frames)
+    report = run(generator, args.frames, args.rate, args.detector, args.record, args.threaded_writer)
+    print_report(report)
@@ -11,7 +11,8 @@ See COPYING and COPYING.LESSER for license details.
 import os
 import sys
 import importlib
-from time import time
+from time import time, perf_counter
+import plugin_timing
 import logging
 logger = logging.getLogger(__name__)
 '''
@@ -176,7 +177,8 @@ class Plugin(object):
 
             adding 'delay':3.2 will delay the notification for 3.2s.
             If a new delayed notification of same subject is sent before 3.2s
-            have passed we will discard the former notification.
+            have passed we will discard the former notification,
+            unless the new one has 'allow_duplicates':True.
 
         You may add more fields as you like.
 
@@ -269,9 +271,17 @@ class Plugin_List(object):
     """This is the Plugin Manager
         It is a self sorting list with a few functions to manage adding and
         removing Plugins and lacking most other list methods.
+
+        recent_events, on_notify and gl_display call the hook of every plugin
+        and measure them while plugin timing is enabled (see plugin_timing.py).
+
+        Reacts to notifications:
+            ``plugin_timing.should_start``: Measure hook durations, publish ``stats.plugins``
+            ``plugin_timing.should_stop``: Stop measuring
     """
     def __init__(self, g_pool, plugin_initializers):
         self._plugins = []
+        self.timing = None
         self.g_pool = g_pool
         plugin_by_name = g_pool.plugin_by_name
 
@@ -338,6 +348,45 @@ class Plugin_List(object):
                 logger.debug("Unloaded Plugin: {}".format(p))
                 self._plugins.remove(p)
 
+    def recent_events(self, events):
+        if self.timing is None:
+            for p in self._plugins:
+                p.recent_events(events)
+        else:
+            self._timed_call('recent_events', events)
+            if self.timing.report_due(perf_counter()):
+                report = self.timing.report()
+                report.update({'topic': plugin_timing.stats_topic, 'process': self.g_pool.app,
+                               'timestamp': self.g_pool.get_timestamp()})
+                self.g_pool.ipc_pub.send(plugin_timing.stats_topic, report)
+
+    def on_notify(self, notification):
+        subject = notification['subject']
+        if subject == 'plugin_timing.should_start':
+            self.timing = plugin_timing.Plugin_Timing(notification.get('interval', 1.),
+                                                      notification.get('window', 300))
+        elif subject == 'plugin_timing.should_stop':
+            self.timing = None
+
+        if self.timing is None:
+            for p in self._plugins:
+                p.on_notify(notification)
+        else:
+            self._timed_call('on_notify', notification)
+
+    def gl_display(self):
+        if self.timing is None:
+            for p in self._plugins:
+                p.gl_display()
+        else:
+            self._timed_call('gl_display')
+
+    def _timed_call(self, hook, *args):
+        for p in self._plugins:
+            start = perf_counter()
+            getattr(p, hook)(*args)
+            self.timing.add(p.class_name, hook, perf_counter() - start)
+
     def get_initializers(self):
         initializers = []
         for p in self._plugins:
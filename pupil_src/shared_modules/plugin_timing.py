@@ -0,0 +1,115 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Wall time spent in the hooks of each plugin.
+
+Plugin_List measures recent_events, on_notify and gl_display of every plugin
+while timing is enabled with the notification:
+    {'subject': 'plugin_timing.should_start', 'interval': 1., 'window': 300}
+and stops with {'subject': 'plugin_timing.should_stop'}.
+
+Every `interval` seconds each process publishes on the IPC:
+    {'topic': 'stats.plugins', 'process': g_pool.app, 'timestamp': pupil time,
+     'bin_edges_ms': histogram bin edges,
+     'plugins': {plugin class name: {hook: {'calls', 'total_ms', 'mean_ms', 'max_ms',
+                                            'p50_ms', 'p95_ms', 'p99_ms', 'histogram'}}}}
+Calls, totals, max and histograms count from the start of timing,
+percentiles are taken of the last `window` calls.
+'''
+
+from bisect import bisect
+from collections import deque
+
+stats_topic = 'stats.plugins'
+# upper edges of the histogram bins, the last bin counts everything above
+bin_edges_ms = (.01, .02, .05, .1, .2, .5, 1., 2., 5., 10., 20., 50., 100., 200., 500.)
+_bin_edges = tuple(edge / 1e3 for edge in bin_edges_ms)
+
+
+def percentile(sorted_values, q):
+    '''nearest rank percentile of a sorted, non empty sequence'''
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100. * len(sorted_values)))]
+
+
+class Hook_Stats(object):
+    """Durations of one hook of one plugin"""
+
+    __slots__ = ('calls', 'total', 'max', 'histogram', 'recent')
+
+    def __init__(self, window):
+        self.calls = 0
+        self.total = 0.
+        self.max = 0.
+        self.histogram = [0] * (len(_bin_edges) + 1)
+        self.recent = deque(maxlen=window)
+
+    def add(self, duration):
+        self.calls += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[bisect(_bin_edges, duration)] += 1
+        self.recent.append(duration)
+
+    def to_dict(self):
+        recent = sorted(self.recent)
+        return {'calls': self.calls,
+                'total_ms': 1e3 * self.total,
+                'mean_ms': 1e3 * self.total / self.calls,
+                'max_ms': 1e3 * self.max,
+                'p50_ms': 1e3 * percentile(recent, 50),
+                'p95_ms': 1e3 * percentile(recent, 95),
+                'p99_ms': 1e3 * percentile(recent, 99),
+                'histogram': list(self.histogram)}
+
+
+class Plugin_Timing(object):
+    """Hook durations of all plugins of one Plugin_List"""
+
+    def __init__(self, interval=1., window=300):
+        self.interval = interval
+        self.window = window
+        self.stats = {}  # plugin class name: {hook: Hook_Stats}
+        self.next_report = None
+
+    def add(self, plugin_name, hook, duration):
+        try:
+            self.stats[plugin_name][hook].add(duration)
+        except KeyError:
+            self.stats.setdefault(plugin_name, {})[hook] = Hook_Stats(self.window)
+            self.stats[plugin_name][hook].add(duration)
+
+    def recent(self, plugin_name, hook='recent_events'):
+        '''last duration of a hook or None'''
+        try:
+            return self.stats[plugin_name][hook].recent[-1]
+        except (KeyError, IndexError):
+            return None
+
+    def report_due(self, now):
+        if self.next_report is None:
+            self.next_report = now + self.interval
+        elif now >= self.next_report:
+            self.next_report = now + self.interval
+            return True
+        return False
+
+    def report(self):
+        return {'bin_edges_ms': list(bin_edges_ms),
+                'plugins': {name: {hook: stats.to_dict() for hook, stats in hooks.items()}
+                            for name, hooks in self.stats.items()}}
+
+    def slowest(self, count, hook='recent_events'):
+        '''class names of the plugins with the highest 95th percentile of a hook'''
+        p95 = [(percentile(sorted(hooks[hook].recent), 95), name)
+               for name, hooks in self.stats.items() if hook in hooks]
+        return [name for _, name in sorted(p95, reverse=True)[:count]]
@@ -19,7 +19,8 @@ class Pupil_Data_Relay(System_Plugin_Base):
     def __init__(self, g_pool):
         super().__init__(g_pool)
         self.order = .01
-        self.gaze_pub = zmq_tools.Msg_Streamer(self.g_pool.zmq_ctx,self.g_pool.ipc_pub_url)
+        # gaze is batched after a `data_batching.started` notification
+        self.gaze_pub = zmq_tools.Msg_Batch_Streamer(self.g_pool.zmq_ctx,self.g_pool.ipc_pub_url,max_count=1)
         self.pupil_sub = zmq_tools.Msg_Receiver(self.g_pool.zmq_ctx,self.g_pool.ipc_sub_url,topics=('pupil',))
 
     def recent_events(self, events):
@@ -33,6 +34,23 @@ class Pupil_Data_Relay(System_Plugin_Base):
             for g in new_gaze_data:
                 self.gaze_pub.send('gaze', g)
             recent_gaze_data += new_gaze_data
+        self.gaze_pub.flush()
 
         events['pupil_positions'] = recent_pupil_data
         events['gaze_positions'] = recent_gaze_data
+
+    def on_notify(self, notification):
+        if notification['subject'] == 'data_batching.started':
+            self.gaze_pub.max_count = notification.get('max_count', 10)
+            self.gaze_pub.max_delay = notification.get('max_delay', .01)
+        elif notification['subject'] == 'data_batching.stopped':
+            self.gaze_pub.flush(force=True)
+            self.gaze_pub.max_count = 1
+        elif notification['subject'] == 'compact_encoding.started':
+            self.gaze_pub.compact = True
+        elif notification['subject'] == 'compact_encoding.stopped':
+            self.gaze_pub.compact = False
+        elif notification['subject'] == 'sequence_numbers.started':
+            self.gaze_pub.sequence_numbers = True
+        elif notification['subject'] == 'sequence_numbers.stopped':
+            self.gaze_pub.sequence_numbers = False
@@ -9,11 +9,13 @@ See COPYING and COPYING.LESSER for license details.
 ---------------------------------------------------------------------------~(*)
 '''
 
-from time import sleep
+from time import sleep, perf_counter
 import socket
 import audio
 import zmq
 import zmq_tools
+import filtered_relay
+import plugin_timing
 from pyre import zhelper
 from pyglui import ui
 from plugin import Plugin
@@ -38,9 +40,35 @@ class Pupil_Remote(Plugin):
         'PUB_PORT' return the current pub port of the IPC Backbone
         'SUB_PORT' return the current sub port of the IPC Backbone
 
+        'STATS' returns a msgpack serialized dict with the number of requests and
+                the mean and max handling time in ms for each command.
+
+        'FILTER' + a msgpack serialized subscription spec registers a filtered,
+                rate limited subscription, see filtered_relay.py.
+                Returns a msgpack serialized dict with 'port' and 'topic' to subscribe to.
+
+        'PLUGIN_STATS' starts plugin timing (see plugin_timing.py) and returns a msgpack
+                serialized dict with the latest 'stats.plugins' report of each process.
+                The first request returns an empty dict.
+        'PLUGIN_STATS stop' stops plugin timing.
+
     Mulitpart messages conforming to pattern:
         part1: 'notify.' part2: a msgpack serialized dict with at least key 'subject':'my_notification_subject'
         will be forwared to the Pupil IPC Backbone.
+        part1: 'BATCH' part2: a msgpack serialized list of such dicts
+        forwards several notifications with one request.
+
+    The server uses a ROUTER socket. REQ clients work as before.
+    DEALER clients can send requests without waiting for replies (pipelining).
+    Requests from different clients are handled in the order they arrive.
+    To match replies to requests, a frame starting with '#' can be sent before
+    the command (after the empty delimiter frame), it is sent back in front of the reply:
+        socket = context.socket(zmq.DEALER)
+        socket.connect('tcp://127.0.0.1:50020')
+        for i in range(10):
+            socket.send_multipart((b'', '#{}'.format(i).encode(), b't'))
+        for i in range(10):
+            _, request_id, timestamp = socket.recv_multipart()
 
 
     A example script for talking with pupil remote below:
@@ -72,11 +100,20 @@ class Pupil_Remote(Plugin):
     """
     icon_chr = chr(0xe307)
     icon_font = 'pupil_icons'
+    # requests served before the thread pipe is checked again
+    max_requests_per_poll = 100
 
     def __init__(self, g_pool, port="50020", host="*", use_primary_interface=True):
         super().__init__(g_pool)
         self.order = .01  # excecute first
         self.context = g_pool.zmq_ctx
+        # command: [count, total and max handling time], only used by the server thread
+        self.command_stats = {}
+        # pipe to the filtered_relay thread, started by the first FILTER request
+        self.relay_pipe = None
+        # subscription to stats.plugins, made by the first PLUGIN_STATS request
+        self.plugin_stats_sub = None
+        self.plugin_stats = {}  # process: latest report
         self.thread_pipe = zhelper.zthread_fork(self.context, self.thread_loop)
 
         self.use_primary_interface = use_primary_interface
@@ -162,7 +199,7 @@ class Pupil_Remote(Plugin):
                 self.start_server('tcp://'+new_address)
                 self.update_menu()
 
-        help_str = 'Pupil Remote using ZeroMQ REQ REP scheme.'
+        help_str = 'Pupil Remote using ZeroMQ REQ REP or DEALER ROUTER scheme.'
         self.menu.append(ui.Info_Text(help_str))
         self.menu.append(ui.Switch('use_primary_interface', self, setter=set_iface, label="Use primary network interface"))
         if self.use_primary_interface:
@@ -193,7 +230,7 @@ class Pupil_Remote(Plugin):
                         poller.unregister(remote_socket)
                         remote_socket.close(linger=0)
                     try:
-                        remote_socket = context.socket(zmq.REP)
+                        remote_socket = context.socket(zmq.ROUTER)
                         remote_socket.bind(new_url)
                     except zmq.ZMQError as e:
                         remote_socket = None
@@ -205,32 +242,119 @@ class Pupil_Remote(Plugin):
                         pipe.send(remote_socket.last_endpoint.replace(b"tcp://", b""))
                         poller.register(remote_socket, zmq.POLLIN)
             if remote_socket in items:
-                self.on_recv(remote_socket, ipc_pub)
-
+                # serve queued requests of all clients, the pipe is polled again in between
+                for _ in range(self.max_requests_per_poll):
+                    if not remote_socket.get(zmq.EVENTS) & zmq.POLLIN:
+                        break
+                    self.on_recv(remote_socket, ipc_pub)
+
+        if self.relay_pipe:
+            self.relay_pipe.send_string('Exit')
+            self.relay_pipe = None
+        self.plugin_stats_sub = None
         self.thread_pipe = None
 
     def on_recv(self, socket, ipc_pub):
-        msg = socket.recv_string()
+        received = perf_counter()
+        frames = socket.recv_multipart(copy=False)
+        # ROUTER envelope: client identity, empty delimiter (REQ and most DEALER clients)
+        envelope = frames[:1]
+        if len(frames) > 1 and not frames[1].bytes:
+            envelope = frames[:2]
+        request = frames[len(envelope):]
+        # optional request id of pipelining clients
+        if len(request) > 1 and request[0].bytes.startswith(b'#'):
+            envelope.append(request.pop(0))
+        if not request:
+            return
+        command, response = self.handle_command(request[0], request[1:], ipc_pub)
+        if isinstance(response, str):
+            response = response.encode('utf-8')
+        socket.send_multipart(envelope + [response], copy=False)
+
+        stats = self.command_stats.setdefault(command, [0, 0., 0.])
+        duration = perf_counter() - received
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+    def handle_command(self, msg_frame, payload_frames, ipc_pub):
+        '''returns the command name used for the stats and the response'''
+        try:
+            msg = msg_frame.bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            return 'unknown', 'Command is not utf-8 encoded.'
         if msg.startswith('notify'):
             try:
-                payload = zmq_tools.serializer.loads(socket.recv(flags=zmq.NOBLOCK), encoding='utf-8')
+                payload = zmq_tools.serializer.loads(payload_frames[0].bytes, encoding='utf-8')
                 payload['subject']
             except Exception as e:
                 response = 'Notification mal-formatted or missing: {}'.format(e)
             else:
                 ipc_pub.notify(payload)
                 response = 'Notification recevied.'
+            return 'notify', response
+        elif msg == 'BATCH':
+            try:
+                notifications = zmq_tools.serializer.loads(payload_frames[0].bytes, encoding='utf-8')
+                for n in notifications:
+                    n['subject']
+            except Exception as e:
+                response = 'Notification batch mal-formatted or missing: {}'.format(e)
+            else:
+                for n in notifications:
+                    ipc_pub.notify(n)
+                response = '{} notifications recevied.'.format(len(notifications))
+            return msg, response
+        elif msg == 'STATS':
+            return msg, zmq_tools.serializer.dumps({command: {'count': count, 'mean_ms': 1e3 * total / count, 'max_ms': 1e3 * max_duration}
+                                                    for command, (count, total, max_duration) in self.command_stats.items()},
+                                                   use_bin_type=True)
+        elif msg == 'FILTER':
+            if not payload_frames:
+                return msg, 'Filter spec missing.'
+            if self.relay_pipe is None:
+                self.relay_pipe = zhelper.zthread_fork(self.context, filtered_relay.relay_loop,
+                                                       self.g_pool.ipc_sub_url, 'tcp://{}:*'.format(self.host))
+            self.relay_pipe.send_string('Add', flags=zmq.SNDMORE)
+            self.relay_pipe.send(payload_frames[0].bytes)
+            if self.relay_pipe.recv_string() == 'OK':
+                return msg, self.relay_pipe.recv()
+            return msg, self.relay_pipe.recv_string()
+        elif msg == 'PLUGIN_STATS':
+            if self.plugin_stats_sub is None:
+                self.plugin_stats_sub = zmq_tools.Msg_Receiver(self.context, self.g_pool.ipc_sub_url,
+                                                               topics=(plugin_timing.stats_topic,),
+                                                               block_until_connected=False)
+                ipc_pub.notify({'subject': 'plugin_timing.should_start'})
+            while self.plugin_stats_sub.new_data:
+                topic, report = self.plugin_stats_sub.recv()
+                self.plugin_stats[report['process']] = report
+            return msg, zmq_tools.serializer.dumps(self.plugin_stats, use_bin_type=True)
+        elif msg == 'PLUGIN_STATS stop':
+            ipc_pub.notify({'subject': 'plugin_timing.should_stop'})
+            self.plugin_stats_sub = None
+            self.plugin_stats = {}
+            return 'PLUGIN_STATS', 'OK'
         elif msg == 'SUB_PORT':
             response = self.g_pool.ipc_sub_url.split(':')[-1]
+            if not self.is_local_peer(msg_frame):
+                # frames published through shared memory cannot be read by this subscriber
+                ipc_pub.notify({'subject': 'frame_publishing.remote_subscriber'})
+            return msg, response
         elif msg == 'PUB_PORT':
-            response = self.g_pool.ipc_pub_url.split(':')[-1]
-        elif msg[0] == 'R':
+            return msg, self.g_pool.ipc_pub_url.split(':')[-1]
+        elif not msg:
+            return msg, 'Unknown command.'
+
+        command = msg[0]
+        if command == 'R':
             try:
                 ipc_pub.notify({'subject': 'recording.should_start', 'session_name': msg[2:]})
                 response = 'OK'
             except IndexError:
                 response = 'Recording command mal-formatted.'
-        elif msg[0] == 'r':
+        elif command == 'r':
             ipc_pub.notify({'subject': 'recording.should_stop'})
             response = 'OK'
         elif msg == 'C':
@@ -239,7 +363,7 @@ class Pupil_Remote(Plugin):
         elif msg == 'c':
             ipc_pub.notify({'subject': 'calibration.should_stop'})
             response = 'OK'
-        elif msg[0] == 'T':
+        elif command == 'T':
             try:
                 target = float(msg[2:])
             except:
@@ -248,13 +372,23 @@ class Pupil_Remote(Plugin):
                 raw_time = self.g_pool.get_now()
                 self.g_pool.timebase.value = raw_time-target
                 response = 'Timesync successful.'
-        elif msg[0] == 't':
+        elif command == 't':
             response = repr(self.g_pool.get_timestamp())
-        elif msg[0] == 'v':
+        elif command == 'v':
             response = '{}'.format(self.g_pool.version)
         else:
+            command = 'unknown'
             response = 'Unknown command.'
-        socket.send_string(response)
+        return command, response
+
+    @staticmethod
+    def is_local_peer(msg_frame):
+        try:
+            peer = msg_frame.get('Peer-Address')
+        except (zmq.ZMQError, AttributeError, TypeError):
+            # peer address is not available for all transports and libzmq versions
+            return True
+        return peer in ('127.0.0.1', '::1', '::ffff:127.0.0.1')
 
     def on_notify(self, notification):
         """send simple string messages to control application functions.
@@ -264,6 +398,7 @@ class Pupil_Remote(Plugin):
             ``recording.should_stop``
             ``calibration.should_start``
             ``calibration.should_stop``
+            ``frame_publishing.remote_subscriber``: A remote client asked for the SUB port
             Any other notification received though the reqrepl port.
         """
         pass
@@ -20,7 +20,7 @@ from time import strftime, localtime, time, gmtime
 from shutil import copy2
 from file_methods import save_object, load_object
 from methods import get_system_info
-from av_writer import JPEG_Writer, AV_Writer
+from av_writer import JPEG_Writer, AV_Writer, Async_Writer
 from ndsi import H264Writer
 # logging
 import logging
@@ -86,7 +86,7 @@ class Recorder(System_Plugin_Base):
     def __init__(self, g_pool, session_name=get_auto_name(), rec_dir=None,
                  user_info={'name': '', 'additional_field': 'change_me'},
                  info_menu_conf={}, show_info_menu=False, record_eye=False,
-                 raw_jpeg=True):
+                 raw_jpeg=True, threaded_writer=False):
         super().__init__(g_pool)
         # update name if it was autogenerated.
         if session_name.startswith('20') and len(session_name) == 10:
@@ -109,6 +109,7 @@ class Recorder(System_Plugin_Base):
             self.rec_dir = default_rec_dir
 
         self.raw_jpeg = raw_jpeg
+        self.threaded_writer = threaded_writer
         self.order = .9
         self.record_eye = record_eye
         self.session_name = session_name
@@ -130,6 +131,7 @@ class Recorder(System_Plugin_Base):
         d['show_info_menu'] = self.show_info_menu
         d['rec_dir'] = self.rec_dir
         d['raw_jpeg'] = self.raw_jpeg
+        d['threaded_writer'] = self.threaded_writer
         return d
 
     def init_ui(self):
@@ -143,6 +145,7 @@ class Recorder(System_Plugin_Base):
         self.menu.append(ui.Text_Input('session_name', self, setter=self.set_session_name, label='Recording session name'))
         self.menu.append(ui.Switch('show_info_menu', self, on_val=True, off_val=False, label='Request additional user info'))
         self.menu.append(ui.Selector('raw_jpeg', self, selection=[True, False], labels=["bigger file, less CPU", "smaller file, more CPU"], label='Compression'))
+        self.menu.append(ui.Switch('threaded_writer', self, on_val=True, off_val=False, label='Encode video on separate thread'))
         self.menu.append(ui.Info_Text('Recording the raw eye video is optional. We use it for debugging.'))
         self.menu.append(ui.Switch('record_eye', self, on_val=True, off_val=False, label='Record eye'))
         self.button = ui.Thumb('running', self, setter=self.toggle, label='R', hotkey='r')
@@ -251,6 +254,8 @@ class Recorder(System_Plugin_Base):
                                      int(self.g_pool.capture.frame_rate))
         else:
             self.writer = AV_Writer(self.video_path, fps=self.g_pool.capture.frame_rate)
+        if self.threaded_writer:
+            self.writer = Async_Writer(self.writer)
 
         try:
             cal_pt_path = os.path.join(self.g_pool.user_dir, "user_calibration_data")
@@ -266,7 +271,7 @@ class Recorder(System_Plugin_Base):
         logger.info("Started Recording.")
         self.notify_all({'subject': 'recording.started', 'rec_path': self.rec_path,
                          'session_name': self.session_name, 'record_eye': self.record_eye,
-                         'compression': self.raw_jpeg})
+                         'compression': self.raw_jpeg, 'threaded_writer': self.threaded_writer})
 
     def open_info_menu(self):
         self.info_menu = ui.Growing_Menu('additional Recording Info', size=(300, 300), pos=(300, 300))
@@ -295,17 +300,23 @@ class Recorder(System_Plugin_Base):
     def recent_events(self,events):
         if self.running:
             for key, data in events.items():
-                if key not in ('dt', 'frame', 'depth_frame'):
+                if key not in ('dt', 'frame', 'queued_frames', 'depth_frame'):
                     try:
                         self.data[key] += data
                     except KeyError:
                         self.data[key] = []
                         self.data[key] += data
 
+            # frames a threaded capture grabbed while the last loop iteration ran
+            # Async_Writer returns False for dropped frames
+            for frame in events.get('queued_frames', ()):
+                if self.writer.write_video_frame(frame) is not False:
+                    self.frame_count += 1
+
             if 'frame' in events:
                 frame = events['frame']
-                self.writer.write_video_frame(frame)
-                self.frame_count += 1
+                if self.writer.write_video_frame(frame) is not False:
+                    self.frame_count += 1
 
             # # cv2.putText(frame.img, "Frame %s"%self.frame_count,(200,200), cv2.FONT_HERSHEY_SIMPLEX,1,(255,100,100))
 
@@ -44,6 +44,124 @@ def m_verts_from_screen(verts):
     return cv2.getPerspectiveTransform(verts, marker_corners_norm)
 
 
+def perspective_transforms(src, dst):
+    '''
+    vectorized cv2.getPerspectiveTransform
+    src and dst are (F,4,2) arrays of quadrangles (either may also be a single (4,2) quadrangle)
+    returns the (F,3,3) homographies that map src to dst
+    '''
+    src, dst = np.broadcast_arrays(np.asarray(src, dtype=np.float64).reshape(-1, 4, 2),
+                                   np.asarray(dst, dtype=np.float64).reshape(-1, 4, 2))
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    a = np.concatenate((np.stack((x, y, ones, zeros, zeros, zeros, -u * x, -u * y), axis=-1),
+                        np.stack((zeros, zeros, zeros, x, y, ones, -v * x, -v * y), axis=-1)), axis=1)
+    b = np.concatenate((u, v), axis=1)
+    h = np.linalg.solve(a, b[..., None])[..., 0]
+    return np.concatenate((h, np.ones((h.shape[0], 1))), axis=1).reshape(-1, 3, 3)
+
+
+def perspective_transform_batch(points, m):
+    '''
+    vectorized cv2.perspectiveTransform with stacked homographies
+    points: (F,N,2) array with m: (F,3,3), one homography per point set
+        or  (N,2) array with m: (N,3,3), one homography per point
+    Like cv2.perspectiveTransform, points with w close to zero are mapped to (0,0).
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    hom_points = np.concatenate((points, np.ones(points.shape[:-1] + (1,))), axis=-1)
+    if points.ndim == 3:
+        hom = np.einsum('fij,fnj->fni', m, hom_points)
+    else:
+        hom = np.einsum('nij,nj->ni', m, hom_points)
+    w = hom[..., 2:]
+    valid = np.abs(w) > np.finfo(np.float32).eps
+    w = np.divide(1., w, out=np.zeros_like(w), where=valid)
+    return hom[..., :2] * w
+
+
+class Data_Arrays(object):
+    """Flat array view of data that is correlated by frame (e.g. g_pool.gaze_positions_by_frame)
+
+    data_by_frame[i] == data[offsets[i]:offsets[i+1]]
+    norm_pos, confidence and timestamp hold one row per datum.
+    """
+
+    def __init__(self, data_by_frame):
+        counts = np.array([len(d) for d in data_by_frame], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.data = [d for frame_data in data_by_frame for d in frame_data]
+        self.norm_pos = np.array([d['norm_pos'] for d in self.data], dtype=np.float64).reshape(-1, 2)
+        self.confidence = np.array([d['confidence'] for d in self.data], dtype=np.float64)
+        self.timestamp = np.array([d['timestamp'] for d in self.data], dtype=np.float64)
+
+    def indices_of_frames(self, frame_indices):
+        '''datum indices of all data in the given frames and the position of their frame in frame_indices'''
+        frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        starts = self.offsets[frame_indices]
+        counts = self.offsets[frame_indices + 1] - starts
+        which = np.repeat(np.arange(frame_indices.shape[0]), counts)
+        datum_idx = np.arange(which.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts) + starts[which]
+        return datum_idx, which
+
+
+_data_arrays_memo = []
+
+
+def data_arrays(data_by_frame):
+    '''
+    Data_Arrays of data_by_frame. Results are reused as long as the same list object is passed.
+    Lists correlated by frame are replaced, not modified, when their data changes.
+    '''
+    for source, arrays in _data_arrays_memo:
+        if source is data_by_frame:
+            return arrays
+    arrays = Data_Arrays(data_by_frame)
+    _data_arrays_memo.insert(0, (data_by_frame, arrays))
+    del _data_arrays_memo[4:]
+    return arrays
+
+
+class Surface_Mapped_Data(object):
+    """Data mapped onto a surface by Reference_Surface.map_frames_to_surface
+
+    Mapped positions are kept as arrays with one row per datum:
+        frame_idx, norm_pos, on_srf and the index of the datum in the source Data_Arrays.
+    Indexing or iterating creates the same dicts as Reference_Surface.map_datum_to_surface.
+    """
+
+    def __init__(self, source, datum_idx, frame_idx, norm_pos, on_srf):
+        self.source = source
+        self.datum_idx = datum_idx
+        self.frame_idx = frame_idx
+        self.norm_pos = norm_pos
+        self.on_srf = on_srf
+
+    def __len__(self):
+        return self.datum_idx.shape[0]
+
+    def __getitem__(self, i):
+        d = self.source.data[self.datum_idx[i]]
+        return {'topic': d['topic']+"_on_surface", 'norm_pos': (self.norm_pos[i, 0], self.norm_pos[i, 1]),
+                'confidence': d['confidence'], 'on_srf': bool(self.on_srf[i]), 'base_data': d, 'timestamp': d['timestamp']}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def confidence(self):
+        return self.source.confidence[self.datum_idx]
+
+    @property
+    def timestamp(self):
+        return self.source.timestamp[self.datum_idx]
+
+    def select(self, mask):
+        return Surface_Mapped_Data(self.source, self.datum_idx[mask], self.frame_idx[mask], self.norm_pos[mask], self.on_srf[mask])
+
+
 class Reference_Surface(object):
     """docstring for Reference Surface
 
@@ -238,14 +356,23 @@ class Reference_Surface(object):
         self._generate_heatmap(data)
 
     def _generate_heatmap(self, data):
-        if not data:
+        if not len(data):
             return
 
-        grid = int(self.real_world_size['y']), int(self.real_world_size['x'])
+        grid = self.heatmap_grid
 
-        xvals, yvals = zip(*((x, 1.-y) for x, y in data))
+        data = np.asarray(data, dtype=np.float64).reshape(-1, 2)
+        xvals, yvals = data[:, 0], 1. - data[:, 1]
         hist, *edges = np.histogram2d(yvals, xvals, bins=grid,
                                       range=[[0, 1.], [0, 1.]], normed=False)
+        self._generate_heatmap_from_histogram(hist)
+
+    @property
+    def heatmap_grid(self):
+        return int(self.real_world_size['y']), int(self.real_world_size['x'])
+
+    def _generate_heatmap_from_histogram(self, hist):
+        grid = hist.shape
         filter_h = int(self.heatmap_detail * grid[0]) // 2 * 2 + 1
         filter_w = int(self.heatmap_detail * grid[1]) // 2 * 2 + 1
         hist = cv2.GaussianBlur(hist, (filter_h, filter_w), 0)
@@ -486,6 +613,23 @@ class Reference_Surface(object):
     def map_data_to_surface(self, data, m_from_screen):
         return [self.map_datum_to_surface(d, m_from_screen) for d in data]
 
+    @staticmethod
+    def map_frames_to_surface(data_by_frame, frame_indices, m_from_screen):
+        '''
+        map all data of the given frames at once.
+        data_by_frame: list of data lists correlated by frame
+        frame_indices: (F,) frame indices, m_from_screen: (F,3,3) stacked homographies of these frames
+        returns Surface_Mapped_Data
+        '''
+        source = data_arrays(data_by_frame)
+        datum_idx, which = source.indices_of_frames(frame_indices)
+        if datum_idx.shape[0]:
+            mapped_pos = perspective_transform_batch(source.norm_pos[datum_idx], np.asarray(m_from_screen)[which])
+        else:
+            mapped_pos = np.empty((0, 2))
+        on_srf = np.all((0 <= mapped_pos) & (mapped_pos <= 1), axis=1)
+        return Surface_Mapped_Data(source, datum_idx, np.asarray(frame_indices)[which], mapped_pos, on_srf)
+
     def move_vertex(self,vert_idx,new_pos):
         """
         this fn is used to manipulate the surface boundary (coordinate system)
@@ -500,6 +644,7 @@ class Reference_Surface(object):
         transform = cv2.getPerspectiveTransform(after,before)
         for m in self.markers.values():
             m.uv_coords = cv2.perspectiveTransform(m.uv_coords,transform)
+        return transform
 
 
     def add_marker(self,marker,visible_markers,min_marker_perimeter,min_id_confidence):
@@ -0,0 +1,150 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Shared memory transport for frame publishing.
+
+Frame_Ring_Writer copies frame buffers into a ring of slots in a memory mapped
+file (in /dev/shm if available). Instead of the frame buffer, the published message
+carries a reference to the slot in its '__shm__' field. zmq_tools.Msg_Receiver resolves
+references of local rings and adds a copy of the slot contents as '__raw_data__',
+so consumers see the same messages as with frames sent through the IPC.
+
+Slot contents stay valid until the writer comes around the ring again (slot_count frames later).
+Messages of frames that were overwritten before they were received, or that were
+sent from another host, get '__frame_unavailable__': True instead of '__raw_data__'.
+Publishers fall back to sending frame data only when Pupil Remote sees a remote
+client ask for the SUB port (``frame_publishing.remote_subscriber``). Clients that
+connect directly or through a tunnel are not detected.
+'''
+
+import os
+import socket
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+hostname = socket.gethostname()
+if os.path.isdir('/dev/shm'):
+    ring_dir = '/dev/shm'
+else:
+    ring_dir = tempfile.gettempdir()
+
+# slot data starts at a multiple of this
+alignment = 64
+
+
+class Frame_Ring_Writer(object):
+    """Writes frame buffers into a ring of equally sized slots.
+
+    The file starts with one int64 sequence number per slot. A slot's number is set to -1
+    while the slot is written, readers compare it to the number in the reference.
+    The ring is recreated with larger slots when a frame does not fit.
+    """
+
+    def __init__(self, name, slot_count=8):
+        self.name = name
+        self.slot_count = slot_count
+        self.seq = 0
+        self.path = None
+        self._ring = None
+        self._generation = 0
+
+    def _create(self, slot_size):
+        self.close()
+        self._generation += 1
+        self.slot_size = -(-slot_size // alignment) * alignment
+        self.header_size = -(-8 * self.slot_count // alignment) * alignment
+        self.path = os.path.join(ring_dir, 'pupil_frames_{}_{}_{}'.format(self.name, os.getpid(), self._generation))
+        self._ring = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(self.header_size + self.slot_count * self.slot_size,))
+        self._seqs = self._ring[:8 * self.slot_count].view(np.int64)
+        self._seqs[:] = -1
+
+    def write(self, data):
+        '''copy data (any object exposing the buffer interface) into the next slot and return a reference to it'''
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        else:
+            data = np.frombuffer(data, dtype=np.uint8)
+        if self._ring is None or data.shape[0] > self.slot_size:
+            self._create(data.shape[0])
+        slot = self.seq % self.slot_count
+        offset = self.header_size + slot * self.slot_size
+        self._seqs[slot] = -1
+        self._ring[offset:offset + data.shape[0]] = data
+        self._seqs[slot] = self.seq
+        ref = {'host': hostname, 'path': self.path, 'slot_count': self.slot_count, 'slot': slot,
+               'seq': self.seq, 'offset': offset, 'nbytes': data.shape[0]}
+        self.seq += 1
+        return ref
+
+    def close(self):
+        if self._ring is not None:
+            del self._seqs
+            self._ring = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
+class Frame_Ring_Reader(object):
+    """Resolves references written by Frame_Ring_Writer on the same host"""
+
+    max_open_rings = 8
+
+    def __init__(self):
+        self._rings = OrderedDict()
+
+    def _open(self, path):
+        try:
+            return self._rings[path]
+        except KeyError:
+            pass
+        if len(self._rings) >= self.max_open_rings:
+            # rings are recreated by writers with new paths, drop the oldest one
+            self._rings.popitem(last=False)
+        ring = np.memmap(path, dtype=np.uint8, mode='r')
+        self._rings[path] = ring
+        return ring
+
+    def read(self, ref):
+        '''copy of the referenced data or None if it is not available (anymore)'''
+        if ref['host'] != hostname:
+            return None
+        try:
+            ring = self._open(ref['path'])
+        except (IOError, OSError, ValueError):
+            return None
+        seqs = ring[:8 * ref['slot_count']].view(np.int64)
+        if seqs[ref['slot']] != ref['seq']:
+            return None
+        data = ring[ref['offset']:ref['offset'] + ref['nbytes']].copy()
+        # the writer might have started on the slot while we copied it
+        if seqs[ref['slot']] != ref['seq']:
+            return None
+        return data
+
+
+_reader = None
+
+
+def resolve(ref):
+    '''resolve a frame reference using a per process reader'''
+    global _reader
+    if _reader is None:
+        _reader = Frame_Ring_Reader()
+    return _reader.read(ref)
@@ -151,18 +151,23 @@ def correct_gradient(gray_img,r):
         return True
 
 
-def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visualize=False):
+def find_marker_candidates(gray_img,min_marker_perimeter=40,aperture=11,offset=(0,0)):
+    """
+    quadrangles in gray_img that could be markers.
+    gray_img may be a region of a larger image, offset is added to all returned verts.
+    """
     edges = cv2.adaptiveThreshold(gray_img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, aperture, 9)
 
     _img, contours, hierarchy = cv2.findContours(edges,
                                     mode=cv2.RETR_TREE,
-                                    method=cv2.CHAIN_APPROX_SIMPLE,offset=(0,0)) #TC89_KCOS
+                                    method=cv2.CHAIN_APPROX_SIMPLE,offset=offset) #TC89_KCOS
+    if hierarchy is None:
+        return []
 
     # remove extra encapsulation
     hierarchy = hierarchy[0]
-    contours = np.array(contours)
     # keep only contours                        with parents     and      children
-    contained_contours = contours[np.logical_and(hierarchy[:,3]>=0, hierarchy[:,2]>=0)]
+    contained_contours = [c for c,h in zip(contours,hierarchy) if h[3]>=0 and h[2]>=0]
     # turn on to debug contours
     # cv2.drawContours(gray_img, contours,-1, (0,255,255))
     # cv2.drawContours(gray_img, aprox_contours,-1, (255,0,0))
@@ -178,7 +183,20 @@ def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visual
     rect_cand = [cv2.convexHull(c,clockwise=True) for c in aprox_contours if c.shape[0]==4 and cv2.arcLength(c,closed=True) > min_marker_perimeter]
     # a non convex quadrangle is not what we are looking for.
     rect_cand = [r for r in rect_cand if r.shape[0]==4]
+    return rect_cand
+
+
+def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visualize=False):
+    rect_cand = find_marker_candidates(gray_img,min_marker_perimeter,aperture)
+    return markers_from_candidates(gray_img,grid_size,rect_cand,visualize)
+
 
+def markers_from_candidates(gray_img,grid_size,rect_cand,visualize=False,stable_markers=()):
+    """
+    refine and decode quadrangle candidates.
+    Candidates that match one of stable_markers (see match_stable_marker) are not decoded again,
+    they inherit id and orientation of the matched marker.
+    """
     if visualize:
         cv2.drawContours(gray_img, rect_cand,-1, (255,100,50))
 
@@ -194,6 +212,16 @@ def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visual
             criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.001)
             cv2.cornerSubPix(gray_img,r,(3,3),(-1,-1),criteria)
 
+            stable, roll = match_stable_marker(r,stable_markers)
+            if stable is not None:
+                r = np.roll(r,roll,axis=0)
+                centroid = r.sum(axis=0)/4.
+                centroid.shape = (2)
+                markers.append({'id':stable['id'],'id_confidence':stable['id_confidence'],'verts':r.tolist(),'soft_id':stable['soft_id'],
+                                'perimeter':cv2.arcLength(r,closed=True),'centroid':centroid.tolist(),"frames_since_true_detection":0,
+                                'frames_since_decode':stable['frames_since_decode']+1})
+                continue
+
             M = cv2.getPerspectiveTransform(r,mapped_space)
             flat_marker_img =  cv2.warpPerspective(gray_img, M, (size,size) )#[, dst[, flags[, borderMode[, borderValue]]]])
             # Otsu documentation here :
@@ -220,7 +248,7 @@ def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visual
                 # id_confidence = 2*np.mean (np.abs(np.array(soft_msg)-.5 ))
                 id_confidence = 2* min(np.abs(np.array(soft_msg)-.5 ))
 
-                marker = {'id':msg,'id_confidence':id_confidence,'verts':r.tolist(),'soft_id':soft_msg,'perimeter':cv2.arcLength(r,closed=True),'centroid':centroid.tolist(),"frames_since_true_detection":0}
+                marker = {'id':msg,'id_confidence':id_confidence,'verts':r.tolist(),'soft_id':soft_msg,'perimeter':cv2.arcLength(r,closed=True),'centroid':centroid.tolist(),"frames_since_true_detection":0,'frames_since_decode':0}
                 if visualize:
                     marker['otsu'] = np.rot90(otsu,-angle-2).transpose()
                     marker['img'] = cv2.resize(msg_img,(20*grid_size,20*grid_size),interpolation=cv2.INTER_NEAREST)
@@ -229,7 +257,6 @@ def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visual
     return markers
 
 
-
 def draw_markers(img,markers):
     for m in markers:
         centroid = np.array(m['centroid'],dtype=np.float32)
@@ -381,6 +408,82 @@ def detect_markers_robust(gray_img,grid_size,prev_markers,min_marker_perimeter=4
 
 
 
+#persistent vars for detect_markers_roi
+roi_tick = 0
+# ids of markers with at least this id_confidence are reused for at most decode_every_frame frames
+stable_id_confidence = .7
+decode_every_frame = 15
+
+
+def match_stable_marker(r,stable_markers):
+    """
+    find a marker of the previous frame that r is a small displacement of.
+    Returns the marker and the roll that maps the verts of r onto its verts or (None, 0).
+    A displacement is small if no vertex moved more than a 16th of the marker perimeter,
+    then the vertex correspondence (and thus the marker rotation) is unambiguous.
+    """
+    for m in stable_markers:
+        prev_verts = np.array(m['verts'],dtype=np.float32).reshape(4,1,2)
+        max_shift = m['perimeter']/16.
+        for roll in range(4):
+            if np.abs(np.roll(r,roll,axis=0)-prev_verts).max() < max_shift:
+                return m,roll
+    return None,0
+
+
+def marker_rois(markers,img_shape,padding=.5,min_padding=10):
+    """
+    bounding boxes (x0,y0,x1,y1) around markers, padded by a fraction of the marker size.
+    Overlapping boxes are merged.
+    """
+    rois = []
+    for m in markers:
+        verts = np.array(m['verts']).reshape(4,2)
+        (x0,y0),(x1,y1) = verts.min(axis=0),verts.max(axis=0)
+        pad = max(padding*max(x1-x0,y1-y0),min_padding)
+        rois.append([max(int(x0-pad),0),max(int(y0-pad),0),min(int(x1+pad)+1,img_shape[1]),min(int(y1+pad)+1,img_shape[0])])
+
+    merged = True
+    while merged:
+        merged = False
+        for i,a in enumerate(rois):
+            for b in rois[i+1:]:
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    a[:] = min(a[0],b[0]),min(a[1],b[1]),max(a[2],b[2]),max(a[3],b[3])
+                    rois.remove(b)
+                    merged = True
+                    break
+            if merged:
+                break
+    return rois
+
+
+def detect_markers_roi(gray_img,grid_size,prev_markers,min_marker_perimeter=40,aperture=11,visualize=False,full_detect_every_frame=10,invert_image=False):
+    """
+    marker detection that only searches padded regions around the markers of the previous frame.
+    Every full_detect_every_frame frames (and whenever there are no previous markers) the whole frame is searched
+    to pick up new markers. Markers that are tracked stably are not decoded again, see match_stable_marker.
+    """
+    global roi_tick
+
+    if invert_image:
+        gray_img = 255-gray_img
+
+    prev_markers = [m for m in prev_markers if m['id'] >= 0]
+    if not roi_tick or not prev_markers:
+        roi_tick = full_detect_every_frame
+        rect_cand = find_marker_candidates(gray_img,min_marker_perimeter,aperture)
+    else:
+        rect_cand = []
+        for x0,y0,x1,y1 in marker_rois(prev_markers,gray_img.shape):
+            if x1-x0 > aperture and y1-y0 > aperture:
+                rect_cand += find_marker_candidates(gray_img[y0:y1,x0:x1],min_marker_perimeter,aperture,offset=(x0,y0))
+    roi_tick -= 1
+
+    stable_markers = [m for m in prev_markers if m['id_confidence'] >= stable_id_confidence and m.get('frames_since_decode',decode_every_frame) < decode_every_frame]
+    return markers_from_candidates(gray_img,grid_size,rect_cand,visualize,stable_markers)
+
+
 # def bench(folder):
 #     from os.path import join
 #     from video_capture.av_file_capture import File_Capture
@@ -428,8 +531,49 @@ def bench(folder):
     print(detected_count) #2900 #3042 #3021
 
 
+def bench_roi(folder,frame_count=500):
+    """
+    compare detect_markers_robust as used in bench() with detect_markers_roi on the same frames.
+    Frames are decoded up front so that only detection is timed.
+    """
+    global prev_img,tick,roi_tick
+    from os.path import join
+    from time import perf_counter
+    from video_capture import File_Source, EndofVideoFileError
+    class Global_Container(object):
+        pass
+    cap = File_Source(Global_Container(),join(folder,'marker-test.mp4'))
+    frames = []
+    try:
+        while len(frames) < frame_count:
+            frames.append(cap.get_frame().gray.copy())
+    except EndofVideoFileError:
+        pass
+    cap.cleanup()
+
+    results = {}
+    for name,detect in (('robust',lambda gray,prev: detect_markers_robust(gray,5,prev_markers=prev,true_detect_every_frame=1)),
+                        ('roi',lambda gray,prev: detect_markers_roi(gray,5,prev_markers=prev))):
+        prev_img,tick,roi_tick = None,0,0
+        markers = []
+        ids = []
+        start = perf_counter()
+        for gray in frames:
+            markers = detect(gray,markers)
+            ids.append(set(m['id'] for m in markers))
+        duration = perf_counter()-start
+        results[name] = ids
+        print('{:>6}: {:.2f} ms per frame, {} markers detected'.format(name,1000*duration/len(frames),sum(len(i) for i in ids)))
+    agree = sum(a==b for a,b in zip(results['robust'],results['roi']))
+    print('same marker ids in {} of {} frames'.format(agree,len(frames)))
+
+
 if __name__ == '__main__':
     folder = '/Users/mkassner/Desktop/'
+    import sys
+    if '--roi' in sys.argv:
+        bench_roi(folder)
+        sys.exit()
     import cProfile,subprocess,os
     cProfile.runctx("bench(folder)",{'folder':folder},locals(),os.path.join(folder, "world.pstats"))
     loc = os.path.abspath(__file__).rsplit('pupil_src', 1)
@@ -0,0 +1,120 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+import os
+import csv
+import numpy as np
+import cv2
+from reference_surface import data_arrays, Surface_Mapped_Data
+
+
+def map_frames_with_cv2(data_by_frame, frames, m_from_screen):
+    '''
+    like Reference_Surface.map_frames_to_surface but with cv2.perspectiveTransform, one call per frame.
+    The vectorized mapping differs in the last bits, exported files keep the per datum arithmetic
+    for positions and on_srf.
+    '''
+    source = data_arrays(data_by_frame)
+    datum_idx, which = source.indices_of_frames(frames)
+    frame_idx = np.asarray(frames, dtype=np.int64)[which]
+    norm_pos = np.empty((datum_idx.shape[0], 2))
+    if datum_idx.shape[0]:
+        m_from_screen = np.asarray(m_from_screen)
+        order = np.argsort(which, kind='mergesort')
+        for rows in np.split(order, np.flatnonzero(np.diff(which[order])) + 1):
+            pos = source.norm_pos[datum_idx[rows]].reshape(-1, 1, 2)
+            norm_pos[rows] = cv2.perspectiveTransform(pos, m_from_screen[which[rows[0]]]).reshape(-1, 2)
+    on_srf = np.all((0 <= norm_pos) & (norm_pos <= 1), axis=1)
+    return Surface_Mapped_Data(source, datum_idx, frame_idx, norm_pos, on_srf)
+
+
+def gaze_on_srf_with_cv2(surface, gaze_positions_by_frame, section):
+    '''gaze on the surface in section (a slice), decided like the exported on_srf column'''
+    if surface.cache is None:
+        return []
+    gaze = map_frames_with_cv2(gaze_positions_by_frame, *surface.located_frames(section))
+    return gaze.select(gaze.on_srf)
+
+
+def surface_export_data(surface, timestamps, gaze_positions_by_frame, fixations_by_frame, in_mark, out_mark):
+    '''
+    collect everything the per surface export files need as arrays.
+    This runs in the main process, the result is picklable and passed to export_surface().
+    '''
+    section = slice(in_mark, out_mark + 1)
+    frames, m_from_screen = surface.located_frames(section)
+    # positions are written as the cached arrays are printed, keep them as they are
+    m_to_screen = [surface.cache[idx]['m_to_screen'] for idx in frames]
+    m_from_screen_cached = [surface.cache[idx]['m_from_screen'] for idx in frames]
+    detected_markers = [surface.cache[idx]['detected_markers'] for idx in frames]
+    timestamps = np.asarray(timestamps)
+
+    gaze = map_frames_with_cv2(gaze_positions_by_frame, frames, m_from_screen)
+    fixations = map_frames_with_cv2(fixations_by_frame, frames, m_from_screen)
+    # a fixation spans several frames, keep the last mapping of each fixation id in order of first appearance
+    removed_duplicates = dict([(f['base_data']['id'], f) for f in fixations]).values()
+    fixation_rows = []
+    for f_on_s in removed_duplicates:
+        f = f_on_s['base_data']
+        f_x, f_y = f_on_s['norm_pos']
+        fixation_rows.append((f['id'], f['timestamp'], f['duration'], f['start_frame_index'], f['end_frame_index'],
+                              f_x, f_y, f_x*surface.real_world_size['x'], f_y*surface.real_world_size['y'], f_on_s['on_srf']))
+
+    return {'name': surface.name,
+            'uid': surface.uid,
+            'real_world_size': (surface.real_world_size['x'], surface.real_world_size['y']),
+            'frames': np.asarray(frames, dtype=np.int64),
+            'frame_ts': timestamps[frames],
+            'm_to_screen': m_to_screen,
+            'm_from_screen': m_from_screen_cached,
+            'detected_markers': detected_markers,
+            'gaze_world_ts': timestamps[gaze.frame_idx],
+            'gaze_frame_idx': gaze.frame_idx,
+            'gaze_ts': gaze.timestamp,
+            'gaze_norm_pos': gaze.norm_pos,
+            'gaze_on_srf': gaze.on_srf,
+            'fixation_rows': fixation_rows,
+            'heatmap': surface.heatmap}
+
+
+def export_surface(metrics_dir, srf):
+    '''
+    write srf_positons, gaze_positions_on_surface, fixations_on_surface and heatmap files of one surface.
+    srf is the dict created by surface_export_data(). Can be run in a worker process.
+    '''
+    surface_name = '_'+srf['name'].replace('/', '')+'_'+srf['uid']
+    size_x, size_y = srf['real_world_size']
+
+    # save surface_positions as csv
+    with open(os.path.join(metrics_dir, 'srf_positons'+surface_name+'.csv'), 'w', encoding='utf-8', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=',')
+        csv_writer.writerow(('frame_idx', 'timestamp', 'm_to_screen', 'm_from_screen', 'detected_markers'))
+        csv_writer.writerows(zip(srf['frames'].tolist(), srf['frame_ts'].tolist(), srf['m_to_screen'],
+                                 srf['m_from_screen'], srf['detected_markers']))
+
+    # save gaze on srf as csv.
+    with open(os.path.join(metrics_dir, 'gaze_positions_on_surface'+surface_name+'.csv'), 'w', encoding='utf-8', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=',')
+        csv_writer.writerow(('world_timestamp', 'world_frame_idx', 'gaze_timestamp', 'x_norm', 'y_norm', 'x_scaled', 'y_scaled', 'on_srf'))
+        x_norm, y_norm = srf['gaze_norm_pos'].T
+        csv_writer.writerows(zip(srf['gaze_world_ts'].tolist(), srf['gaze_frame_idx'].tolist(), srf['gaze_ts'].tolist(),
+                                 x_norm.tolist(), y_norm.tolist(), (x_norm*size_x).tolist(), (y_norm*size_y).tolist(),
+                                 srf['gaze_on_srf'].tolist()))
+
+    # save fixation on srf as csv.
+    with open(os.path.join(metrics_dir, 'fixations_on_surface'+surface_name+'.csv'), 'w', encoding='utf-8', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=',')
+        csv_writer.writerow(('id', 'start_timestamp', 'duration', 'start_frame', 'end_frame', 'norm_pos_x', 'norm_pos_y', 'x_scaled', 'y_scaled', 'on_srf'))
+        csv_writer.writerows(srf['fixation_rows'])
+
+    if srf['heatmap'] is not None:
+        cv2.imwrite(os.path.join(metrics_dir, 'heatmap'+surface_name+'.png'), srf['heatmap'])
+    return srf['name'], srf['uid'], srf['heatmap'] is not None
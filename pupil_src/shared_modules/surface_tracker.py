@@ -20,21 +20,78 @@ from methods import normalize,denormalize
 from glfw import *
 from plugin import Plugin
 
-from square_marker_detect import detect_markers,detect_markers_robust, draw_markers,m_marker_to_screen
+from square_marker_detect import detect_markers,detect_markers_robust,detect_markers_roi, draw_markers,m_marker_to_screen
 from reference_surface import Reference_Surface
 
 from math import sqrt
+import threading
 
 # logging
 import logging
 logger = logging.getLogger(__name__)
 
 
+class Marker_Detection_Thread(object):
+    """Runs marker detection in a background thread.
+
+    Frames are handed over through a slot that only holds the latest frame:
+    submit() replaces a frame that has not been picked up yet, so detection
+    skips frames under load instead of delaying the world loop.
+    fetch() returns the newest result as (markers, frame timestamp, frame index) or None.
+    detect(gray_img, prev_markers) is called in the background thread and returns the markers.
+    """
+
+    def __init__(self, detect):
+        self.detect = detect
+        self.skipped_frames = 0
+        self._cond = threading.Condition()
+        self._frame = None
+        self._result = None
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='Marker Detection', daemon=True)
+        self._thread.start()
+
+    def submit(self, gray_img, timestamp, index):
+        with self._cond:
+            if self._frame is not None:
+                self.skipped_frames += 1
+            self._frame = gray_img, timestamp, index
+            self._cond.notify()
+
+    def fetch(self):
+        with self._cond:
+            result, self._result = self._result, None
+        return result
+
+    def _run(self):
+        markers = []
+        while True:
+            with self._cond:
+                while self._frame is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                (gray_img, timestamp, index), self._frame = self._frame, None
+            try:
+                markers = self.detect(gray_img, markers)
+            except Exception:
+                logger.exception('Marker detection failed.')
+                markers = []
+            with self._cond:
+                self._result = markers, timestamp, index
+
+    def stop(self, timeout=1):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+
 class Surface_Tracker(Plugin):
     icon_chr = chr(0xec07)
     icon_font = 'pupil_icons'
 
-    def __init__(self,g_pool,mode="Show Markers and Surfaces",min_marker_perimeter = 100,invert_image=False,robust_detection=True):
+    def __init__(self,g_pool,mode="Show Markers and Surfaces",min_marker_perimeter = 100,invert_image=False,robust_detection=True,roi_detection=False):
         super().__init__(g_pool)
         self.order = .2
 
@@ -52,6 +109,7 @@ class Surface_Tracker(Plugin):
         self.running = True
 
         self.robust_detection = robust_detection
+        self.roi_detection = roi_detection
         self.aperture = 11
         self.min_marker_perimeter = min_marker_perimeter
         self.min_id_confidence = 0.0
@@ -60,6 +118,9 @@ class Surface_Tracker(Plugin):
 
         self.img_shape = None
         self._last_mouse_pos = 0,0
+        # marker detection runs in the background, markers belong to the frame with this timestamp
+        self.detection_thread = None
+        self.markers_timestamp = None
 
         self.menu = None
         self.button =  None
@@ -167,6 +228,7 @@ class Surface_Tracker(Plugin):
         self.menu.elements[:] = []
         self.menu.append(ui.Info_Text('This plugin detects and tracks fiducial markers visible in the scene. You can define surfaces using 1 or more marker visible within the world view by clicking *add surface*. You can edit defined surfaces by selecting *Surface edit mode*.'))
         self.menu.append(ui.Switch('robust_detection',self,label='Robust detection'))
+        self.menu.append(ui.Switch('roi_detection',self,label='Only search near known markers'))
         self.menu.append(ui.Switch('invert_image',self,label='Use inverted markers'))
         self.menu.append(ui.Slider('min_marker_perimeter',self,step=1,min=10,max=100))
         self.menu.append(ui.Switch('locate_3d',self,label='3D localization'))
@@ -195,28 +257,24 @@ class Surface_Tracker(Plugin):
             return
         self.img_shape = frame.height,frame.width,3
 
+        new_markers = False
         if self.running:
-            gray = frame.gray
-            if self.invert_image:
-                gray = 255-gray
-
-            if self.robust_detection:
-                self.markers = detect_markers_robust(
-                    gray, grid_size = 5,aperture=self.aperture,
-                    prev_markers=self.markers,
-                    true_detect_every_frame=3,
-                    min_marker_perimeter=self.min_marker_perimeter)
-            else:
-                self.markers = detect_markers(
-                    gray, grid_size = 5,aperture=self.aperture,
-                    min_marker_perimeter=self.min_marker_perimeter)
+            if self.detection_thread is None:
+                self.detection_thread = Marker_Detection_Thread(self.detect_markers)
+            # copy, drawing into frame.gray must not race with detection
+            self.detection_thread.submit(frame.gray.copy(), frame.timestamp, frame.index)
+            result = self.detection_thread.fetch()
+            if result is not None:
+                self.markers, self.markers_timestamp, _ = result
+                new_markers = True
             if self.mode == "Show marker IDs":
                 draw_markers(frame.gray,self.markers)
 
 
-        # locate surfaces, map gaze
+        # locate surfaces when detection has finished a frame, map gaze of every frame
         for s in self.surfaces:
-            s.locate(self.markers,self.min_marker_perimeter,self.min_id_confidence, self.locate_3d)
+            if new_markers:
+                s.locate(self.markers,self.min_marker_perimeter,self.min_id_confidence, self.locate_3d)
             if s.detected:
                 s.gaze_on_srf = s.map_data_to_surface(events.get('gaze_positions',[]),s.m_from_screen)
                 s.update_gaze_history()
@@ -226,7 +284,8 @@ class Surface_Tracker(Plugin):
         events['surfaces'] = []
         for s in self.surfaces:
             if s.detected:
-                events['surfaces'].append({'name':s.name,'uid':s.uid,'m_to_screen':s.m_to_screen.tolist(),'m_from_screen':s.m_from_screen.tolist(),'gaze_on_srf': s.gaze_on_srf, 'timestamp':frame.timestamp,'camera_pose_3d':s.camera_pose_3d.tolist() if s.camera_pose_3d is not None else None})
+                # gaze is mapped every frame, the surface was located in the frame of detection_timestamp
+                events['surfaces'].append({'name':s.name,'uid':s.uid,'m_to_screen':s.m_to_screen.tolist(),'m_from_screen':s.m_from_screen.tolist(),'gaze_on_srf': s.gaze_on_srf, 'timestamp':frame.timestamp,'detection_timestamp':self.markers_timestamp,'camera_pose_3d':s.camera_pose_3d.tolist() if s.camera_pose_3d is not None else None})
 
 
         if self.running:
@@ -243,8 +302,30 @@ class Surface_Tracker(Plugin):
                         new_pos = s.img_to_ref_surface(np.array(pos))
                         s.move_vertex(v_idx,new_pos)
 
+    def detect_markers(self, gray, prev_markers):
+        # called from the marker detection thread
+        if self.invert_image:
+            gray = 255-gray
+
+        if self.roi_detection:
+            return detect_markers_roi(
+                gray, grid_size = 5,aperture=self.aperture,
+                prev_markers=prev_markers,
+                full_detect_every_frame=10,
+                min_marker_perimeter=self.min_marker_perimeter)
+        elif self.robust_detection:
+            return detect_markers_robust(
+                gray, grid_size = 5,aperture=self.aperture,
+                prev_markers=prev_markers,
+                true_detect_every_frame=3,
+                min_marker_perimeter=self.min_marker_perimeter)
+        else:
+            return detect_markers(
+                gray, grid_size = 5,aperture=self.aperture,
+                min_marker_perimeter=self.min_marker_perimeter)
+
     def get_init_dict(self):
-        return {'mode':self.mode,'min_marker_perimeter':self.min_marker_perimeter,'invert_image':self.invert_image,'robust_detection':self.robust_detection}
+        return {'mode':self.mode,'min_marker_perimeter':self.min_marker_perimeter,'invert_image':self.invert_image,'robust_detection':self.robust_detection,'roi_detection':self.roi_detection}
 
     def gl_display(self):
         """
@@ -298,6 +379,8 @@ class Surface_Tracker(Plugin):
         This happens either voluntarily or forced.
         if you have a GUI or glfw window destroy it here.
         """
+        if self.detection_thread:
+            self.detection_thread.stop()
         self.save_surface_definitions_to_file()
 
         for s in self.surfaces:
@@ -0,0 +1,118 @@
+'''
+(*)~---------------------------------------------------------------------------
+Pupil - eye tracking platform
+Copyright (C) 2012-2017  Pupil Labs
+
+Distributed under the terms of the GNU
+Lesser General Public License (LGPL v3.0).
+See COPYING and COPYING.LESSER for license details.
+---------------------------------------------------------------------------~(*)
+'''
+
+'''
+Synthetic frames for testing and benchmarking without cameras.
+
+Generators return the bgr image of frame `index`:
+    Moving_Pupil_Generator: dark ellipse moving on a Lissajous path over an eye like
+                            background, with the ground truth pupil of every frame.
+    Video_Replay_Generator: frames of a recorded video, decoded into memory once and looped.
+Both are deterministic. Nothing here needs a window, OpenGL or pyglui.
+'''
+
+import math
+import numpy as np
+import cv2
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Synthetic_Frame(object):
+    """Frame with the attributes the pipeline uses from camera frames"""
+    def __init__(self, timestamp, img, index):
+        self.timestamp = timestamp
+        self._img = img
+        self.bgr = img
+        self.height, self.width, _ = img.shape
+        self._gray = None
+        self.index = index
+        # indicate that the frame does not have a native yuv or jpeg buffer
+        self.yuv_buffer = None
+        self.jpeg_buffer = None
+
+    @property
+    def img(self):
+        return self._img
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self._img, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+
+class Moving_Pupil_Generator(object):
+    """Dark elliptical pupil with a glint on an iris and sclera background.
+
+    The pupil center follows a Lissajous path with a period of `period` frames,
+    its size oscillates and its ellipse gets flatter towards the image border like a rotating eye.
+    """
+
+    def __init__(self, frame_size=(192, 192), period=240, noise=4, seed=0):
+        self.frame_size = tuple(frame_size)
+        self.period = period
+        w, h = self.frame_size
+        rng = np.random.RandomState(seed)
+        background = np.full((h, w), 170, dtype=np.uint8)
+        cv2.circle(background, (w // 2, h // 2), int(.42 * min(w, h)), 110, -1)
+        background = cv2.GaussianBlur(background, (0, 0), max(1., .02 * w))
+        # fixed sensor noise pattern, added per frame without random number generation
+        self._noise = rng.randint(-noise, noise + 1, size=(h, w)).astype(np.int16) if noise else None
+        self._background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+
+    def pupil(self, index):
+        '''ground truth pupil ellipse of frame index in image coordinates'''
+        w, h = self.frame_size
+        phase = 2 * math.pi * (index % self.period) / self.period
+        dx, dy = .25 * math.sin(phase), .2 * math.sin(2 * phase + .5)
+        center = (w / 2. * (1 + dx * 2), h / 2. * (1 + dy * 2))
+        diameter = .18 * min(w, h) * (1 + .15 * math.sin(3 * phase))
+        # foreshortening of the pupil disc when the eye rotates away from the camera
+        flatten = math.cos(math.hypot(dx, dy) * 1.5)
+        angle = math.degrees(math.atan2(dy, dx)) if dx or dy else 0.
+        return {'center': center, 'axes': (diameter * flatten, diameter), 'angle': angle}
+
+    def make_image(self, index):
+        pupil = self.pupil(index)
+        img = self._background.copy()
+        center = tuple(int(round(c)) for c in pupil['center'])
+        axes = tuple(int(round(a / 2.)) for a in pupil['axes'])
+        cv2.ellipse(img, center, axes, pupil['angle'], 0, 360, (30, 30, 30), -1)
+        cv2.circle(img, (center[0] + axes[1] // 2, center[1] - axes[1] // 2), max(1, axes[1] // 6), (250, 250, 250), -1)
+        if self._noise is not None:
+            shift = index % self._noise.shape[1]
+            noise = np.roll(self._noise, shift, axis=1)[..., None]
+            img = np.clip(img + noise, 0, 255).astype(np.uint8)
+        return img
+
+
+class Video_Replay_Generator(object):
+    """Frames of a video file, decoded up front so decoding does not count as capture time"""
+
+    def __init__(self, path, max_frames=1000):
+        import av
+        container = av.open(path)
+        self.images = []
+        for packet in container.demux(container.streams.video[0]):
+            for frame in packet.decode():
+                self.images.append(frame.to_nd_array(format='bgr24'))
+            if len(self.images) >= max_frames:
+                break
+        container.close()
+        if not self.images:
+            raise ValueError('No frames in "{}"'.format(path))
+        self.frame_size = self.images[0].shape[1], self.images[0].shape[0]
+        logger.debug('Loaded {} frames of "{}"'.format(len(self.images), path))
+
+    def make_image(self, index):
+        # copy like a camera would deliver a new buffer
+        return self.images[index % len(self.images)].copy()
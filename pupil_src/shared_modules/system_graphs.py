@@ -10,11 +10,13 @@ See COPYING and COPYING.LESSER for license details.
 '''
 
 import os
+from time import perf_counter
 import psutil
 import glfw
 from pyglui import ui, graph
 from pyglui.cygl.utils import RGBA, mix_smooth
 from plugin import System_Plugin_Base
+import zmq_tools
 
 
 class System_Graphs(System_Plugin_Base):
@@ -23,7 +25,7 @@ class System_Graphs(System_Plugin_Base):
 
     def __init__(self, g_pool, show_cpu=True, show_fps=True, show_conf0=True,
                  show_conf1=True, show_dia0=False, show_dia1=False,
-                 dia_min=0., dia_max=8.):
+                 show_drops=False, show_plugin_timing=False, dia_min=0., dia_max=8.):
         super().__init__(g_pool)
         self.show_cpu = show_cpu
         self.show_fps = show_fps
@@ -31,10 +33,17 @@ class System_Graphs(System_Plugin_Base):
         self.show_conf1 = show_conf1
         self.show_dia0 = show_dia0
         self.show_dia1 = show_dia1
+        self.show_drops = show_drops
+        self.show_plugin_timing = show_plugin_timing
         self.dia_min = dia_min
         self.dia_max = dia_max
         self.conf_grad_limits = .0, 1.
         self.ts = None
+        self.drop_count = None
+        self.slowest_plugins = []
+        self.next_slowest_update = 0.
+        if show_plugin_timing:
+            self.notify_all({'subject': 'plugin_timing.should_start'})
 
     def init_ui(self):
         self.add_menu()
@@ -46,6 +55,13 @@ class System_Graphs(System_Plugin_Base):
         self.menu.append(ui.Switch('show_conf1', self, label='Display confidence for eye 1'))
         self.menu.append(ui.Switch('show_dia0', self, label='Display pupil diameter for eye 0'))
         self.menu.append(ui.Switch('show_dia1', self, label='Display pupil diameter for eye 1'))
+        self.menu.append(ui.Switch('show_drops', self, label='Display dropped IPC messages'))
+
+        def set_show_plugin_timing(show):
+            self.show_plugin_timing = show
+            self.notify_all({'subject': 'plugin_timing.should_start' if show else 'plugin_timing.should_stop'})
+        self.menu.append(ui.Switch('show_plugin_timing', self, setter=set_show_plugin_timing,
+                                   label='Display slowest plugins'))
 
         # set up performace graphs:
         pid = os.getpid()
@@ -81,6 +97,21 @@ class System_Graphs(System_Plugin_Base):
         self.dia1_graph.update_rate = 5
         self.dia1_graph.label = "id1 dia: %0.2f"
 
+        # messages lost, conflated or dropped by the zmq sockets of this process
+        self.drop_graph = graph.Bar_Graph(max_val=100)
+        self.drop_graph.pos = (20, 100)
+        self.drop_graph.update_rate = 5
+        self.drop_graph.label = "drops %0.0f/s"
+
+        # recent_events time of the slowest plugins
+        self.timing_graphs = []
+        for x in (20, 140, 260):
+            timing_graph = graph.Bar_Graph(max_val=33.)
+            timing_graph.pos = (x, 150)
+            timing_graph.update_rate = 5
+            timing_graph.label = '%0.1f ms'
+            self.timing_graphs.append(timing_graph)
+
         self.conf_grad = RGBA(1., .0, .0, self.conf0_graph.color[3]), self.conf0_graph.color
 
         def set_dia_min(val):
@@ -108,6 +139,9 @@ class System_Graphs(System_Plugin_Base):
         self.conf1_graph.scale = hdpi_factor
         self.dia0_graph.scale = hdpi_factor
         self.dia1_graph.scale = hdpi_factor
+        self.drop_graph.scale = hdpi_factor
+        for timing_graph in self.timing_graphs:
+            timing_graph.scale = hdpi_factor
 
         self.cpu_graph.adjust_window_size(*fb_size)
         self.fps_graph.adjust_window_size(*fb_size)
@@ -115,6 +149,9 @@ class System_Graphs(System_Plugin_Base):
         self.conf1_graph.adjust_window_size(*fb_size)
         self.dia0_graph.adjust_window_size(*fb_size)
         self.dia1_graph.adjust_window_size(*fb_size)
+        self.drop_graph.adjust_window_size(*fb_size)
+        for timing_graph in self.timing_graphs:
+            timing_graph.adjust_window_size(*fb_size)
 
     def gl_display(self):
         if self.show_cpu:
@@ -135,9 +172,30 @@ class System_Graphs(System_Plugin_Base):
             self.dia0_graph.draw()
         if self.show_dia1:
             self.dia1_graph.draw()
+        if self.show_drops:
+            self.drop_graph.draw()
+        if self.show_plugin_timing:
+            for timing_graph, name in zip(self.timing_graphs, self.slowest_plugins):
+                timing_graph.draw()
 
     def recent_events(self, events):
         self.cpu_graph.update()
+        timing = self.g_pool.plugins.timing
+        if not timing:
+            # stopped by another plugin or a remote client
+            self.slowest_plugins = []
+        elif self.show_plugin_timing:
+            now = perf_counter()
+            if now >= self.next_slowest_update:
+                self.next_slowest_update = now + 1.
+                slowest = timing.slowest(len(self.timing_graphs))
+                for timing_graph, name in zip(self.timing_graphs, slowest):
+                    timing_graph.label = name[:16] + ' %0.1f ms'
+                self.slowest_plugins = slowest
+            for timing_graph, name in zip(self.timing_graphs, self.slowest_plugins):
+                duration = timing.recent(name)
+                if duration is not None:
+                    timing_graph.add(1e3 * duration)
         # update performace graphs
         if 'frame' in events:
             t = events["frame"].timestamp
@@ -151,6 +209,11 @@ class System_Graphs(System_Plugin_Base):
                 for p in events["pupil_positions"]:
                     (self.conf0_graph if p['id'] == 0 else self.conf1_graph).add(p['confidence'])
                     (self.dia0_graph if p['id'] == 0 else self.dia1_graph).add(p.get('diameter_3d', 0.))
+
+                drop_count = sum(zmq_tools.drop_counts().values())
+                if self.drop_count is not None and dt > 0:
+                    self.drop_graph.add((drop_count - self.drop_count) / dt)
+                self.drop_count = drop_count
             else:
                 self.ts = t
 
@@ -162,8 +225,11 @@ class System_Graphs(System_Plugin_Base):
         self.conf1_graph = None
         self.dia0_graph = None
         self.dia1_graph = None
+        self.drop_graph = None
+        self.timing_graphs = []
 
     def get_init_dict(self):
         return {'show_cpu': self.show_cpu, 'show_fps': self.show_fps,
                 'show_conf0': self.show_conf0, 'show_conf1': self.show_conf1,
-                'show_dia0': self.show_dia0, 'show_dia1': self.show_dia1}
+                'show_dia0': self.show_dia0, 'show_dia1': self.show_dia1,
+                'show_drops': self.show_drops, 'show_plugin_timing': self.show_plugin_timing}
@@ -16,7 +16,7 @@ from socket import gethostname
 from heapq import heappush
 from pyre import Pyre
 from urllib.parse import urlparse
-from network_time_sync import Clock_Sync_Master, Clock_Sync_Follower
+from network_time_sync import Clock_Sync_Master, Clock_Sync_Follower, Filtered_Clock_Sync_Follower
 import random
 
 import logging
@@ -56,13 +56,21 @@ class Time_Sync(Plugin):
     Implements the Pupil Time Sync protocol.
     Acts as clock service and as follower if required.
     See `time_sync_spec.md` for details.
+
+    With `precise_sync` the follower filters offsets, estimates the clock drift
+    and adapts its poll interval (see Filtered_Clock_Sync_Follower).
+    Followers publish the sync quality after each estimate:
+        {'topic': 'stats.time_sync', 'timestamp': pupil time, 'host': master address,
+         'in_sync', 'offset', 'drift', 'rtt', 'jitter', 'estimates'}
     """
     icon_chr = chr(0xec15)
     icon_font = 'pupil_icons'
 
-    def __init__(self, g_pool, node_name=None, sync_group_prefix='default', base_bias=1.):
+    def __init__(self, g_pool, node_name=None, sync_group_prefix='default', base_bias=1., precise_sync=False):
         super().__init__(g_pool)
         self.sync_group_prefix = sync_group_prefix
+        self.precise_sync = precise_sync
+        self.published_estimates = 0
         self.discovery = None
 
         self.leaderboard = []
@@ -103,6 +111,10 @@ class Time_Sync(Plugin):
                 return 'Clock Master'
         self.menu.append(ui.Text_Input('sync status', getter=sync_status, setter=lambda _: _, label='Status'))
 
+        help_str = "Precise sync filters many probes and corrects clock drift between syncs."
+        self.menu.append(ui.Info_Text(help_str))
+        self.menu.append(ui.Switch('precise_sync', self, label='Precise Sync', setter=self.set_precise_sync))
+
         def set_bias(bias):
             if bias < 0:
                 bias = 0.
@@ -138,6 +150,12 @@ class Time_Sync(Plugin):
             self.announce_clock_master_info()
             self.evaluate_leaderboard()
 
+        if self.follower_service and self.follower_service.estimates != self.published_estimates:
+            self.published_estimates = self.follower_service.estimates
+            quality = self.follower_service.sync_quality
+            quality.update({'topic': 'stats.time_sync', 'timestamp': self.g_pool.get_timestamp()})
+            self.g_pool.ipc_pub.send('stats.time_sync', quality)
+
     def update_leaderboard(self, uuid, name, rank, port):
         for cs in self.leaderboard:
             if cs.uuid == uuid:
@@ -172,12 +190,14 @@ class Time_Sync(Plugin):
             leader_addr = urlparse(leader_ep).netloc.split(':')[0]
             if self.follower_service is None:
                 # make new follower
-                self.follower_service = Clock_Sync_Follower(leader_addr,
-                                                            port=current_leader.port,
-                                                            interval=10,
-                                                            time_fn=self.get_time,
-                                                            jump_fn=self.jump_time,
-                                                            slew_fn=self.slew_time)
+                follower_cls = Filtered_Clock_Sync_Follower if self.precise_sync else Clock_Sync_Follower
+                self.follower_service = follower_cls(leader_addr,
+                                                     port=current_leader.port,
+                                                     interval=10,
+                                                     time_fn=self.get_time,
+                                                     jump_fn=self.jump_time,
+                                                     slew_fn=self.slew_time)
+                self.published_estimates = 0
             else:
                 # update follower_service
                 self.follower_service.host = leader_addr
@@ -242,6 +262,15 @@ class Time_Sync(Plugin):
         self.discovery.start()
         self.announce_clock_master_info()
 
+    def set_precise_sync(self, precise_sync):
+        if precise_sync != self.precise_sync:
+            self.precise_sync = precise_sync
+            if self.follower_service:
+                # restart the follower with the other estimation
+                self.follower_service.terminate()
+                self.follower_service = None
+                self.evaluate_leaderboard()
+
     def change_sync_group(self, new_group_prefix):
         if new_group_prefix != self.sync_group_prefix:
             self.discovery.leave(self.sync_group)
@@ -259,7 +288,8 @@ class Time_Sync(Plugin):
     def get_init_dict(self):
         return {'node_name': self.node_name,
                 'sync_group_prefix': self.sync_group_prefix,
-                'base_bias': self.base_bias}
+                'base_bias': self.base_bias,
+                'precise_sync': self.precise_sync}
 
     def cleanup(self):
         self.discovery.leave(self.sync_group)
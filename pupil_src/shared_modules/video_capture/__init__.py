@@ -18,7 +18,7 @@ source provides the stream of image frames.
 These backends are available:
 - UVC: Local USB sources
 - NDSI: Remote Pupil Mobile sources
-- Fake: Fallback, static random image
+- Fake: Fallback, static random image or synthetic test frames
 - File: Loads video from file
 '''
 
@@ -11,6 +11,8 @@ See COPYING and COPYING.LESSER for license details.
 
 from plugin import Plugin
 
+import threading
+from collections import deque
 import gl_utils
 from pyglui import cygl
 import numpy as np
@@ -30,6 +32,58 @@ class StreamError(Exception):
     pass
 
 
+class Capture_Thread(object):
+    """Runs the blocking frame grabbing function of a source on its own thread.
+
+    grab_frame() returns a frame or None and is called until the thread is stopped.
+    Frames are kept in a ring buffer of ring_size frames. If the consumer falls
+    behind, the oldest frames are overwritten and counted in `dropped`.
+    An exception raised by grab_frame() ends the thread and is kept in `error`.
+    """
+
+    def __init__(self, grab_frame, ring_size=4, name='Capture'):
+        self.grab_frame = grab_frame
+        self.captured = 0
+        self.dropped = 0
+        self.error = None
+        self._ring = deque(maxlen=ring_size)
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            try:
+                frame = self.grab_frame()
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify()
+                return
+            if frame is None:
+                continue
+            with self._cond:
+                if len(self._ring) == self._ring.maxlen:
+                    self.dropped += 1
+                self._ring.append(frame)
+                self.captured += 1
+                self._cond.notify()
+
+    def get_frames(self, timeout):
+        '''all queued frames, oldest first. Waits up to timeout seconds if there are none.'''
+        with self._cond:
+            if not self._ring and self.error is None:
+                self._cond.wait(timeout)
+            frames = list(self._ring)
+            self._ring.clear()
+        return frames
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
 class Base_Source(Plugin):
     """Abstract source class
 
@@ -46,6 +100,8 @@ class Base_Source(Plugin):
     - frame_size
 
     The recent_events function is allowed to not add a frame to the `events` object.
+    Sources that grab frames on a `Capture_Thread` add the newest frame as `events['frame']`
+    and older frames that arrived since the last call as `events['queued_frames']`.
 
     Attributes:
         g_pool (object): Global container, see `Plugin.g_pool`
@@ -16,6 +16,7 @@ import numpy as np
 from time import time,sleep
 from pyglui import ui
 from camera_models import Dummy_Camera
+from synthetic_frames import Moving_Pupil_Generator, Video_Replay_Generator
 
 #logging
 import logging
@@ -56,16 +57,26 @@ class Fake_Source(Base_Source):
     contains the necessary information to recover to the original source if
     it becomes accessible again.
 
+    For testing and benchmarking it can also stream synthetic frames (see synthetic_frames.py):
+    `pattern` 'pupil' generates a moving pupil, 'replay' loops the video at `replay_path`.
+    With `throttle` off frames are delivered as fast as the process loop runs.
+
     Attributes:
         frame_count (int): Sequence counter
         frame_rate (int)
         frame_size (tuple)
     """
-    def __init__(self, g_pool, name,frame_size,frame_rate):
+    patterns = ('static', 'pupil', 'replay')
+
+    def __init__(self, g_pool, name,frame_size,frame_rate, pattern='static', replay_path=None, throttle=True):
         super().__init__(g_pool)
         self.fps = frame_rate
         self._name = name
         self.presentation_time = time()
+        self.pattern = pattern if pattern in self.patterns else 'static'
+        self.replay_path = replay_path
+        self.throttle = throttle
+        self.generator = None
         self.make_img(tuple(frame_size))
         self.frame_count = 0
 
@@ -77,6 +88,14 @@ class Fake_Source(Base_Source):
         text = ui.Info_Text("Fake capture source streaming test images.")
         self.menu.append(text)
 
+        def set_pattern(pattern):
+            self.pattern = pattern
+            self.make_img(self.frame_size)
+        self.menu.append(ui.Selector('pattern', self, selection=self.patterns,
+                                     labels=['Static image', 'Moving pupil', 'Replay video'],
+                                     setter=set_pattern, label='Pattern'))
+        self.menu.append(ui.Switch('throttle', self, label='Limit to frame rate'))
+
     def deinit_ui(self):
         self.remove_menu()
 
@@ -88,18 +107,34 @@ class Fake_Source(Base_Source):
         # coarse[:,:,1] /=30
         # self._img = np.ones((size[1],size[0],3),dtype=np.uint8)
         self._img = cv2.resize(coarse,size,interpolation=cv2.INTER_LANCZOS4)
+        self.generator = None
+        if self.pattern == 'pupil':
+            self.generator = Moving_Pupil_Generator(size)
+        elif self.pattern == 'replay':
+            try:
+                self.generator = Video_Replay_Generator(self.replay_path)
+            except Exception as e:
+                logger.error('Could not replay "{}": {}'.format(self.replay_path, e))
+                self.pattern = 'static'
+            else:
+                self._img = self.generator.make_image(0)
+                size = self.generator.frame_size
         self._intrinsics = Dummy_Camera(size, self.name)
 
     def recent_events(self,events):
-        now = time()
-        spent = now - self.presentation_time
-        wait = max(0, 1./self.fps - spent)
-        sleep(wait)
+        if self.throttle:
+            now = time()
+            spent = now - self.presentation_time
+            wait = max(0, 1./self.fps - spent)
+            sleep(wait)
         self.presentation_time = time()
         self.frame_count += 1
         timestamp = self.g_pool.get_timestamp()
-        frame = Frame(timestamp,self._img.copy(),self.frame_count)
-        cv2.putText(frame.img, "Fake Source Frame %s"%self.frame_count,(20,20), cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,100,100))
+        if self.generator:
+            frame = Frame(timestamp,self.generator.make_image(self.frame_count),self.frame_count)
+        else:
+            frame = Frame(timestamp,self._img.copy(),self.frame_count)
+            cv2.putText(frame.img, "Fake Source Frame %s"%self.frame_count,(20,20), cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,100,100))
         events['frame'] = frame
         self._recent_frame = frame
 
@@ -167,6 +202,9 @@ class Fake_Source(Base_Source):
         d['frame_size'] = self.frame_size
         d['frame_rate'] = self.frame_rate
         d['name'] = self.name
+        d['pattern'] = self.pattern
+        d['replay_path'] = self.replay_path
+        d['throttle'] = self.throttle
         return d
 
 
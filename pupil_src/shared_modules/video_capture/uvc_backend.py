@@ -13,7 +13,7 @@ import time
 import logging
 import uvc
 from version_utils import VersionFormat
-from .base_backend import InitialisationError, Base_Source, Base_Manager
+from .base_backend import InitialisationError, Base_Source, Base_Manager, Capture_Thread
 from camera_models import load_intrinsics
 
 # check versions for our own depedencies as they are fast-changing
@@ -28,11 +28,16 @@ class UVC_Source(Base_Source):
     """
     Camera Capture is a class that encapsualtes uvc.Capture:
     """
-    def __init__(self, g_pool, frame_size, frame_rate, name=None, preferred_names=(), uid=None, uvc_controls={}):
+    def __init__(self, g_pool, frame_size, frame_rate, name=None, preferred_names=(), uid=None, uvc_controls={}, threaded=False):
         import platform
 
         super().__init__(g_pool)
         self.uvc_capture = None
+        # grab frames on a Capture_Thread instead of in recent_events
+        self.threaded = threaded
+        self.capture_thread = None
+        # menu text showing the frames dropped by the capture thread
+        self.dropped_info = None
         self._restart_in = 3
         assert name or preferred_names or uid
 
@@ -88,6 +93,8 @@ class UVC_Source(Base_Source):
             self.name_backup = (self.name,)
             self.frame_size_backup = frame_size
             self.frame_rate_backup = frame_rate
+            if threaded:
+                self.start_capture_thread()
 
     def verify_drivers(self):
         import time
@@ -221,9 +228,33 @@ class UVC_Source(Base_Source):
         else:
             self._restart_in -= 1
 
+    def start_capture_thread(self):
+        if self.uvc_capture and not self.capture_thread:
+            self.capture_thread = Capture_Thread(self._grab_frame, name='{} capture'.format(self.name))
+
+    def stop_capture_thread(self):
+        if self.capture_thread:
+            self.capture_thread.stop()
+            logger.debug('{}: {} frames captured, {} dropped.'.format(
+                self.name, self.capture_thread.captured, self.capture_thread.dropped))
+            self.capture_thread = None
+
+    def _grab_frame(self):
+        frame = self.uvc_capture.get_frame(0.05)
+        if self.ts_offset: #c930 timestamps need to be set here. The camera does not provide valid pts from device
+            frame.timestamp = uvc.get_time_monotonic() + self.ts_offset
+        frame.timestamp -= self.g_pool.timebase.value
+        return frame
+
     def recent_events(self, events):
+        if self.threaded and not self.capture_thread:
+            # (re)start after init or a successful restart
+            self.start_capture_thread()
+        if self.capture_thread:
+            self._recent_events_threaded(events)
+            return
         try:
-            frame = self.uvc_capture.get_frame(0.05)
+            frame = self._grab_frame()
         except uvc.StreamError:
             self._recent_frame = None
             self._restart_logic()
@@ -232,13 +263,41 @@ class UVC_Source(Base_Source):
             time.sleep(0.02)
             self._restart_logic()
         else:
-            if self.ts_offset: #c930 timestamps need to be set here. The camera does not provide valid pts from device
-                frame.timestamp = uvc.get_time_monotonic() + self.ts_offset
-            frame.timestamp -= self.g_pool.timebase.value
             self._recent_frame = frame
             events['frame'] = frame
             self._restart_in = 3
 
+    def _recent_events_threaded(self, events):
+        frames = self.capture_thread.get_frames(0.05)
+        if frames:
+            self._recent_frame = frames[-1]
+            events['frame'] = frames[-1]
+            if len(frames) > 1:
+                events['queued_frames'] = frames[:-1]
+            self._restart_in = 3
+            self.update_dropped_info()
+        elif self.capture_thread.error is not None:
+            error = self.capture_thread.error
+            self.stop_capture_thread()
+            self._recent_frame = None
+            if not isinstance(error, uvc.StreamError):
+                time.sleep(0.02)
+            self._restart_logic()
+
+    def set_threaded(self, threaded):
+        self.threaded = threaded
+        if threaded:
+            self.start_capture_thread()
+        else:
+            self.stop_capture_thread()
+        self.update_dropped_info()
+
+    def update_dropped_info(self):
+        if self.dropped_info is not None:
+            text = 'Dropped frames: {}'.format(self.capture_thread.dropped if self.capture_thread else '-')
+            if self.dropped_info.text != text:
+                self.dropped_info.text = text
+
     def _get_uvc_controls(self):
         d = {}
         if self.uvc_capture:
@@ -250,6 +309,7 @@ class UVC_Source(Base_Source):
         d = super().get_init_dict()
         d['frame_size'] = self.frame_size
         d['frame_rate'] = self.frame_rate
+        d['threaded'] = self.threaded
         if self.uvc_capture:
             d['name'] = self.name
             d['uvc_controls'] = self._get_uvc_controls()
@@ -273,6 +333,9 @@ class UVC_Source(Base_Source):
 
     @frame_size.setter
     def frame_size(self, new_size):
+        # the capture thread must not grab frames while the stream is reconfigured
+        was_threaded = bool(self.capture_thread)
+        self.stop_capture_thread()
         # closest match for size
         sizes = [abs(r[0]-new_size[0]) for r in self.uvc_capture.frame_sizes]
         best_size_idx = sizes.index(min(sizes))
@@ -283,6 +346,8 @@ class UVC_Source(Base_Source):
         self.frame_size_backup = size
 
         self._intrinsics = load_intrinsics(self.g_pool.user_dir, self.name, self.frame_size)
+        if was_threaded:
+            self.start_capture_thread()
 
     @property
     def intrinsics(self):
@@ -297,6 +362,8 @@ class UVC_Source(Base_Source):
 
     @frame_rate.setter
     def frame_rate(self, new_rate):
+        was_threaded = bool(self.capture_thread)
+        self.stop_capture_thread()
         # closest match for rate
         rates = [abs(r-new_rate) for r in self.uvc_capture.frame_rates]
         best_rate_idx = rates.index(min(rates))
@@ -306,6 +373,8 @@ class UVC_Source(Base_Source):
                 new_rate, self.uvc_capture.frame_size, self.uvc_capture.name, rate))
         self.uvc_capture.frame_rate = rate
         self.frame_rate_backup = rate
+        if was_threaded:
+            self.start_capture_thread()
 
     @property
     def jpeg_support(self):
@@ -316,6 +385,7 @@ class UVC_Source(Base_Source):
         return bool(self.uvc_capture)
 
     def deinit_ui(self):
+        self.dropped_info = None
         self.remove_menu()
 
     def init_ui(self):
@@ -324,7 +394,11 @@ class UVC_Source(Base_Source):
         self.update_menu()
 
     def update_menu(self):
+        if getattr(self, 'menu', None) is None:
+            # ui not initialized, e.g. in headless eye processes
+            return
         del self.menu[:]
+        self.dropped_info = None
         from pyglui import ui
         ui_elements = []
 
@@ -365,6 +439,10 @@ class UVC_Source(Base_Source):
         def frame_rate_getter():
             return (self.uvc_capture.frame_rates, [str(fr) for fr in self.uvc_capture.frame_rates])
         sensor_control.append(ui.Selector('frame_rate', self, selection_getter=frame_rate_getter, label='Frame rate'))
+        sensor_control.append(ui.Switch('threaded', self, setter=self.set_threaded, label='Capture on separate thread'))
+        self.dropped_info = ui.Info_Text('')
+        self.update_dropped_info()
+        sensor_control.append(self.dropped_info)
 
         for control in self.uvc_capture.controls:
             c = None
@@ -401,6 +479,7 @@ class UVC_Source(Base_Source):
         self.menu.extend(ui_elements)
 
     def cleanup(self):
+        self.stop_capture_thread()
         self.devices.cleanup()
         self.devices = None
         if self.uvc_capture:
@@ -446,6 +525,7 @@ class UVC_Manager(Base_Manager):
             settings = {
                 'frame_size': self.g_pool.capture.frame_size,
                 'frame_rate': self.g_pool.capture.frame_rate,
+                'threaded': getattr(self.g_pool.capture, 'threaded', False),
                 'uid': source_uid
             }
             if self.g_pool.process == 'world':
@@ -16,13 +16,66 @@ the Pupil IPC Backbone.
 '''
 
 import logging
+import random
+import weakref
+from collections import deque
+from time import monotonic
 import msgpack as serializer
 import zmq
+import shared_frames
+import datum_schema
 from zmq.utils.monitor import recv_monitor_message
 # import ujson as serializer # uncomment for json serialization
 
 assert zmq.__version__ > '15.1'
 
+# batched messages are sent on '<topic>.batch' with payload {'data': [payload, ...]}
+batch_suffix = '.batch'
+
+
+def is_batch(topic, payload):
+    return topic.endswith(batch_suffix) and isinstance(payload, dict) and 'data' in payload
+
+
+def decode_compact(payload):
+    '''
+    (datum dict, sequence number or None) of a compact payload (see datum_schema.py),
+    other payloads are returned as they are.
+    '''
+    values = datum_schema.unpack(payload)
+    if values is None:
+        return payload, None
+    # the sequence number is an optional trailing element
+    seq = values[-1] if len(values) > datum_schema.schemas[values[0]].size else None
+    return datum_schema.decode(values), seq
+
+
+def unpack_datums(topic, payload):
+    '''
+    topic and datums of a deserialized payload like Msg_Receiver returns them:
+    batches are split up and compact datums are decoded.
+    '''
+    if is_batch(topic, payload):
+        return topic[:-len(batch_suffix)], [decode_compact(datum)[0] for datum in payload['data']]
+    return topic, [decode_compact(payload)[0]]
+
+# live sockets of this process, see drop_counts()
+_receivers = weakref.WeakSet()
+_streamers = weakref.WeakSet()
+
+
+def drop_counts():
+    '''
+    number of messages lost by all sockets of this process so far:
+    gaps in the sequence numbers seen by Msg_Receivers, data replaced by newer data
+    on latest_only topics, shared memory frames that were overwritten before they were read
+    and messages discarded by Msg_Streamers with drop_policy 'count'.
+    '''
+    return {'lost': sum(r.lost for r in _receivers),
+            'conflated': sum(r.conflated for r in _receivers),
+            'unavailable': sum(r.unavailable for r in _receivers),
+            'dropped': sum(s.dropped for s in _streamers)}
+
 
 class ZMQ_handler(logging.Handler):
     '''
@@ -52,10 +105,45 @@ class Msg_Receiver(ZMQ_Socket):
     Recv messages on a sub port.
     Not threadsafe. Make a new one for each thread
     __init__ will block until connection is established.
+
+    With zero_copy=True extra message frames are returned as memoryviews
+    of the received zmq frames instead of bytes copies.
+    Use np.frombuffer() to view them as arrays without copying.
+
+    Backpressure:
+    hwm sets the receive high water mark (zmq default: 1000 messages).
+    Messages beyond it are dropped by zmq, the receiver finds out through
+    the per topic sequence numbers of Msg_Streamer(sequence_numbers=True) (see lost, lost_by_topic).
+    Topics starting with one of the latest_only prefixes are conflated:
+    recv() reads the queued messages first, at most hwm of them, and only keeps the newest one of each
+    of these topics (see conflated). Use this for frame topics when only the current frame matters.
+    ZMQ_CONFLATE can not be used instead as it does not support multipart messages.
+
+    Frames sent through shared memory (see shared_frames.py) are read when the message
+    is received. Frames that can not be read anymore are marked with
+    '__frame_unavailable__': True instead of '__raw_data__' (see unavailable).
     '''
-    def __init__(self, ctx, url, topics=(), block_until_connected=True):
+    zero_copy = False
+    latest_only = ()
+    received = 0
+    lost = 0
+    conflated = 0
+    unavailable = 0
+    # pairs do not count gaps
+    _last_seq = None
+
+    def __init__(self, ctx, url, topics=(), block_until_connected=True, zero_copy=False, hwm=None, latest_only=()):
         self.socket = zmq.Socket(ctx, zmq.SUB)
+        self.zero_copy = zero_copy
         assert type(topics) != str
+        if hwm is not None:
+            self.socket.set_hwm(hwm)
+        self.latest_only = tuple(latest_only)
+        # messages _drain_latest reads ahead at most
+        self._max_pending = hwm or 1000
+        self._last_seq = {}
+        self.lost_by_topic = {}
+        _receivers.add(self)
 
         if block_until_connected:
             # connect node and block until a connecetion has been made
@@ -73,6 +161,7 @@ class Msg_Receiver(ZMQ_Socket):
         else:
             self.socket.connect(url)
 
+        self._unbatched = deque()
         for t in topics:
             self.subscribe(t)
 
@@ -90,29 +179,156 @@ class Msg_Receiver(ZMQ_Socket):
 
         Any addional message frames will be added as a list
         in the payload dict with key: '__raw_data__' .
+        Payloads of shared memory frames that were overwritten
+        have '__frame_unavailable__' set instead.
+
+        Batches (see Msg_Batch_Streamer) are split up and returned
+        one datum at a time with the original topic.
+
+        Compact payloads (see datum_schema.py) are returned as dicts.
         '''
+        if self.latest_only:
+            self._drain_latest()
+        if not self._unbatched:
+            self._queue(*self.recv_message())
+        topic, payload = self._unbatched.popleft()
+        if isinstance(payload, serializer.ExtType):
+            # compact datum of a batch
+            payload, _ = decode_compact(payload)
+        return topic, payload
+
+    def _queue(self, topic, payload):
+        if is_batch(topic, payload):
+            topic = topic[:-len(batch_suffix)]
+            self._unbatched.extend((topic, datum) for datum in payload['data'])
+        else:
+            self._unbatched.append((topic, payload))
+
+    def _drain_latest(self):
+        '''read queued messages, keep only the newest one of latest_only topics'''
+        while len(self._unbatched) < self._max_pending and self.socket.get(zmq.EVENTS) & zmq.POLLIN:
+            topic, payload = self.recv_message()
+            if topic.startswith(self.latest_only):
+                # there is at most one pending message of this topic
+                for idx, (pending_topic, _) in enumerate(self._unbatched):
+                    if pending_topic == topic:
+                        del self._unbatched[idx]
+                        self.conflated += 1
+                        break
+            self._queue(topic, payload)
+
+    def recv_message(self):
+        '''Recv a single message without splitting batches'''
         topic = self.socket.recv_string()
         payload = serializer.loads(self.socket.recv(), encoding='utf-8')
+        self.received += 1
+        payload, seq = decode_compact(payload)
+        if isinstance(payload, dict) and '__seq__' in payload:
+            seq = payload.pop('__seq__')
+        if seq is not None:
+            self._count_gaps(topic, seq)
         extra_frames = []
         while self.socket.get(zmq.RCVMORE):
-            extra_frames.append(self.socket.recv())
-        if extra_frames:
+            if self.zero_copy:
+                extra_frames.append(self.socket.recv(copy=False).buffer)
+            else:
+                extra_frames.append(self.socket.recv())
+        if not isinstance(payload, dict):
+            # not a pupil message, returned as it is
+            pass
+        elif extra_frames:
             payload['__raw_data__'] = extra_frames
+        elif '__shm__' in payload:
+            # frame sent through shared memory, see shared_frames.py
+            data = shared_frames.resolve(payload['__shm__'])
+            if data is not None:
+                payload['__raw_data__'] = [data]
+            else:
+                payload['__frame_unavailable__'] = True
+                self.unavailable += 1
         return topic, payload
 
+    def _count_gaps(self, topic, seq):
+        if self._last_seq is None:
+            return
+        sender, idx = seq
+        last = self._last_seq.get((topic, sender))
+        if last is not None and idx > last + 1:
+            self.lost += idx - last - 1
+            self.lost_by_topic[topic] = self.lost_by_topic.get(topic, 0) + idx - last - 1
+        self._last_seq[topic, sender] = idx
+
+    @property
+    def drop_stats(self):
+        return {'received': self.received, 'lost': self.lost, 'conflated': self.conflated,
+                'unavailable': self.unavailable,
+                'lost_by_topic': dict(self.lost_by_topic)}
+
     @property
     def new_data(self):
-        return self.socket.get(zmq.EVENTS)
+        return bool(self._unbatched) or self.socket.get(zmq.EVENTS)
 
 
 class Msg_Streamer(ZMQ_Socket):
     '''
     Send messages on fast and efficient but without garatees.
     Not threadsave. Make a new one for each thread
+
+    With zero_copy=True large '__raw_data__' frames are handed to zmq
+    without copying. zmq keeps a reference to the buffer object until it is sent,
+    but the buffer memory must not be changed in the meantime.
+    Use pending_sends or wait_for_sends() if buffers are reused.
+
+    With sequence_numbers=True every message carries a per topic sequence number
+    in its '__seq__' field that Msg_Receiver uses to count lost messages and removes again.
+    It is off by default because other clients of the IPC would see the extra field.
+
+    Backpressure:
+    hwm sets the send high water mark (zmq default: 1000 messages).
+    drop_policy decides what happens to messages beyond it:
+        'drop': zmq discards them silently (zmq default for PUB sockets)
+        'count': they are discarded and counted in dropped
+        'block': send() waits until they can be queued
+
+    With compact=True pupil, gaze and fixation payloads are sent
+    in the compact encoding of datum_schema.py when they match a schema.
     '''
-    def __init__(self, ctx, url):
+    zero_copy = False
+    compact = False
+    dropped = 0
+    # trackers of zero-copy sends that might still use their buffer
+    _trackers = ()
+    # per topic sequence numbers, None disables them (Dispatcher, Pairs)
+    _next_seq = None
+    _send_flags = 0
+    drop_policies = ('drop', 'count', 'block')
+
+    def __init__(self, ctx, url, zero_copy=False, hwm=None, drop_policy='drop', compact=False, sequence_numbers=False):
         self.socket = zmq.Socket(ctx, zmq.PUB)
+        assert drop_policy in self.drop_policies
+        if hwm is not None:
+            self.socket.set_hwm(hwm)
+        if drop_policy != 'drop':
+            self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+        if drop_policy == 'count':
+            self._send_flags = zmq.NOBLOCK
         self.socket.connect(url)
+        self.zero_copy = zero_copy
+        self.drop_policy = drop_policy
+        self.compact = compact
+        self._trackers = deque()
+        self._sender = random.getrandbits(31)
+        self.sequence_numbers = sequence_numbers
+        _streamers.add(self)
+
+    @property
+    def sequence_numbers(self):
+        return self._next_seq is not None
+
+    @sequence_numbers.setter
+    def sequence_numbers(self, enabled):
+        if enabled != self.sequence_numbers:
+            self._next_seq = {} if enabled else None
 
     def send(self, topic, payload):
         '''Send a message with topic, payload
@@ -126,30 +342,121 @@ class Msg_Streamer(ZMQ_Socket):
         the contents of the iterable in '__raw_data__'
         require exposing the pyhton memoryview interface.
         '''
-        if '__raw_data__' not in payload:
-            serialized_payload = serializer.dumps(payload, use_bin_type=True)
-            self.socket.send_string(topic, flags=zmq.SNDMORE)
+        extra_frames = payload.pop('__raw_data__', None)
+        values = None
+        if self.compact and extra_frames is None and isinstance(payload, dict):
+            values = datum_schema.encode(payload)
+            if values is payload:
+                values = None
+        if self._next_seq is not None:
+            idx = self._next_seq.get(topic, 0)
+            self._next_seq[topic] = idx + 1
+            if values is not None:
+                values.append((self._sender, idx))
+            else:
+                # do not add the sequence number to the callers dict
+                payload = dict(payload, __seq__=(self._sender, idx))
+        if values is not None:
+            payload = datum_schema.pack(values)
+        serialized_payload = serializer.dumps(payload, use_bin_type=True)
+        try:
+            # a multipart message is queued completely or not at all
+            self.socket.send_string(topic, flags=zmq.SNDMORE | self._send_flags)
+        except zmq.Again:
+            self.dropped += 1
+            return
+        if extra_frames is None:
             self.socket.send(serialized_payload)
         else:
-            extra_frames = payload.pop('__raw_data__')
             assert(isinstance(extra_frames, (list, tuple)))
-            serialized_payload = serializer.dumps(payload, use_bin_type=True)
-            self.socket.send_string(topic, flags=zmq.SNDMORE)
             self.socket.send(serialized_payload, flags=zmq.SNDMORE)
             for frame in extra_frames[:-1]:
-                self.socket.send(frame, flags=zmq.SNDMORE, copy=True)
-            self.socket.send(extra_frames[-1], copy=True)
+                self.send_raw(frame, flags=zmq.SNDMORE)
+            self.send_raw(extra_frames[-1])
+
+    def send_raw(self, frame, flags=0):
+        if self.zero_copy:
+            buffer = memoryview(frame)
+            if buffer.nbytes >= zmq.COPY_THRESHOLD and buffer.c_contiguous:
+                self._trackers.append(self.socket.send(buffer, flags=flags, copy=False, track=True))
+                while self._trackers and self._trackers[0].done:
+                    self._trackers.popleft()
+                return
+        self.socket.send(frame, flags=flags, copy=True)
+
+    @property
+    def pending_sends(self):
+        '''number of zero-copy buffers that zmq has not released yet'''
+        while self._trackers and self._trackers[0].done:
+            self._trackers.popleft()
+        return len(self._trackers)
+
+    def wait_for_sends(self, timeout=-1):
+        '''
+        block until zmq released all zero-copy buffers.
+        timeout in seconds per buffer, -1 waits forever. Raises zmq.NotDone on timeout.
+        '''
+        while self._trackers:
+            self._trackers[0].wait(timeout)
+            self._trackers.popleft()
 
 
 
+class Msg_Batch_Streamer(Msg_Streamer):
+    '''
+    Msg_Streamer that collects data of the same topic and sends them
+    as a single message on '<topic>.batch'. Msg_Receiver unbatches them transparently.
+
+    A batch is sent when it holds max_count data or when its first datum
+    is older than max_delay seconds. Call flush() regularly to send batches
+    that are due while no new data arrive. max_count=1 disables batching.
+    Payloads with '__raw_data__' are never batched.
+    Not threadsave. Make a new one for each thread
+    '''
+    def __init__(self, ctx, url, max_count=10, max_delay=.01, zero_copy=False, hwm=None, drop_policy='drop',
+                 compact=False, sequence_numbers=False):
+        super().__init__(ctx, url, zero_copy, hwm, drop_policy, compact, sequence_numbers)
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self._batches = {}
+
+    def send(self, topic, payload):
+        if self.max_count <= 1 or '__raw_data__' in payload:
+            if topic in self._batches:
+                # keep the order of data on this topic
+                self._send_batch(topic)
+            super().send(topic, payload)
+            return
+        try:
+            started, batch = self._batches[topic]
+        except KeyError:
+            started, batch = self._batches[topic] = monotonic(), []
+        batch.append(datum_schema.to_ext(payload) if self.compact and isinstance(payload, dict) else payload)
+        if len(batch) >= self.max_count or monotonic() - started >= self.max_delay:
+            self._send_batch(topic)
+
+    def flush(self, force=False):
+        '''send batches that are due, or all batches if force is set'''
+        now = monotonic()
+        for topic, (started, batch) in list(self._batches.items()):
+            if force or now - started >= self.max_delay:
+                self._send_batch(topic)
+
+    def _send_batch(self, topic):
+        started, batch = self._batches.pop(topic)
+        super().send(topic + batch_suffix, {'data': batch})
+
+
 class Msg_Dispatcher(Msg_Streamer):
     '''
     Send messages with delivery guarantee.
     Not threadsafe. Make a new one for each thread.
     '''
-    def __init__(self, ctx, url):
+    def __init__(self, ctx, url, zero_copy=False):
         self.socket = zmq.Socket(ctx, zmq.PUSH)
         self.socket.connect(url)
+        self.zero_copy = zero_copy
+        self._trackers = deque()
 
     def notify(self, notification):
         '''Send a pupil notification.
@@ -172,6 +479,9 @@ class Msg_Pair_Base(Msg_Streamer,Msg_Receiver):
     def new_data(self):
         return self.socket.get(zmq.EVENTS) & zmq.POLLIN
 
+    # pairs do not carry batches
+    recv = Msg_Receiver.recv_message
+
     def subscribe(self, topic):
         raise NotImplementedError()
 
@@ -212,8 +522,96 @@ class Msg_Pair_Client(Msg_Pair_Base):
             self.socket.connect(url)
 
 
+def bench_batching(count=20000, max_count=10):
+    '''
+    compare sending pupil like data one message per datum with Msg_Batch_Streamer.
+    Uses an in-process XSUB/XPUB proxy like the IPC backbone.
+    '''
+    import threading
+    from time import sleep, perf_counter, process_time
+    ctx = zmq.Context()
+    xsub = ctx.socket(zmq.XSUB)
+    xsub.bind('inproc://bench_pub')
+    xpub = ctx.socket(zmq.XPUB)
+    xpub.bind('inproc://bench_sub')
+    xpub.set_hwm(0)
+    xsub.set_hwm(0)
+    threading.Thread(target=zmq.proxy, args=(xsub, xpub), daemon=True).start()
+
+    datum = {'topic': 'pupil', 'confidence': .9, 'ellipse': {'center': [96.5, 48.1], 'axes': [30.2, 35.8], 'angle': 90.},
+             'diameter': 35.8, 'norm_pos': [.5, .4], 'timestamp': 123.456, 'method': '2d c++', 'id': 0}
+    for name, streamer in (('single', Msg_Streamer(ctx, 'inproc://bench_pub')),
+                           ('batched', Msg_Batch_Streamer(ctx, 'inproc://bench_pub', max_count=max_count, max_delay=1.))):
+        streamer.socket.set_hwm(0)
+        receiver = Msg_Receiver(ctx, 'inproc://bench_sub', topics=('pupil',), block_until_connected=False)
+        receiver.socket.set_hwm(0)
+        sleep(.5)
+        start, cpu = perf_counter(), process_time()
+        for i in range(count):
+            streamer.send('pupil.0', datum)
+        if isinstance(streamer, Msg_Batch_Streamer):
+            streamer.flush(force=True)
+        sent, sent_cpu = perf_counter(), process_time()
+        for i in range(count):
+            receiver.recv()
+        done, done_cpu = perf_counter(), process_time()
+        print('{:>8}: send {:.2f} us/datum ({:.2f} us cpu), recv {:.2f} us/datum ({:.2f} us cpu), {:.0f} data/s'.format(
+              name, 1e6*(sent-start)/count, 1e6*(sent_cpu-cpu)/count, 1e6*(done-sent)/count,
+              1e6*(done_cpu-sent_cpu)/count, count/(done-start)))
+        del receiver, streamer
+
+
+def bench_zero_copy(duration=3.):
+    '''
+    CPU time of streaming frames through an XSUB/XPUB proxy over tcp loopback
+    with and without zero-copy send and receive, for 1080p bgr world frames at 30 Hz
+    and 400x400 gray eye frames at 400 Hz. Sender, proxy and receiver run in this process.
+
+    Frame publishers copy bgr and gray images before a zero-copy send because plugins
+    draw into them ('zero-copy+copy'). Only jpeg and yuv buffers are sent without any copy.
+    '''
+    import threading
+    import numpy as np
+    from time import sleep, perf_counter, process_time
+    ctx = zmq.Context()
+    xsub = ctx.socket(zmq.XSUB)
+    pub_port = xsub.bind_to_random_port('tcp://127.0.0.1')
+    xpub = ctx.socket(zmq.XPUB)
+    sub_port = xpub.bind_to_random_port('tcp://127.0.0.1')
+    threading.Thread(target=zmq.proxy, args=(xsub, xpub), daemon=True).start()
+
+    streams = (('1080p30 bgr', np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8), 30),
+               ('400Hz eye gray', np.random.randint(0, 255, (400, 400), dtype=np.uint8), 400))
+    for name, img, rate in streams:
+        for zero_copy, copy_first in ((False, False), (True, False), (True, True)):
+            streamer = Msg_Streamer(ctx, 'tcp://127.0.0.1:{}'.format(pub_port), zero_copy=zero_copy)
+            receiver = Msg_Receiver(ctx, 'tcp://127.0.0.1:{}'.format(sub_port), topics=('frame.',), zero_copy=zero_copy)
+            sleep(.5)
+            count = int(duration * rate)
+            start, cpu = perf_counter(), process_time()
+            for i in range(count):
+                data = img.copy() if copy_first else img
+                streamer.send('frame.bench', {'width': img.shape[1], 'height': img.shape[0], 'index': i,
+                                              'format': 'bgr', '__raw_data__': [data]})
+                topic, msg = receiver.recv()
+                frame = np.frombuffer(msg['__raw_data__'][0], dtype=np.uint8).reshape(img.shape)
+            streamer.wait_for_sends()
+            wall, cpu = perf_counter() - start, process_time() - cpu
+            mode = ('zero-copy+copy' if copy_first else 'zero-copy') if zero_copy else 'copy'
+            print('{:>15} {:>14}: {:.3f} ms cpu per frame, {:.1f}% of one core at {} Hz'.format(
+                  name, mode, 1e3*cpu/count, 100*cpu/count*rate, rate))
+            del streamer, receiver
+
+
 if __name__ == '__main__':
     from time import sleep, time
+    import sys
+    if '--bench-zero-copy' in sys.argv:
+        bench_zero_copy()
+        sys.exit()
+    if '--bench-batching' in sys.argv:
+        bench_batching()
+        sys.exit()
     # tap into the IPC backbone of pupil capture
     ctx = zmq.Context()
 
@@ -240,7 +638,7 @@ if __name__ == '__main__':
         topics=('notify.',))
     monitor = Msg_Receiver(
         ctx, 'tcp://127.0.0.1:{}'.format(ipc_sub_port),
-        topics=('pingback_test.3',))
+        topics=('pingback_test.3',), latest_only=('frame.',))
     # gaze_monitor = Msg_Receiver(ctx,'tcp://
     # localhost:%s'%ipc_sub_port,topics=('gaze.',))
 